@@ -1,3 +1,5 @@
+import os
+
 from flask import Flask
 from google.appengine.api import wrap_wsgi_app
 
@@ -5,9 +7,26 @@ from google.appengine.api import wrap_wsgi_app
 def create_app():
     app = Flask(__name__)
 
+    from app.serialization import FastJSONProvider
+    app.json = FastJSONProvider(app)
+
     app.config["PROPAGATE_EXCEPTIONS"] = True
     app.config["JWT_SECRET_KEY"] = "test_key"
     app.config['SECRET_KEY'] = 'ti-egine-kwstaki-se-goustarei-i-xwriatisa'
+    # 'outbox' stores events for the drain_purchase_events cron job, 'push' enqueues a task per purchase.
+    # Push mode waits for the Task Queue add before the response is sent, so purchases use the outbox by default.
+    app.config["EVENT_DELIVERY_MODE"] = os.environ.get("EVENT_DELIVERY_MODE", "outbox")
+    # Per-request RPC counts and timings go to a Server-Timing header and a structured log line
+    app.config["SERVER_TIMING"] = os.environ.get("SERVER_TIMING", "true").lower() == "true"
+    # Share of requests run under cProfile, 0 disables profiling
+    app.config["PROFILE_SAMPLE_RATE"] = float(os.environ.get("PROFILE_SAMPLE_RATE", 0))
+
+    # Registered first so its teardown runs last, once the request's tasks are flushed.
+    from app.instrumentation import init_instrumentation
+    init_instrumentation(app)
+
+    from app.services.task_service import init_task_batching
+    init_task_batching(app)
 
     app.wsgi_app = wrap_wsgi_app(app.wsgi_app)
 
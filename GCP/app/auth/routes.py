@@ -5,7 +5,7 @@ from flask_login import login_user, logout_user, login_required, current_user
 
 from app.models import User, logger
 from app.auth import bp as auth_bp
-from app.exceptions import UserAlreadyExistsError
+from app.exceptions import InvalidUserError, UserAlreadyExistsError
 from app.decorators import google_authenticated
 
 @auth_bp.route('/register', methods=['POST'])
@@ -23,7 +23,7 @@ def register():
     try:
         user = User.create_user(username=username, email=email, password=password, is_admin=is_admin)
         return jsonify({"model": user.kind(), "key_id": user.id()}), 201
-    except UserAlreadyExistsError as e:
+    except (InvalidUserError, UserAlreadyExistsError) as e:
         return jsonify({"message": str(e)}), 400
 
 @auth_bp.route('/login', methods=['POST'])
@@ -33,7 +33,7 @@ def login():
         return jsonify({"message": 'Invalid JSON'}), 400
     username = data.get("username")
     password = data.get("password")
-    if not username or not password:
+    if not username or not password or not username.strip():
         return jsonify({"message": 'Missing required fields'}), 400
     user = User.get_by_username(username)
     if not user or not user.check_password(password):
@@ -0,0 +1,332 @@
+import hashlib
+import json
+import pickle
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Iterable, List, NamedTuple, Optional, Sequence, Tuple, Type
+
+from google.appengine.api import memcache
+from google.appengine.datastore import entity_bytes_pb2 as entity_pb2
+from google.appengine.ext import ndb
+
+# Memcache values are limited to 1MB, leave some room for the key and flags.
+MEMCACHE_CHUNK_SIZE = 950 * 1024
+# Placeholder a reader stores in memcache while it loads an entity from Datastore, see EntityCache.get_multi.
+MEMCACHE_LEASE = "lease"
+MEMCACHE_LEASE_TIME = 10
+
+
+class LRUCache:
+    """
+        A thread-safe, size-bounded, in-process LRU cache.
+
+        Entries expire either after the cache-wide `ttl` (seconds) or at their own absolute
+        `expires_at` (epoch seconds), whichever comes first.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: Optional[float] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.time():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any, expires_at: Optional[float] = None):
+        if self.ttl is not None:
+            ttl_expiry = time.time() + self.ttl
+            expires_at = ttl_expiry if expires_at is None else min(expires_at, ttl_expiry)
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key: Hashable):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+def serialize_entity(entity: ndb.Model) -> bytes:
+    return entity._to_pb().SerializeToString()
+
+
+def deserialize_entity(model_class: Type[ndb.Model], data: bytes) -> ndb.Model:
+    return model_class._from_pb(entity_pb2.EntityProto.FromString(data))
+
+
+class EntityCache:
+    """
+        Read-through cache for the entities of one kind: a per-process LRU in front of memcache in front of Datastore.
+
+        Entities are cached as serialized protobufs, so every read returns a fresh instance that callers may
+        modify freely. Writers must call `invalidate` once their change is committed; other processes keep
+        their local copy for at most `local_ttl` seconds, so the TTL bounds how stale a read can be.
+
+        A reader that misses memcache leases the key before it reads Datastore, and only stores what it read
+        with a compare-and-set on that lease. An invalidation in between deletes the lease, so a copy read
+        before the write committed is never cached.
+
+        Hits and misses are counted per layer and reported by `stats`.
+    """
+
+    _instances = []
+
+    def __init__(self, kind: str, memcache_time: int, local_ttl: float, local_size: int = 1024):
+        self.kind = kind
+        self.memcache_time = memcache_time
+        self._local = LRUCache(max_size=local_size, ttl=local_ttl)
+        self._counters = {"local_hits": 0, "memcache_hits": 0, "misses": 0}
+        self._counters_lock = threading.Lock()
+        EntityCache._instances.append(self)
+
+    def cache_key(self, entity_id: Any) -> str:
+        return f"entity:{self.kind}:{entity_id}"
+
+    def version_key(self, entity_id: Any) -> str:
+        return f"entity_version:{self.kind}:{entity_id}"
+
+    def _count(self, counter: str, amount: int):
+        if amount:
+            with self._counters_lock:
+                self._counters[counter] += amount
+
+    def get_multi(self, model_class: Type[ndb.Model], entity_ids: Iterable[Any], local: bool = True) -> List[Optional[ndb.Model]]:
+        """
+            Loads entities by id, reading each layer at most once for the whole batch.
+            With `local` False the per-process LRU is skipped, so the copy is at most as stale as memcache.
+
+            Returns:
+                List[Optional[ndb.Model]]: the entities in the order of `entity_ids`, None for the ones that do not exist
+        """
+        entity_ids = list(entity_ids)
+        serialized = {}
+        for entity_id in entity_ids if local else ():
+            data = self._local.get(self.cache_key(entity_id))
+            if data is not None:
+                serialized[entity_id] = data
+        self._count("local_hits", len(serialized))
+
+        missing = [entity_id for entity_id in dict.fromkeys(entity_ids) if entity_id not in serialized]
+        if missing:
+            # CAS ids are kept per client, so every load uses its own.
+            client = memcache.Client()
+            cached = client.get_multi([self.cache_key(entity_id) for entity_id in missing], for_cas=True)
+            memcache_hits = 0
+            for entity_id in missing:
+                data = cached.get(self.cache_key(entity_id))
+                if data is not None and data != MEMCACHE_LEASE:
+                    serialized[entity_id] = data
+                    self._local.set(self.cache_key(entity_id), data)
+                    memcache_hits += 1
+            self._count("memcache_hits", memcache_hits)
+
+            missing = [entity_id for entity_id in missing if entity_id not in serialized]
+            self._count("misses", len(missing))
+            if missing:
+                unleased = [self.cache_key(entity_id) for entity_id in missing if self.cache_key(entity_id) not in cached]
+                if unleased:
+                    client.add_multi({cache_key: MEMCACHE_LEASE for cache_key in unleased}, time=MEMCACHE_LEASE_TIME)
+                    cached.update(client.get_multi(unleased, for_cas=True))
+                entities = ndb.get_multi([ndb.Key(model_class, entity_id) for entity_id in missing])
+                fetched = {
+                    entity.key.id(): serialize_entity(entity)
+                    for entity in entities if entity is not None
+                }
+                leased = {
+                    self.cache_key(entity_id): data for entity_id, data in fetched.items()
+                    if cached.get(self.cache_key(entity_id)) == MEMCACHE_LEASE
+                }
+                not_stored = set(client.cas_multi(leased, time=self.memcache_time)) if leased else set()
+                for entity_id, data in fetched.items():
+                    serialized[entity_id] = data
+                    if self.cache_key(entity_id) in leased and self.cache_key(entity_id) not in not_stored:
+                        self._local.set(self.cache_key(entity_id), data)
+
+        return [
+            deserialize_entity(model_class, serialized[entity_id]) if entity_id in serialized else None
+            for entity_id in entity_ids
+        ]
+
+    def get(self, model_class: Type[ndb.Model], entity_id: Any, local: bool = True) -> Optional[ndb.Model]:
+        return self.get_multi(model_class, [entity_id], local=local)[0]
+
+    def get_or_load(self, cache_key: str, load: Callable[[], Any]) -> Any:
+        """
+            Returns a value derived from the entities, such as an ETag, from memcache, calling `load` on a miss.
+
+            The loaded value is stored under the same lease as get_multi's entities, so a value loaded before
+            a concurrent `invalidate` is not cached. A None value is not cached.
+        """
+        client = memcache.Client()
+        value = client.get(cache_key, for_cas=True)
+        if value is None:
+            client.add(cache_key, MEMCACHE_LEASE, time=MEMCACHE_LEASE_TIME)
+            value = client.get(cache_key, for_cas=True)
+        if value is not None and value != MEMCACHE_LEASE:
+            return value
+        loaded = load()
+        if loaded is not None and value == MEMCACHE_LEASE:
+            client.cas(cache_key, loaded, time=self.memcache_time)
+        return loaded
+
+    def exists(self, model_class: Type[ndb.Model], entity_id: Any) -> bool:
+        """
+            Checks that an entity exists without deserializing it when any cache layer has a copy.
+        """
+        cache_key = self.cache_key(entity_id)
+        if self._local.get(cache_key) is not None:
+            self._count("local_hits", 1)
+            return True
+        data = memcache.get(cache_key)
+        if data is not None and data != MEMCACHE_LEASE:
+            self._count("memcache_hits", 1)
+            self._local.set(cache_key, data)
+            return True
+        return self.get(model_class, entity_id) is not None
+
+    def invalidate(self, *entity_ids: Any):
+        cache_keys = [self.cache_key(entity_id) for entity_id in entity_ids]
+        for cache_key in cache_keys:
+            self._local.delete(cache_key)
+        memcache.delete_multi(cache_keys + [self.version_key(entity_id) for entity_id in entity_ids])
+
+    def stats(self) -> Dict[str, int]:
+        with self._counters_lock:
+            stats = dict(self._counters)
+        stats["local_size"] = len(self._local)
+        return stats
+
+    def clear_local(self):
+        self._local.clear()
+
+    @classmethod
+    def all_stats(cls) -> Dict[str, Dict[str, int]]:
+        return {cache.kind: cache.stats() for cache in cls._instances}
+
+    @classmethod
+    def clear_all_local(cls):
+        for cache in cls._instances:
+            cache.clear_local()
+
+
+class GenerationToken(NamedTuple):
+    key: str
+    generations: List[int]
+
+
+class GenerationalCache:
+    """
+        Memcache cache for values derived from many entities, such as rendered listing pages.
+
+        Every value belongs to one or more scopes, each with a generation counter. A value is only served
+        while the counters still hold the generations it was computed under, so writers invalidate every
+        value of a scope at once with `bump`, without knowing which values exist. A lookup is a single
+        get_multi of the counters and the value.
+
+        Counters start at the current time in nanoseconds rather than 0, so a counter that memcache evicted
+        and recreated never matches the generations of values stored before the eviction.
+    """
+
+    def __init__(self, namespace: str, time: int):
+        self.namespace = namespace
+        self.time = time
+
+    def generation_key(self, scope: str) -> str:
+        return f"generation:{self.namespace}:{scope}"
+
+    def entry_key(self, scopes: Sequence[str], shape: dict) -> str:
+        digest = hashlib.sha256(json.dumps(shape, sort_keys=True).encode("utf-8")).hexdigest()
+        return f"{self.namespace}:{','.join(scopes)}:{digest}"
+
+    def get(self, scopes: Sequence[str], shape: dict) -> Tuple[Any, Optional[GenerationToken]]:
+        """
+            Looks up the value computed for `shape` under the current generations of `scopes`.
+
+            Returns:
+                Tuple[Any, Optional[GenerationToken]]: the value, or None on a miss, and the token to pass to `set`
+                    once the value is computed, or None if it must not be cached
+        """
+        entry_key = self.entry_key(scopes, shape)
+        generation_keys = [self.generation_key(scope) for scope in scopes]
+        cached = memcache.get_multi(generation_keys + [entry_key])
+
+        uninitialized = {key: time.time_ns() for key in generation_keys if key not in cached}
+        if uninitialized:
+            # Counters that lost the race to another process are read back on the next request.
+            if memcache.add_multi(uninitialized):
+                return None, None
+            cached.update(uninitialized)
+        generations = [cached[key] for key in generation_keys]
+
+        entry = cached.get(entry_key)
+        if entry is not None and entry["generations"] == generations:
+            return entry["value"], None
+        return None, GenerationToken(entry_key, generations)
+
+    def set(self, token: Optional[GenerationToken], value: Any, time: Optional[int] = None) -> bool:
+        """
+            Stores a value computed after `get` returned `token`, for `time` seconds or the cache's default.
+            A scope bumped in between makes it stale at once.
+        """
+        if token is None:
+            return False
+        return memcache.set(token.key, {"generations": token.generations, "value": value},
+                            time=self.time if time is None else time)
+
+    def bump(self, *scopes: str):
+        memcache.offset_multi({self.generation_key(scope): 1 for scope in dict.fromkeys(scopes)})
+
+
+def set_chunked(key: str, value: Any, time: int = 0) -> bool:
+    """
+        Stores a value of any size in memcache, split over as many entries as it needs.
+
+        The chunks are written first under a fresh version, then `key` is pointed at them,
+        so readers never combine chunks of two different values.
+
+        Returns:
+            bool: True if every entry was stored
+    """
+    data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+    version = uuid.uuid4().hex[:8]
+    chunks = {
+        f"{key}:{version}:{index}": data[offset:offset + MEMCACHE_CHUNK_SIZE]
+        for index, offset in enumerate(range(0, len(data), MEMCACHE_CHUNK_SIZE))
+    }
+    if memcache.set_multi(chunks, time=time):
+        return False
+    return memcache.set(key, {"version": version, "chunks": len(chunks)}, time=time)
+
+
+def get_chunked(key: str) -> Any:
+    """
+        Reads a value stored with set_chunked, or None if it or any of its chunks was evicted.
+    """
+    manifest = memcache.get(key)
+    if manifest is None:
+        return None
+    chunk_keys = [f"{key}:{manifest['version']}:{index}" for index in range(manifest["chunks"])]
+    chunks = memcache.get_multi(chunk_keys)
+    if len(chunks) != len(chunk_keys):
+        return None
+    return pickle.loads(b"".join(chunks[chunk_key] for chunk_key in chunk_keys))
@@ -1,21 +1,106 @@
-from flask import jsonify, request
+from flask import current_app, jsonify, request
 from google.appengine.ext import ndb
 from flask_login import login_required, current_user
-from google.appengine.api import memcache
 import datetime
-
-from app.models import StoreModel, ItemModel, logger
+from typing import Optional
+
+from app.models import (
+    StoreModel,
+    ItemModel,
+    StockReservation,
+    logger,
+    DEFAULT_PAGE_SIZE,
+    DEFAULT_RESERVATION_TTL,
+    LEGACY_ITEM_LISTING,
+    MAX_STOCK_SHARDS,
+    MAX_XG_ENTITY_GROUPS,
+    MAX_BULK_ITEMS,
+    MAX_GET_MULTI_KEYS,
+    STOCK_LISTING_CACHE_TIME
+)
+from app.cache import EntityCache
 from app.core import bp
 from app.exceptions import (
     ItemNotFoundError,
     ItemSoldOutError,
     StoreNotFoundError,
     InvalidItemQuantity,
-    InvalidItemPrice
+    InvalidItemPrice,
+    InvalidBatchError,
+    InvalidCursorError,
+    InvalidPageSizeError,
+    InvalidSearchError,
+    InvalidReservationError,
+    ReservationNotFoundError,
+    ReservationExpiredError
 )
 from app.decorators import admin_required
-from app.services.bigquery_service import fetch_analytics_from_bq
-from app.services.task_service import enqueue_task
+from app.instrumentation import timed
+from app.services.analytics_service import get_analytics as get_cached_analytics
+from app.services.event_service import publish_item_consumed
+
+ITEM_PROJECTED_FIELDS = {"id"} | set(ItemModel.LISTING_PROJECTION) - {"num_shards"}
+ITEM_LISTING_FIELDS = ITEM_PROJECTED_FIELDS | {"description"}
+# Related entities that item responses can embed in place of their ids.
+ITEM_EXPANDABLE_FIELDS = {"store"}
+
+# Cache-Control max-age (seconds) per route. Responses are private as every route requires a login,
+# and once stale a client revalidates with If-None-Match.
+STORE_MAX_AGE = 60
+ITEM_MAX_AGE = 5
+ITEMS_MAX_AGE = 5
+
+
+def _with_cache_headers(response, max_age: int, etag: Optional[str] = None):
+    if etag is not None:
+        response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.max_age = max_age
+    response.cache_control.must_revalidate = True
+    return response
+
+
+def _not_modified(etag: str, max_age: int):
+    """
+        Returns a 304 response if the request's If-None-Match holds `etag`, or None otherwise.
+    """
+    if not request.if_none_match.contains(etag):
+        return None
+    return _with_cache_headers(current_app.response_class(status=304), max_age, etag)
+
+
+def _conditional_response(body, max_age: int, etag: Optional[str] = None):
+    """
+        Returns `body` as JSON with the route's cache headers, or a 304 if it matches If-None-Match.
+        Without an `etag` one is derived from the response body.
+    """
+    response = _with_cache_headers(jsonify(body), max_age, etag)
+    if etag is None:
+        response.add_etag()
+    return response.make_conditional(request)
+
+def _expanded_fields():
+    """
+        Returns the fields of the request's comma separated 'expand' argument, or None if one cannot be expanded.
+    """
+    expand = {field.strip() for field in request.args.get("expand", "").split(",") if field.strip()}
+    return None if expand - ITEM_EXPANDABLE_FIELDS else expand
+
+
+def _embed_stores(item_dicts: list, local: bool = True):
+    """
+        Replaces the store ids of serialized items with the stores, loaded in one batch through the entity cache
+        and serialized once per store. Responses that are cached must pass local=False: this process' store
+        copies live for a minute and may predate the update that replaced the previous response.
+    """
+    store_ids = list(dict.fromkeys(item_dict["store"] for item_dict in item_dicts if "store" in item_dict))
+    stores = {
+        store_id: store.to_dict_extended(include_id=True) if store is not None else None
+        for store_id, store in zip(store_ids, StoreModel.get_multi_cached(store_ids, local=local))
+    }
+    for item_dict in item_dicts:
+        if "store" in item_dict:
+            item_dict["store"] = stores[item_dict["store"]]
 
 @bp.route("/stores", methods=["POST"])
 @login_required
@@ -73,12 +158,20 @@ def get_store(store_id):
         Returns:
             Response object with the store's extended details in JSON format and an HTTP status code 200 on success.
             Returns an error message in JSON format with an HTTP status code 404 if the store is not found.
+            Returns an empty response with an HTTP status code 304 if If-None-Match holds the store's current ETag,
+            which is checked without loading the store.
     """
-    store = StoreModel.get_by_id(store_id)
+    etag = StoreModel.cached_etag(store_id)
+    if etag is None:
+        return jsonify({"message": 'Invalid Store Id'}), 404
+    not_modified = _not_modified(etag, STORE_MAX_AGE)
+    if not_modified is not None:
+        return not_modified
+
+    store = StoreModel.get_cached(store_id)
     if store is None:
         return jsonify({"message": 'Invalid Store Id'}), 404
-    store_dict = store.to_dict_extended()
-    return jsonify(store_dict), 200
+    return _conditional_response(store.to_dict_extended(), STORE_MAX_AGE, store.etag())
 
 
 @bp.route("/stores/<int:store_id>", methods=["PUT"])
@@ -116,6 +209,7 @@ def create_item():
 
     Request Body:
         JSON object containing item attributes. 'name', 'price', and 'store_id' are required.
+    'stock_shards' optionally splits the stock across that many shards for hot items.
 
     Returns:
         Response object with the item's key details in JSON format and an HTTP status code 201 on success.
@@ -130,7 +224,8 @@ def create_item():
                 "description": "A new item",
                 "price": 10.99,
                 "quantity": 10,
-                "store_id": 12345
+                "store_id": 12345,
+                "stock_shards": 10
             }
         Response:
             201 Created
@@ -143,84 +238,316 @@ def create_item():
     if not data:
         return jsonify({"message": 'Invalid JSON'}), 400
 
-    name = data.get("name")
-    description = data.get("description")
-    price =  data.get("price")
-    quantity = data.get("quantity", 0)
-    store_id = data.get("store_id")
+    error = _item_row_error(data)
+    if error:
+        return jsonify({"message": error}), 400
 
-    if not name:
-        return jsonify({"message": "Invalid item name"}), 400
-    if not price or price <= 0:
-        return jsonify({"message": "Invalid item price"}), 400
-    if not store_id:
-        return jsonify({"message": "store_id is required"}), 400
-    if quantity < 0:
-        return jsonify({"message": "Invalid item quantity"}), 400
-
-    store_key = StoreModel.get_by_id(store_id)
-    if store_key is None:
+    store_id = data["store_id"]
+    if not StoreModel.exists_cached(store_id):
         return jsonify({"message": "Store not found"}), 404
 
-    item = ItemModel(
-        name=name,
-        description=description,
-        price=price,
-        store=store_key.key,
-        quantity=quantity
-    )
-    key = item.put()
+    key = _new_item(data).put()
+    if data.get("stock_shards"):
+        ItemModel.enable_sharding(key.id(), data["stock_shards"])
+    ItemModel.listing_changed(store_id)
     return jsonify({"model": key.kind(), "key_id": key.id()}), 201
 
 
+def _item_row_error(data) -> Optional[str]:
+    """
+        Validates the attributes of a new item.
+
+        Returns:
+            Optional[str]: the error message, or None if the item is valid
+    """
+    if not isinstance(data, dict):
+        return "Invalid JSON"
+
+    price = data.get("price")
+    quantity = data.get("quantity", 0)
+    stock_shards = data.get("stock_shards")
+
+    if not data.get("name"):
+        return "Invalid item name"
+    if not isinstance(price, (int, float)) or isinstance(price, bool) or price <= 0:
+        return "Invalid item price"
+    if not data.get("store_id"):
+        return "store_id is required"
+    if not isinstance(data["store_id"], int) or isinstance(data["store_id"], bool):
+        return "Invalid store_id"
+    if not isinstance(quantity, int) or isinstance(quantity, bool) or quantity < 0:
+        return "Invalid item quantity"
+    if stock_shards is not None and (not isinstance(stock_shards, int) or isinstance(stock_shards, bool) or not 1 <= stock_shards <= MAX_STOCK_SHARDS):
+        return "Invalid stock shard count"
+    return None
+
+
+def _new_item(data: dict) -> ItemModel:
+    return ItemModel(
+        name=data["name"],
+        description=data.get("description"),
+        price=data["price"],
+        store=ndb.Key(StoreModel, data["store_id"]),
+        quantity=data.get("quantity", 0)
+    )
+
+
+@bp.route("/items/bulk", methods=["POST"])
+@login_required
+@admin_required
+def create_items_bulk():
+    """
+        Creates many items in one request.
+
+        Every row is validated, all referenced stores are checked with one batch get and the valid rows
+        are written in chunks of concurrent put_multi_async calls. Invalid rows do not stop the others.
+
+        Request Body:
+            JSON list of items (or an object with an 'items' list), each with the attributes accepted by POST /items.
+
+        Returns:
+            Response object with one result per row, in request order, and an HTTP status code 201 if every row was created,
+            207 if only some were, or 400 if none was or the body is invalid.
+
+        Example:
+            Request:
+                POST /items/bulk
+                [
+                    {"name": "New Item", "price": 10.99, "quantity": 10, "store_id": 12345},
+                    {"name": "Other Item", "price": -1, "store_id": 12345}
+                ]
+            Response:
+                207 Multi-Status
+                {
+                    "created": 1,
+                    "results": [
+                        {"index": 0, "status": 201, "key_id": 67890},
+                        {"index": 1, "status": 400, "message": "Invalid item price"}
+                    ]
+                }
+    """
+    data = request.get_json(silent=True)
+    rows = data.get("items") if isinstance(data, dict) else data
+    if not rows or not isinstance(rows, list):
+        return jsonify({"message": 'Invalid JSON'}), 400
+    if len(rows) > MAX_BULK_ITEMS:
+        return jsonify({"message": f"At most {MAX_BULK_ITEMS} items can be created at once"}), 400
+
+    results = [None] * len(rows)
+    valid = []
+    for index, row in enumerate(rows):
+        error = _item_row_error(row)
+        if error:
+            results[index] = {"index": index, "status": 400, "message": error}
+        else:
+            valid.append(index)
+
+    store_ids = list(dict.fromkeys(rows[index]["store_id"] for index in valid))
+    stores = {}
+    for start in range(0, len(store_ids), MAX_GET_MULTI_KEYS):
+        chunk = store_ids[start:start + MAX_GET_MULTI_KEYS]
+        stores.update(zip(chunk, StoreModel.get_multi_cached(chunk)))
+
+    to_create = []
+    for index in valid:
+        if stores[rows[index]["store_id"]] is None:
+            results[index] = {"index": index, "status": 404, "message": "Store not found"}
+        else:
+            to_create.append(index)
+
+    keys = ItemModel.put_multi_chunked([_new_item(rows[index]) for index in to_create])
+    for index, key in zip(to_create, keys):
+        if isinstance(key, Exception):
+            results[index] = {"index": index, "status": 500, "message": str(key)}
+            continue
+        results[index] = {"index": index, "status": 201, "key_id": key.id()}
+        if rows[index].get("stock_shards"):
+            ItemModel.enable_sharding(key.id(), rows[index]["stock_shards"])
+
+    created = sum(1 for result in results if result["status"] == 201)
+    status = 201 if created == len(rows) else 207 if created else 400
+    logger.info(f"Bulk created {created} of {len(rows)} items")
+    return jsonify({"created": created, "results": results}), status
+
+
 @bp.route("/items", methods=['GET'])
 @login_required
 def get_items():
     """
         Retrieves a list of items based on the provided query parameters.
 
+        Rendered pages are cached in memcache by their normalized query, per store, so a hot page costs one
+        memcache lookup. Creating or updating an item, or updating its store, replaces every cached page of the
+        store. Purchases do not, so pages showing the quantity are only cached for STOCK_LISTING_CACHE_TIME
+        seconds and their stock can lag by that long. Pages are rendered from memcache and Datastore rather than
+        this process' entity cache, which may hold copies older than the write that replaced the previous page.
+
         Query Parameters:
-            page_size: Number of items per page (default: 2).
-            cursor: Cursor for pagination (default: None).
+            page_size: Number of items per page (default: DEFAULT_PAGE_SIZE, at most MAX_PAGE_SIZE).
+            cursor: The next_cursor of the previous page, only valid with the same filter, order and page size (default: None).
             reverse: Boolean indicating whether to reverse the order of results (default: False).
             store_id: ID of the store to filter items by (default: None).
+            fields: Comma separated item attributes to return, e.g. 'name,price,quantity' (default: all).
+                Indexed attributes are read with a projection query, so the entities themselves are never loaded,
+                once LEGACY_ITEM_LISTING is off.
+            keys_only: Boolean, never uses a projection query; the page's keys are fetched and the items loaded through the entity cache, as full pages always are (default: False).
+            ids: Comma separated item IDs, fetches exactly these items in one batch instead of a page (default: None).
+            expand: 'store' embeds each item's store in place of its id, with the page's stores loaded in one batch (default: None).
 
         Returns:
             Response object with a list of items in JSON format and an HTTP status code 200 on success.
+            Returns an error message in JSON format with an HTTP status code 400 for unknown fields or expansions, an invalid page size or cursor.
             Returns an error message in JSON format with an HTTP status code 404 if the store is not found.
+            Returns an empty response with an HTTP status code 304 if If-None-Match holds the ETag of an identical page.
     """
-    page_size = request.args.get("page_size", default=2, type=int)
-    cursor_str = request.args.get("cursor")
+    expand = _expanded_fields()
+    if expand is None:
+        return jsonify({"message": f"Only {sorted(ITEM_EXPANDABLE_FIELDS)} can be expanded"}), 400
+    ids = request.args.get("ids")
+    if ids is not None:
+        return _get_items_by_ids(ids, expand)
+
+    page_size = request.args.get("page_size", default=DEFAULT_PAGE_SIZE, type=int)
+    cursor = request.args.get("cursor")
     reverse = request.args.get("reverse", default="false").lower() == "true"
     store_id = request.args.get("store_id")
+    keys_only = request.args.get("keys_only", default="false").lower() == "true"
+    fields = request.args.get("fields")
+
+    if store_id:
+        try:
+            store_id = int(store_id)
+        except ValueError:
+            return jsonify({"message": "Invalid store_id"}), 400
+    else:
+        store_id = None
+
+    projected = False
+    if fields is not None:
+        fields = {field.strip() for field in fields.split(",") if field.strip()}
+        unknown = fields - ITEM_LISTING_FIELDS
+        if not fields or unknown:
+            return jsonify({"message": f"Invalid fields: {sorted(unknown)}"}), 400
+        # Unindexed attributes such as the description cannot be projected.
+        projected = not (keys_only or LEGACY_ITEM_LISTING) and fields <= ITEM_PROJECTED_FIELDS
+
+    # Pages are cached by the normalized query, and replaced as soon as an item of the listed store is written.
+    shape = {
+        "store_id": store_id,
+        "reverse": reverse,
+        "page_size": page_size,
+        "cursor": cursor or None,
+        "fields": sorted(fields) if fields is not None else None,
+        "projected": projected,
+        "expand": sorted(expand),
+    }
+    response, token = ItemModel.listing_cache.get(ItemModel.listing_scopes(store_id), shape)
+    if response is not None:
+        return _conditional_response(response, ITEMS_MAX_AGE)
+
+    # Only pages that will not be cached may come from this process' copies.
+    local = token is None
+    pagination = dict(
+        secret_key=current_app.config["SECRET_KEY"],
+        page_size=page_size,
+        cursor=cursor,
+        reverse=reverse,
+        projected=projected,
+        local=local
+    )
+    try:
+        if store_id is not None:
+            page = ItemModel.get_by_store(store_id, **pagination)
+        else:
+            page = ItemModel.paginate(**pagination)
+    except StoreNotFoundError as e:
+        return jsonify({"message": str(e)}), 404
+    except (InvalidPageSizeError, InvalidCursorError) as e:
+        return jsonify({"message": str(e)}), 400
 
-    cursor = ndb.Cursor(urlsafe=cursor_str) if cursor_str else None
     results = []
-    query = ItemModel.query()
+    include_id = fields is None or "id" in fields
+    with timed("serialize"):
+        for item in page.items:
+            item_dict = item.to_dict_extended(fields, include_id=include_id)
+            if fields and "store" in fields and store_id is not None:
+                # The store filter is an equality filter, so the store itself is not projected.
+                item_dict["store"] = store_id
+            results.append(item_dict)
+        if "store" in expand:
+            _embed_stores(results, local=local)
 
-    if store_id:
-        store_key = ndb.Key(StoreModel, int(store_id))
-        query = query.filter(ItemModel.store == store_key)
+    response = {
+        "items": results,
+        "pagination": {
+            "next_cursor": page.next_cursor,
+            "has_more": page.has_more,
+            "page_size": page_size,
+        }
+    }
+    shows_stock = fields is None or "quantity" in fields
+    ItemModel.listing_cache.set(token, response, time=STOCK_LISTING_CACHE_TIME if shows_stock else None)
+    return _conditional_response(response, ITEMS_MAX_AGE)
 
-    order = -ItemModel.created_at if reverse else ItemModel.created_at
-    query = query.order(order)
+@bp.route("/items/search", methods=['GET'])
+@login_required
+def search_items():
+    """
+        Finds items by name. Every word of the search must start a word of the item name, case-insensitively.
 
-    items, next_cursor, more = query.fetch_page(page_size, start_cursor=cursor)
+        Query Parameters:
+            q: The search, e.g. 'wire head' finds 'Wireless Headphones'.
+            page_size: Number of items per page (default: DEFAULT_PAGE_SIZE, at most MAX_PAGE_SIZE).
+            cursor: The next_cursor of the previous page, only valid with the same search and page size (default: None).
 
-    for item in items:
-        item_dict = item.to_dict_extended()
-        item_dict["id"] = item.key.id()
-        results.append(item_dict)
+        Returns:
+            Response object with the matching items in JSON format, best matches first across the first
+            MAX_SEARCH_MATCHES matches, and an HTTP status code 200 on success.
+            Returns an error message in JSON format with an HTTP status code 400 for an empty or too long search,
+            an invalid page size or cursor.
+    """
+    page_size = request.args.get("page_size", default=DEFAULT_PAGE_SIZE, type=int)
+    try:
+        page = ItemModel.search(
+            current_app.config["SECRET_KEY"],
+            request.args.get("q", ""),
+            page_size=page_size,
+            cursor=request.args.get("cursor")
+        )
+    except (InvalidSearchError, InvalidPageSizeError, InvalidCursorError) as e:
+        return jsonify({"message": str(e)}), 400
 
-    response = {
+    with timed("serialize"):
+        results = [item.to_dict_extended(include_id=True) for item in page.items]
+    return jsonify({
         "items": results,
         "pagination": {
-            "next_cursor": next_cursor.urlsafe().decode("utf-8") if more and next_cursor else None,
-            "has_more": more,
+            "next_cursor": page.next_cursor,
+            "has_more": page.has_more,
             "page_size": page_size,
         }
-    }
-    return jsonify(response), 200
+    }), 200
+
+def _get_items_by_ids(ids: str, expand: set):
+    try:
+        item_ids = list(dict.fromkeys(int(item_id) for item_id in ids.split(",") if item_id.strip()))
+    except ValueError:
+        return jsonify({"message": "Invalid item ids"}), 400
+    if not item_ids or len(item_ids) > MAX_GET_MULTI_KEYS:
+        return jsonify({"message": f"Between 1 and {MAX_GET_MULTI_KEYS} item ids are required"}), 400
+
+    results = []
+    missing = []
+    items = ItemModel.get_multi_cached(item_ids)
+    with timed("serialize"):
+        for item_id, item in zip(item_ids, items):
+            if item is None:
+                missing.append(item_id)
+                continue
+            results.append(item.to_dict_extended(include_id=True))
+        if "store" in expand:
+            _embed_stores(results)
+    return jsonify({"items": results, "missing": missing}), 200
 
 @bp.route("/items/<int:item_id>", methods=['GET'])
 @login_required
@@ -229,16 +556,90 @@ def get_item(item_id: int):
         Args:
             item_id: The unique identifier of the item to be retrieved.
 
+        Query Parameters:
+            expand: 'store' embeds the item's store in place of its id (default: None).
+
         Returns:
             Response object with the item's extended details in JSON format and an HTTP status code 200 on success.
-            Returns an error message in JSON format with an HTTP status code 404 if the item is not found.
+            Returns an error message in JSON format with an HTTP status code 404 if the item is not found,
+            or 400 for unknown expansions.
+            Returns an empty response with an HTTP status code 304 if If-None-Match holds the item's current ETag,
+            which is checked without loading the item unless the store is expanded.
     """
-    item = ndb.Key(ItemModel, item_id).get()
+    expand = _expanded_fields()
+    if expand is None:
+        return jsonify({"message": f"Only {sorted(ITEM_EXPANDABLE_FIELDS)} can be expanded"}), 400
+
+    if not expand:
+        etag = ItemModel.cached_etag(item_id)
+        if etag is None:
+            return jsonify({"message": 'Invalid item Id'}), 404
+        not_modified = _not_modified(etag, ITEM_MAX_AGE)
+        if not_modified is not None:
+            return not_modified
+
+    item = ItemModel.get_cached(item_id)
     if item is None:
         return jsonify({"message": 'Invalid item Id'}), 404
-
     item_dict = item.to_dict_extended()
-    return jsonify(item_dict), 200
+    etag = item.etag()
+    if "store" in expand:
+        store = StoreModel.get_cached(item.store.id())
+        item_dict["store"] = store.to_dict_extended(include_id=True) if store is not None else None
+        # The response changes with either entity.
+        etag = f"{etag}-{store.etag() if store is not None else 'none'}"
+    return _conditional_response(item_dict, ITEM_MAX_AGE, etag)
+
+@bp.route("/items/<int:item_id>/reserve", methods=["POST"])
+@login_required
+def reserve_item(item_id: int):
+    """
+        Holds units of an item for the current user, who can buy them with the returned reservation id
+        until it expires. Expired holds are returned to the stock by a cron job.
+
+        Args:
+            item_id: The unique identifier of the item to be reserved.
+
+        Request Body:
+            Optional JSON object with a 'quantity' (default: 1) and a 'ttl' in seconds (default: 600).
+
+        Returns:
+            Response object with the reservation in JSON format and an HTTP status code 201 on success.
+            Returns an error message in JSON format with an HTTP status code 404 if the item is not found,
+            or 400 for invalid input or if the item does not have enough stock.
+
+        Example:
+            Request:
+                POST /items/67890/reserve
+                {"quantity": 2, "ttl": 300}
+            Response:
+                201 Created
+                {
+                    "reservation_id": 13579,
+                    "item_id": 67890,
+                    "quantity": 2,
+                    "expires_at": "2024-01-01T12:05:00"
+                }
+    """
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return jsonify({"message": 'Invalid JSON'}), 400
+    try:
+        reservation = ItemModel.reserve(item_id, current_user.get_id(), quantity=data.get("quantity", 1),
+                                        ttl=data.get("ttl", DEFAULT_RESERVATION_TTL))
+    except ItemNotFoundError as e:
+        return jsonify({"message": str(e)}), 404
+    except ItemSoldOutError as e:
+        return jsonify({"message": str(e), "items": e.items}), 400
+    except (InvalidItemQuantity, InvalidReservationError) as e:
+        return jsonify({"message": str(e)}), 400
+
+    return jsonify({
+        "reservation_id": reservation.key.id(),
+        "item_id": item_id,
+        "quantity": reservation.quantity,
+        "expires_at": reservation.expires_at.isoformat()
+    }), 201
 
 @bp.route("/items/<int:item_id>/buy", methods=["POST"])
 @login_required
@@ -247,31 +648,110 @@ def buy_item(item_id: int):
         Args:
             item_id: The unique identifier of the item to be purchased.
 
+        Request Body:
+            Optional JSON object with the 'reservation_id' of a reservation of the item to buy,
+            otherwise a single unit is taken from the stock.
+
         Raises:
             ItemNotFoundError: If the item with the given ID does not exist.
             ItemSoldOutError: If the item is sold out and cannot be purchased.
 
         Returns:
             Response object with the item's extended details in JSON format and an HTTP status code 200 on success.
-            Returns an error message in JSON format with an HTTP status code 404 if the item is not found,
-            or 400 if the item is sold out.
+            Returns an error message in JSON format with an HTTP status code 404 if the item or the reservation
+            is not found, 410 if the reservation expired, or 400 if the item is sold out.
     """
+    data = request.get_json(silent=True)
+    reservation_id = data.get("reservation_id") if isinstance(data, dict) else None
+    if reservation_id is not None and (not isinstance(reservation_id, int) or isinstance(reservation_id, bool)):
+        return jsonify({"message": "Invalid reservation id"}), 400
     try:
-        item = ItemModel.consume_item(item_id)
-        task_payload = {
-            "user_id": current_user.get_id(),
-            "item_id": item_id,
-            "store_id": item.store.id(),
-            "timestamp": datetime.datetime.now().isoformat()
-        }
-        enqueue_task(target='/tasks/log_item_consumed', queue_name='log-item-consumed', payload=task_payload)
+        if reservation_id is not None:
+            reservation = StockReservation.complete(reservation_id, item_id, current_user.get_id())
+            item = ItemModel.get_cached(item_id)
+            if item is None:
+                raise ItemNotFoundError("Invalid item id")
+            quantity = reservation.quantity
+        else:
+            item = ItemModel.consume_item(item_id)
+            quantity = 1
+        publish_item_consumed(
+            user_id=current_user.get_id(),
+            lines=[{"item_id": item_id, "store_id": item.store.id(), "quantity": quantity}],
+            timestamp=datetime.datetime.now().isoformat()
+        )
 
         return jsonify(item.to_dict_extended()), 200
+    except (ItemNotFoundError, ReservationNotFoundError) as e:
+        return jsonify({"message": str(e)}), 404
+    except ReservationExpiredError as e:
+        return jsonify({"message": str(e)}), 410
+    except ItemSoldOutError as e:
+        return jsonify({"message": str(e)}), 400
+
+@bp.route("/items/buy", methods=["POST"])
+@login_required
+def buy_items():
+    """
+        Purchases several items at once. Either every line is bought or none is.
+
+        Request Body:
+            JSON list of cart lines (or an object with an 'items' list), each with an 'item_id' and an optional 'quantity' (default: 1).
+
+        Returns:
+            Response object with the purchased items' extended details in JSON format and an HTTP status code 200 on success.
+            Returns an error message in JSON format with an HTTP status code 404 if an item is not found,
+            or 400 for invalid input or if any item is sold out, together with the per-item shortfalls.
+
+        Example:
+            Request:
+                POST /items/buy
+                [
+                    {"item_id": 67890, "quantity": 2},
+                    {"item_id": 67891}
+                ]
+            Response:
+                400 Bad Request
+                {
+                    "message": "Items sold out",
+                    "items": [{"item_id": 67891, "requested": 1, "available": 0}]
+                }
+    """
+    data = request.get_json()
+    lines = data.get("items") if isinstance(data, dict) else data
+    if not lines or not isinstance(lines, list):
+        return jsonify({"message": 'Invalid JSON'}), 400
+    if len(lines) > MAX_XG_ENTITY_GROUPS:
+        return jsonify({"message": f"At most {MAX_XG_ENTITY_GROUPS} items can be bought at once"}), 400
+
+    try:
+        cart = [(int(line["item_id"]), line.get("quantity", 1)) for line in lines]
+    except (KeyError, TypeError, ValueError, AttributeError):
+        return jsonify({"message": "Invalid cart line"}), 400
+
+    try:
+        items = ItemModel.consume_items(cart)
     except ItemNotFoundError as e:
         return jsonify({"message": str(e)}), 404
     except ItemSoldOutError as e:
+        return jsonify({"message": str(e), "items": e.items}), 400
+    except (InvalidItemQuantity, InvalidBatchError) as e:
         return jsonify({"message": str(e)}), 400
 
+    quantities = {}
+    for item_id, quantity in cart:
+        quantities[item_id] = quantities.get(item_id, 0) + quantity
+    publish_item_consumed(
+        user_id=current_user.get_id(),
+        lines=[
+            {"item_id": item.key.id(), "store_id": item.store.id(), "quantity": quantities[item.key.id()]}
+            for item in items
+        ],
+        timestamp=datetime.datetime.now().isoformat()
+    )
+
+    return jsonify({"items": items}), 200
+
 @bp.route("/items/<int:item_id>", methods=["PUT"])
 @login_required
 @admin_required
@@ -323,12 +803,30 @@ def update_item(item_id: int):
 @bp.route("/analytics", methods=["GET"])
 @login_required
 def get_analytics():
-    cache_key = "cached_analytics"
-    force_fresh = request.args.get("force_fresh", "false")
-    analytics = memcache.get(cache_key)
-    if force_fresh.lower() == "true" or not analytics: #fallback if cache not yet initiated
-        analytics = fetch_analytics_from_bq()
-        memcache.set(cache_key, analytics, time=3600*24)
+    """
+        Returns the purchase analytics of the last 7 days, from a cache that is refreshed in the background.
+
+        Query Parameters:
+            force_fresh: Boolean, admins only, refreshes the cache in the background (default: False).
+    """
+    force_fresh = request.args.get("force_fresh", "false").lower() == "true" and current_user.is_admin
+    analytics = get_cached_analytics(force_refresh=force_fresh)
     return jsonify(analytics), 200
 
 
+@bp.route("/cache/stats", methods=["GET"])
+@login_required
+@admin_required
+def get_cache_stats():
+    """
+        Returns the entity cache hit and miss counters of this instance, per kind.
+
+        Example:
+            Response:
+                200 OK
+                {
+                    "ItemModel": {"local_hits": 120, "memcache_hits": 8, "misses": 2, "local_size": 10},
+                    ...
+                }
+    """
+    return jsonify(EntityCache.all_stats()), 200
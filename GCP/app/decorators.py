@@ -1,10 +1,11 @@
-import google.auth.transport.requests
-from google.oauth2 import id_token
 from functools import wraps
 from flask import request, abort
 from flask_login import current_user
 import logging
 
+from app.instrumentation import timed
+from app.services.token_service import get_token_verifier
+
 def google_authenticated(func):
     @wraps(func)
     def decorated_function(*args, **kwargs):
@@ -16,7 +17,8 @@ def google_authenticated(func):
         token = token_parts[1] if len(token_parts) > 1 else None
 
         try:
-            id_token.verify_token(token, google.auth.transport.requests.Request())
+            with timed("auth"):
+                get_token_verifier().verify(token)
         except Exception as e:
             logging.error(f"Authentication denied: {e}")
             abort(401)
@@ -2,7 +2,9 @@ class ItemNotFoundError(Exception):
     pass
 
 class ItemSoldOutError(Exception):
-    pass
+    def __init__(self, message: str = "Item sold out", items: list = None):
+        super().__init__(message)
+        self.items = items or []
 
 class InvalidItemQuantity(Exception):
     pass
@@ -18,3 +20,30 @@ class StoreNotFoundError(Exception):
 
 class UserAlreadyExistsError(Exception):
     pass
+
+class InvalidShardCount(Exception):
+    pass
+
+class InvalidBatchError(Exception):
+    pass
+
+class InvalidCursorError(Exception):
+    pass
+
+class InvalidPageSizeError(Exception):
+    pass
+
+class InvalidReservationError(Exception):
+    pass
+
+class ReservationNotFoundError(Exception):
+    pass
+
+class ReservationExpiredError(Exception):
+    pass
+
+class InvalidSearchError(Exception):
+    pass
+
+class InvalidUserError(Exception):
+    pass
@@ -0,0 +1,47 @@
+"""
+    Generates index.yaml from the queries the models run, so the composite indexes cannot drift from the code.
+
+    Usage:
+        python -m app.indexes
+"""
+import os
+from typing import List
+
+from app.models import ItemModel
+
+INDEX_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "index.yaml")
+
+
+def item_listing_indexes() -> List[dict]:
+    """
+        The indexes of GET /items: the store filtered full listing, and the projection listings with and without
+        the store filter, each in both created_at directions.
+    """
+    indexes = []
+    for direction in ("asc", "desc"):
+        indexes.append({"kind": "ItemModel", "properties": [("store", "asc"), ("created_at", direction)]})
+    for store_filtered in (True, False):
+        projected = [name for name in ItemModel.listing_projection(store_filtered) if name != "created_at"]
+        for direction in ("asc", "desc"):
+            properties = [("store", "asc")] if store_filtered else []
+            properties += [("created_at", direction)] + [(name, "asc") for name in projected]
+            indexes.append({"kind": "ItemModel", "properties": properties})
+    return indexes
+
+
+def render_index_yaml(indexes: List[dict]) -> str:
+    lines = ["indexes:"]
+    for index in indexes:
+        lines.append(f"- kind: {index['kind']}")
+        lines.append("  properties:")
+        for name, direction in index["properties"]:
+            lines.append(f"    - name: {name}")
+            if direction == "desc":
+                lines.append("      direction: desc")
+    return "\n".join(lines) + "\n"
+
+
+if __name__ == "__main__":
+    with open(INDEX_FILE, "w") as index_file:
+        index_file.write(render_index_yaml(item_listing_indexes()))
+    print(f"Wrote {INDEX_FILE}")
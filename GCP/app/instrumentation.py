@@ -0,0 +1,217 @@
+import contextvars
+import cProfile
+import io
+import json
+import pstats
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Hashable, Optional
+
+from flask import Flask, current_app, g, request
+from google.appengine.api import apiproxy_stub_map
+
+from app.models import logger
+
+# App Engine services whose RPCs are counted and timed, by their Server-Timing metric name.
+RPC_METRICS = {"datastore_v3": "datastore", "memcache": "memcache", "taskqueue": "taskqueue"}
+PROFILE_TOP_FUNCTIONS = 25
+
+_current = contextvars.ContextVar("request_metrics", default=None)
+
+
+class RequestMetrics:
+    """
+        The RPC counts, cache hits and time breakdown of one request.
+
+        Times are wall-clock milliseconds per component. RPCs that run concurrently overlap, so the
+        components can add up to more than the request. An async RPC is timed by the request that waits for it.
+
+        RPC hooks and callbacks may run on other threads than the request's, so the counters are updated
+        under a lock.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.rpc_counts: Dict[str, int] = {}
+        self.timings: Dict[str, float] = {}
+        self.memcache_hits = 0
+        self.memcache_misses = 0
+        self.status: Optional[int] = None
+        self._rpc_started = {}
+        self._lock = threading.Lock()
+
+    def add_time(self, name: str, seconds: float):
+        with self._lock:
+            self.timings[name] = self.timings.get(name, 0.0) + seconds * 1000
+
+    def start_rpc(self, name: str, rpc_id: Hashable):
+        with self._lock:
+            self.rpc_counts[name] = self.rpc_counts.get(name, 0) + 1
+            self._rpc_started[rpc_id] = time.perf_counter()
+
+    def finish_rpc(self, name: str, rpc_id: Hashable):
+        with self._lock:
+            started = self._rpc_started.pop(rpc_id, None)
+            if started is not None:
+                self.timings[name] = self.timings.get(name, 0.0) + (time.perf_counter() - started) * 1000
+
+    def add_memcache_lookups(self, hits: int, misses: int):
+        with self._lock:
+            self.memcache_hits += hits
+            self.memcache_misses += misses
+
+    def total_ms(self) -> float:
+        return (time.perf_counter() - self.started) * 1000
+
+    def server_timing(self) -> str:
+        """
+            Returns:
+                str: the Server-Timing header value, one metric per component plus the request total
+        """
+        metrics = []
+        with self._lock:
+            timings, rpc_counts = dict(self.timings), dict(self.rpc_counts)
+            memcache_hits, memcache_misses = self.memcache_hits, self.memcache_misses
+        for name in {**timings, **rpc_counts}:
+            duration = timings.get(name, 0.0)
+            description = ""
+            if name in rpc_counts:
+                description = f"{rpc_counts[name]} RPCs"
+            if name == "memcache":
+                description += f", {memcache_hits} hits, {memcache_misses} misses"
+            metrics.append(f'{name};dur={duration:.1f}' + (f';desc="{description}"' if description else ""))
+        metrics.append(f"total;dur={self.total_ms():.1f}")
+        return ", ".join(metrics)
+
+    def fields(self) -> dict:
+        with self._lock:
+            return {
+                "method": request.method,
+                "path": request.path,
+                "endpoint": request.endpoint,
+                "status": self.status,
+                "total_ms": round(self.total_ms(), 2),
+                "timings_ms": {name: round(duration, 2) for name, duration in self.timings.items()},
+                "rpc_counts": dict(self.rpc_counts),
+                "memcache": {"hits": self.memcache_hits, "misses": self.memcache_misses},
+            }
+
+
+def current_metrics() -> Optional[RequestMetrics]:
+    return _current.get()
+
+
+@contextmanager
+def timed(name: str):
+    """
+        Adds the time spent in the block to the `name` component of the current request. Outside of a request,
+        e.g. in a background thread, it does nothing.
+    """
+    metrics = _current.get()
+    if metrics is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.add_time(name, time.perf_counter() - started)
+
+
+def _rpc_precall(service, call, request_pb, response_pb, rpc):
+    metrics = _current.get()
+    name = RPC_METRICS.get(service)
+    if metrics is None or name is None:
+        return
+    metrics.start_rpc(name, id(rpc) if rpc is not None else (service, call))
+
+
+def _rpc_postcall(service, call, request_pb, response_pb, rpc, error):
+    metrics = _current.get()
+    name = RPC_METRICS.get(service)
+    if metrics is None or name is None:
+        return
+    metrics.finish_rpc(name, id(rpc) if rpc is not None else (service, call))
+    if service == "memcache" and call == "Get" and error is None:
+        hits = len(response_pb.item)
+        metrics.add_memcache_lookups(hits, len(request_pb.key) - hits)
+
+
+def _install_rpc_hooks():
+    # testbed swaps in a new apiproxy on activation, so the hooks are checked for on every request.
+    apiproxy = apiproxy_stub_map.apiproxy
+    if getattr(apiproxy, "_request_metrics_hooks", False):
+        return
+    apiproxy.GetPreCallHooks().Append("request_metrics", _rpc_precall)
+    apiproxy.GetPostCallHooks().Append("request_metrics", _rpc_postcall)
+    apiproxy._request_metrics_hooks = True
+
+
+def log_profile(stats: pstats.Stats, fields: dict):
+    """
+        The default profile hook: logs the functions with the highest cumulative time.
+    """
+    output = io.StringIO()
+    stats.stream = output
+    stats.sort_stats("cumulative").print_stats(PROFILE_TOP_FUNCTIONS)
+    logger.info(f"Profile of {fields['method']} {fields['path']} ({fields['total_ms']} ms)\n{output.getvalue()}")
+
+
+def _start_request():
+    _install_rpc_hooks()
+    g.request_metrics_token = _current.set(RequestMetrics())
+
+    rate = current_app.config["PROFILE_SAMPLE_RATE"]
+    if rate and random.random() < rate:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another request of this process is being profiled.
+            return
+        g.request_profiler = profiler
+
+
+def _finish_response(response):
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.status = response.status_code
+        if current_app.config["SERVER_TIMING"]:
+            response.headers["Server-Timing"] = metrics.server_timing()
+    return response
+
+
+def _finish_request(exception=None):
+    token = g.pop("request_metrics_token", None)
+    if token is None:
+        return
+    metrics = _current.get()
+    profiler = g.pop("request_profiler", None)
+    if profiler is not None:
+        profiler.disable()
+    _current.reset(token)
+
+    fields = metrics.fields()
+    logger.info(f"Request metrics {json.dumps(fields)}", extra={"json_fields": fields})
+    if profiler is not None:
+        hook: Callable[[pstats.Stats, dict], None] = current_app.config["PROFILE_HOOK"]
+        hook(pstats.Stats(profiler), fields)
+
+
+def init_instrumentation(app: Flask):
+    """
+        Records the RPCs and time breakdown of every request of `app`.
+
+        The totals are sent in a Server-Timing header (unless SERVER_TIMING is off) and logged as one structured
+        line once the request is torn down, after the tasks it enqueued are flushed. A PROFILE_SAMPLE_RATE share
+        of the requests is also run under cProfile, and the stats are passed to PROFILE_HOOK. On Python 3.12 the
+        profiler sees every thread, so with threaded workers a profile also covers the requests served meanwhile.
+
+        Must be called before any other teardown_request function is registered, so it runs after them.
+    """
+    app.config.setdefault("PROFILE_HOOK", log_profile)
+    app.before_request(_start_request)
+    app.after_request(_finish_response)
+    app.teardown_request(_finish_request)
@@ -1,16 +1,36 @@
 from google.appengine.ext import ndb
-from typing import Optional, Union, List
+from google.appengine.api import memcache
+from typing import Optional, Union, List, Tuple, NamedTuple
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
+import datetime
+import hashlib
+import json
 import logging
+import os
+import random
+import re
 
+from itsdangerous import BadSignature, URLSafeSerializer
+
+from app.cache import EntityCache, GenerationalCache
+from app.serialization import ModelSerializer
 from app.exceptions import (
     ItemNotFoundError,
     ItemSoldOutError,
     StoreNotFoundError,
     InvalidItemQuantity,
     UserAlreadyExistsError,
-    InvalidItemPrice
+    InvalidUserError,
+    InvalidItemPrice,
+    InvalidShardCount,
+    InvalidBatchError,
+    InvalidCursorError,
+    InvalidPageSizeError,
+    InvalidSearchError,
+    InvalidReservationError,
+    ReservationNotFoundError,
+    ReservationExpiredError
 )
 
 
@@ -21,19 +41,155 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
+# An XG transaction may touch at most 25 entity groups; keep room for the item itself.
+MAX_STOCK_SHARDS = 20
+MAX_XG_ENTITY_GROUPS = 25
+BATCH_CONSUME_ATTEMPTS = 3
+STOCK_TOTAL_CACHE_TIME = 60
+# Datastore accepts at most 500 entities per put and 1000 keys per get.
+PUT_MULTI_CHUNK_SIZE = 500
+MAX_BULK_ITEMS = 10000
+MAX_GET_MULTI_KEYS = 1000
+DEFAULT_PAGE_SIZE = int(os.environ.get("ITEMS_PAGE_SIZE", 20))
+MAX_PAGE_SIZE = int(os.environ.get("ITEMS_MAX_PAGE_SIZE", 100))
+# How long a rendered listing page is kept; any item write in its store replaces it sooner.
+LISTING_CACHE_TIME = 300
+# Purchases and reservations do not replace listing pages, so pages showing the stock are only kept this long.
+STOCK_LISTING_CACHE_TIME = 5
+# Item names are indexed by every prefix of their words up to this length, and whole words of any length.
+SEARCH_PREFIX_LENGTH = 20
+# Each search word adds an equality filter to the query, which Datastore merges without composite indexes.
+MAX_SEARCH_WORDS = 5
+# A search ranks at most this many matches, and keeps the ranking for its later pages this long (seconds).
+MAX_SEARCH_MATCHES = 200
+SEARCH_RESULTS_TIME = 60
+# Stock reservation lifetimes (seconds), and how many expired reservations the sweeper releases per query.
+DEFAULT_RESERVATION_TTL = 600
+MAX_RESERVATION_TTL = 1800
+RESERVATION_SWEEP_BATCH_SIZE = 200
+
+# Entity cache policies: (memcache seconds, in-process seconds, in-process entries).
+# Other instances cannot invalidate this process' copy, so the in-process TTL bounds how stale a read can be.
+STORE_CACHE_POLICY = (3600, 60, 1024)
+ITEM_CACHE_POLICY = (600, 5, 4096)
+USER_CACHE_POLICY = (60, 5, 2048)
+# A claimed username or email always points to the same user, so the mapping can be cached for long.
+UNIQUE_VALUE_CACHE_POLICY = (3600, 600, 4096)
+
+# Users created before usernames and emails were claimed are found by query and claimed on their next login.
+# Turn off once /tasks/claim_user_values has run, so unknown usernames cost no query.
+LEGACY_USER_LOOKUP = os.environ.get("LEGACY_USER_LOOKUP", "true").lower() != "false"
+# Items written before num_shards existed have no value for it, so projection queries, which skip entities
+# missing a projected property, would not list them. Listings are only projected once
+# /tasks/backfill_item_listing_properties has run and this is set to false.
+LEGACY_ITEM_LISTING = os.environ.get("LEGACY_ITEM_LISTING", "true").lower() != "false"
+
+class CachedModelMixin:
+    """
+    Read-through caching by id for a model, with the policy given by its `_cache` EntityCache.
+
+    Every put or delete invalidates the cached copy once it is committed, so writers need no extra code.
+    Puts of new entities, whose ids are only allocated by the put, skip the invalidation as nothing can be cached yet.
+    """
+    _cache: EntityCache = None
+    _cache_may_be_stale = True
+
+    @classmethod
+    def get_cached(cls, entity_id):
+        return cls._cache.get(cls, entity_id)
+
+    @classmethod
+    def get_multi_cached(cls, entity_ids, local: bool = True) -> list:
+        return cls._cache.get_multi(cls, entity_ids, local=local)
+
+    @classmethod
+    def exists_cached(cls, entity_id) -> bool:
+        return cls._cache.exists(cls, entity_id)
+
+    @classmethod
+    def invalidate_cache(cls, *entity_ids):
+        cls._cache.invalidate(*entity_ids)
+
+    def _pre_put_hook(self):
+        super()._pre_put_hook()
+        self._cache_may_be_stale = self.key is not None and self.key.id() is not None
+
+    def _post_put_hook(self, future):
+        if not self._cache_may_be_stale:
+            return
+        entity_id = self.key.id()
+        ndb.get_context().call_on_commit(lambda: self.invalidate_cache(entity_id))
+
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        cls.invalidate_cache(key.id())
+
+class VersionedModelMixin:
+    """
+    Counts the writes of an entity in `version`, which is bumped on every put.
+
+    The version is the entity's strong ETag. Together with CachedModelMixin, the current ETag is kept in
+    memcache so conditional requests can be answered without loading the entity.
+    """
+    version = ndb.IntegerProperty(default=0, indexed=False)
+
+    def _pre_put_hook(self):
+        super()._pre_put_hook()
+        self.version = (self.version or 0) + 1
+
+    def etag(self) -> str:
+        return f"{self._get_kind()}-{self.key.id()}-{self.version}"
+
+    @classmethod
+    def cached_etag(cls, entity_id) -> Optional[str]:
+        """
+        Returns the current ETag of an entity, or None if it does not exist.
+
+        On a miss the entity is read past this process' LRU, whose copy may predate a write on another instance,
+        and the ETag is cached under a lease, so an ETag read before a concurrent write is not kept.
+        """
+        def load() -> Optional[str]:
+            entity = cls._cache.get(cls, entity_id, local=False)
+            return entity.etag() if entity is not None else None
+        return cls._cache.get_or_load(cls._cache.version_key(entity_id), load)
+
 class SerializationMixin:
-    def to_dict_extended(self) -> dict:
-        data = self.to_dict()
-        for attr_name, attr_value in data.items():
-            if isinstance(attr_value, ndb.Key):
-                data[attr_name] = attr_value.id()
-        return data
+    # Properties that are never serialized.
+    _serializer_exclude = ()
+
+    @classmethod
+    def serializer(cls) -> ModelSerializer:
+        serializer = cls.__dict__.get('_serializer')
+        if serializer is None:
+            serializer = ModelSerializer(cls, exclude=cls._serializer_exclude)
+            cls._serializer = serializer
+        return serializer
+
+    def to_dict_extended(self, fields: Optional[set] = None, include_id: bool = False) -> dict:
+        """
+        Serializes the entity with its model's compiled serializer, key properties become ids and dates HTTP dates.
 
-class StoreModel(ndb.Model, SerializationMixin):
+        Args:
+            fields (Optional[set]): the properties to return, or None for all of them
+            include_id (bool): whether to add the key id as 'id'
+        """
+        return self.serializer().serialize(self, fields, include_id)
+
+class StoreModel(CachedModelMixin, VersionedModelMixin, ndb.Model, SerializationMixin):
     name = ndb.StringProperty(required=True)
     description = ndb.TextProperty()
     created_at = ndb.DateTimeProperty(auto_now_add=True)
 
+    _cache = EntityCache('StoreModel', *STORE_CACHE_POLICY)
+    _serializer_exclude = ('version',)
+
+    def _post_put_hook(self, future):
+        super()._post_put_hook(future)
+        if self._cache_may_be_stale:
+            # Item listings can embed their store.
+            store_id = self.key.id()
+            ndb.get_context().call_on_commit(lambda: ItemModel.listing_changed(store_id))
+
     @classmethod
     def get_by_id(cls, store_id: int) -> Union['StoreModel', None]:
         store = ndb.Key(cls, store_id).get()
@@ -73,13 +229,137 @@ class StoreModel(ndb.Model, SerializationMixin):
         return store
 
 
-class ItemModel(ndb.Model, SerializationMixin):
+class ItemStockShard(ndb.Model):
+    """A slice of a sharded item's stock. Each shard is its own entity group."""
+    item = ndb.KeyProperty(kind='ItemModel', required=True)
+    count = ndb.IntegerProperty(required=True, default=0)
+
+    @classmethod
+    def key_for(cls, item_id: int, index: int) -> ndb.Key:
+        return ndb.Key(cls, f"{item_id}-{index}")
+
+    @classmethod
+    @ndb.transactional()
+    def take(cls, shard_key: ndb.Key, amount: int = 1) -> bool:
+        """
+        Decrements a single shard.
+
+        Returns:
+            bool: True if the shard had enough stock and was decremented, False otherwise
+        """
+        shard = shard_key.get()
+        if shard is None or shard.count < amount:
+            return False
+        shard.count -= amount
+        shard.put()
+        return True
+
+
+class ItemModel(CachedModelMixin, VersionedModelMixin, ndb.Model, SerializationMixin):
     name = ndb.StringProperty(required=True)
     price = ndb.FloatProperty(required=True)
     description = ndb.TextProperty()
     created_at = ndb.DateTimeProperty(auto_now_add=True)
     store = ndb.KeyProperty(kind=StoreModel, required=True)
     quantity = ndb.IntegerProperty(required=True, default=0)
+    num_shards = ndb.IntegerProperty(default=0)
+    # Written from the name on every put, see search.
+    search_terms = ndb.StringProperty(repeated=True)
+
+    _cache = EntityCache('ItemModel', *ITEM_CACHE_POLICY)
+    # Rendered GET /items pages, scoped per store and for the unfiltered listing.
+    listing_cache = GenerationalCache('item_listing', LISTING_CACHE_TIME)
+
+    # The indexed properties read by projection listings, always projected together so one composite index
+    # per filter and direction serves every `fields` combination. A projection query only returns entities
+    # that have a value for each of them, see LEGACY_ITEM_LISTING.
+    LISTING_PROJECTION = ('created_at', 'name', 'num_shards', 'price', 'quantity', 'store')
+
+    _serializer_exclude = ('num_shards', 'version', 'search_terms')
+    # Set on items whose next put only moves stock, which leaves the listings cached.
+    _stock_only_write = False
+
+    def to_dict_extended(self, fields: Optional[set] = None, include_id: bool = False) -> dict:
+        data = super().to_dict_extended(fields, include_id)
+        if self.num_shards and 'quantity' in data:
+            data['quantity'] = self.get_stock()
+        return data
+
+    def _pre_put_hook(self):
+        super()._pre_put_hook()
+        self.search_terms = self.search_terms_for(self.name)
+
+    def _post_put_hook(self, future):
+        super()._post_put_hook(future)
+        stock_only_write, self._stock_only_write = self._stock_only_write, False
+        if self._cache_may_be_stale and not stock_only_write:
+            store_id = self.store.id()
+            ndb.get_context().call_on_commit(lambda: self.listing_changed(store_id))
+
+    @staticmethod
+    def listing_scopes(store_id: Optional[int]) -> List[str]:
+        return ['all'] if store_id is None else [f'store:{store_id}']
+
+    @classmethod
+    def listing_changed(cls, *store_ids: int):
+        """
+        Invalidates the cached listing pages of the given stores and of the unfiltered listing.
+
+        Updates of existing items, and of stores as listings can embed them, call it once committed. New items have no cached copy to invalidate,
+        so their creators call it themselves, once per batch. Purchases, reservations and their releases only move
+        stock and do not call it: a hot item would otherwise replace its store's pages on every sale. Pages showing
+        the stock are cached for STOCK_LISTING_CACHE_TIME instead.
+        """
+        cls.listing_cache.bump(*cls.listing_scopes(None), *(scope for store_id in store_ids for scope in cls.listing_scopes(store_id)))
+
+    def etag(self) -> str:
+        # Sharded stock changes without a write to the item, so it is part of the ETag.
+        if self.num_shards:
+            return f"{super().etag()}-{self.get_stock()}"
+        return super().etag()
+
+    @staticmethod
+    def _stock_cache_key(item_id: int) -> str:
+        return f"item_stock_total:{item_id}"
+
+    @classmethod
+    def _shard_stock_taken(cls, item: 'ItemModel', amount: int = 1):
+        memcache.decr(cls._stock_cache_key(item.key.id()), delta=amount)
+        memcache.delete(cls._cache.version_key(item.key.id()))
+
+    @classmethod
+    def _shard_stock_returned(cls, item: 'ItemModel', amount: int):
+        memcache.incr(cls._stock_cache_key(item.key.id()), delta=amount)
+        memcache.delete(cls._cache.version_key(item.key.id()))
+
+    @staticmethod
+    def _split_stock(quantity: int, num_shards: int) -> List[int]:
+        base, extra = divmod(quantity, num_shards)
+        return [base + (1 if index < extra else 0) for index in range(num_shards)]
+
+    def shard_keys(self) -> List[ndb.Key]:
+        return [ItemStockShard.key_for(self.key.id(), index) for index in range(self.num_shards)]
+
+    def get_stock(self, cached: bool = True) -> int:
+        """
+        Returns the available stock of the item.
+
+        For sharded items the total is served from memcache and rebuilt by summing the shards on a miss.
+        With cached=False the shards are always summed and the memcache total is replaced, as it drifts when
+        a shard write commits but the memcache update after it is lost.
+        """
+        if not self.num_shards:
+            return self.quantity or 0
+        cache_key = self._stock_cache_key(self.key.id())
+        total = memcache.get(cache_key) if cached else None
+        if total is None:
+            shards = ndb.get_multi(self.shard_keys())
+            total = sum(shard.count for shard in shards if shard is not None)
+            if cached:
+                memcache.add(cache_key, total, time=STOCK_TOTAL_CACHE_TIME)
+            else:
+                memcache.set(cache_key, total, time=STOCK_TOTAL_CACHE_TIME)
+        return int(total)
 
     @classmethod
     def get_by_id(cls, item_id: int) -> Union['ItemModel', None]:
@@ -87,26 +367,322 @@ class ItemModel(ndb.Model, SerializationMixin):
         return item
 
     @classmethod
-    def get_by_store(cls, store_id: int, page_size: int = 2, cursor: Optional[str] = None, reverse: bool = False) -> (List['ItemModel'], Optional[str], bool):
-        store = StoreModel.get_by_id(store_id)
-        if store is None:
-            raise StoreNotFoundError("Invalid store id")
+    @ndb.transactional(xg=True)
+    def enable_sharding(cls, item_id: int, num_shards: int) -> 'ItemModel':
+        """
+        Moves the stock of an item into `num_shards` shard entities so that concurrent buys do not
+        contend on a single entity group.
+
+        Args:
+            item_id (int): the id of the item to shard
+            num_shards (int): the number of shards to split the stock across
+
+        Returns:
+            ItemModel: the updated item object
+
+        Raises:
+            ItemNotFoundError: if the item is not found
+            InvalidShardCount: if the shard count is out of range or the item is already sharded
+        """
+        if not isinstance(num_shards, int) or not 1 <= num_shards <= MAX_STOCK_SHARDS:
+            raise InvalidShardCount(f"Shard count must be between 1 and {MAX_STOCK_SHARDS}")
+        item = ndb.Key(cls, item_id).get()
+        if item is None:
+            raise ItemNotFoundError("Invalid item id")
+        if item.num_shards:
+            raise InvalidShardCount("Item stock is already sharded")
+
+        item.num_shards = num_shards
+        counts = cls._split_stock(item.quantity or 0, num_shards)
+        shards = [
+            ItemStockShard(key=shard_key, item=item.key, count=count)
+            for shard_key, count in zip(item.shard_keys(), counts)
+        ]
+        ndb.put_multi([item] + shards)
+        cache_key = cls._stock_cache_key(item_id)
+        ndb.get_context().call_on_commit(lambda: memcache.set(cache_key, sum(counts), time=STOCK_TOTAL_CACHE_TIME))
+        return item
+
+    @classmethod
+    def put_multi_chunked(cls, items: List['ItemModel'], chunk_size: int = PUT_MULTI_CHUNK_SIZE) -> List[Union[ndb.Key, Exception]]:
+        """
+        Writes items in chunks of `chunk_size`, with every chunk's put_multi_async in flight at once.
+
+        Chunks fail independently, so a failed chunk does not undo the others.
+
+        Returns:
+            List[Union[ndb.Key, Exception]]: the key of every item, or the error its write failed with
+        """
+        chunks = [items[start:start + chunk_size] for start in range(0, len(items), chunk_size)]
+        futures = [ndb.put_multi_async(chunk) for chunk in chunks]
+        results = []
+        for chunk_futures in futures:
+            for future in chunk_futures:
+                try:
+                    results.append(future.get_result())
+                except Exception as e:
+                    logger.error(f"Error writing items: {e}")
+                    results.append(e)
+        cls.listing_changed(*{item.store.id() for item in items})
+        return results
+
+    @classmethod
+    def listing_projection(cls, store_filtered: bool) -> List[str]:
+        """
+        Returns the properties to project for a listing. Properties with an equality filter cannot be projected.
+        """
+        return [name for name in cls.LISTING_PROJECTION if not (store_filtered and name == 'store')]
+
+    @staticmethod
+    def _listing_fingerprint(store_id: Optional[int], reverse: bool, projected: bool) -> str:
+        query = json.dumps({"store_id": store_id, "reverse": reverse, "projected": projected}, sort_keys=True)
+        return hashlib.sha256(query.encode("utf-8")).hexdigest()[:16]
+
+    @classmethod
+    def paginate(cls, secret_key: str, page_size: int = DEFAULT_PAGE_SIZE, cursor: Optional[str] = None,
+                 store_id: Optional[int] = None, reverse: bool = False, projected: bool = False,
+                 local: bool = True) -> 'ItemPage':
+        """
+        Returns one page of items, ordered by creation time.
+
+        Cursors are opaque and signed with `secret_key`. They carry a fingerprint of the filter and order
+        they were issued for, so a cursor cannot be replayed against a different query.
+
+        Full pages are read as a keys-only query and loaded through the entity cache.
+        Projected pages read the LISTING_PROJECTION properties with a projection query instead.
+
+        Args:
+            secret_key (str): the key that signs and verifies the cursors
+            page_size (int): the number of items per page, between 1 and MAX_PAGE_SIZE
+            cursor (Optional[str]): the next_cursor of the previous page, or None for the first page
+            store_id (Optional[int]): only list the items of this store
+            reverse (bool): newest items first
+            projected (bool): read the LISTING_PROJECTION properties only
+            local (bool): whether full pages may be read from this process' entity cache, whose copies may
+                predate a write on another instance
+
+        Returns:
+            ItemPage: the items, the cursor of the next page and whether there is one
+
+        Raises:
+            InvalidPageSizeError: if the page size is out of range
+            InvalidCursorError: if the cursor is malformed, tampered with or was issued for another query
+        """
+        if not isinstance(page_size, int) or not 1 <= page_size <= MAX_PAGE_SIZE:
+            raise InvalidPageSizeError(f"page_size must be between 1 and {MAX_PAGE_SIZE}")
+        fingerprint = cls._listing_fingerprint(store_id, reverse, projected)
+        serializer = URLSafeSerializer(secret_key, salt="item-listing")
+        start_cursor = cls._load_cursor(serializer, cursor, fingerprint, page_size)
+
+        query = cls.query()
+        if store_id is not None:
+            query = query.filter(cls.store == ndb.Key(StoreModel, store_id))
+        query = query.order(-cls.created_at if reverse else cls.created_at)
+
+        def sign(next_cursor: Optional[ndb.Cursor], more: bool) -> Optional[str]:
+            return cls._sign_cursor(serializer, next_cursor, more, fingerprint, page_size)
+
+        if projected:
+            items, next_cursor, more = query.fetch_page(
+                page_size, start_cursor=start_cursor, projection=cls.listing_projection(store_id is not None))
+            signed = sign(next_cursor, more)
+            return ItemPage(items, signed, signed is not None)
+
+        keys, next_cursor, more = query.fetch_page(page_size, start_cursor=start_cursor, keys_only=True)
+        items = [item for item in cls.get_multi_cached([key.id() for key in keys], local=local) if item is not None]
+        signed = sign(next_cursor, more)
+        return ItemPage(items, signed, signed is not None)
+
+    @staticmethod
+    def _load_cursor(serializer: URLSafeSerializer, cursor: Optional[str], fingerprint: str,
+                     page_size: int) -> Optional[ndb.Cursor]:
+        if not cursor:
+            return None
+        try:
+            payload = serializer.loads(cursor)
+        except BadSignature:
+            raise InvalidCursorError("Invalid cursor")
+        if payload.get("query") != fingerprint or payload.get("page_size") != page_size:
+            raise InvalidCursorError("Cursor does not belong to this query")
+        return ndb.Cursor(urlsafe=payload["cursor"])
+
+    @staticmethod
+    def _sign_cursor(serializer: URLSafeSerializer, next_cursor: Optional[ndb.Cursor], more: bool, fingerprint: str,
+                     page_size: int) -> Optional[str]:
+        if not (more and next_cursor):
+            return None
+        return serializer.dumps({"query": fingerprint, "page_size": page_size,
+                                 "cursor": next_cursor.urlsafe().decode("utf-8")})
+
+    @staticmethod
+    def search_words(text: str) -> List[str]:
+        return list(dict.fromkeys(re.findall(r"\w+", text.casefold())))
+
+    @classmethod
+    def search_terms_for(cls, name: Optional[str]) -> List[str]:
+        """
+        Returns the search terms of an item name: each word, and each of its prefixes up to SEARCH_PREFIX_LENGTH.
+        """
+        terms = set()
+        for word in cls.search_words(name or ""):
+            terms.add(word)
+            terms.update(word[:length] for length in range(1, min(len(word), SEARCH_PREFIX_LENGTH) + 1))
+        return sorted(terms)
+
+    @staticmethod
+    def _search_rank(item: 'ItemModel', words: List[str]) -> int:
+        name = item.name.casefold()
+        query = " ".join(words)
+        if name == query:
+            return 0
+        if name.startswith(query):
+            return 1
+        name_words = set(ItemModel.search_words(item.name))
+        return 2 if all(word in name_words for word in words) else 3
+
+    @classmethod
+    def search(cls, secret_key: str, text: str, page_size: int = DEFAULT_PAGE_SIZE,
+               cursor: Optional[str] = None) -> 'ItemPage':
+        """
+        Returns one page of the items whose name has a word starting with every word of `text`, best matches first.
+
+        The first page runs one keys-only query on `search_terms` for up to MAX_SEARCH_MATCHES items, loads them
+        in one batch through the entity cache and ranks them: exact names first, then names starting with `text`,
+        then names holding every word of `text` whole, then the rest, each group by name. The ranked ids are kept
+        in memcache for SEARCH_RESULTS_TIME seconds, so later pages only load their own items.
+        Matches beyond MAX_SEARCH_MATCHES are not returned.
+
+        Raises:
+            InvalidSearchError: if `text` has no words or more than MAX_SEARCH_WORDS
+            InvalidPageSizeError: if the page size is out of range
+            InvalidCursorError: if the cursor is malformed, tampered with or was issued for another search
+        """
+        words = cls.search_words(text)
+        if not 1 <= len(words) <= MAX_SEARCH_WORDS:
+            raise InvalidSearchError(f"The search must have between 1 and {MAX_SEARCH_WORDS} words")
+        if not isinstance(page_size, int) or not 1 <= page_size <= MAX_PAGE_SIZE:
+            raise InvalidPageSizeError(f"page_size must be between 1 and {MAX_PAGE_SIZE}")
+        fingerprint = hashlib.sha256(json.dumps(words).encode("utf-8")).hexdigest()[:16]
+        serializer = URLSafeSerializer(secret_key, salt="item-search")
+        offset = 0
+        if cursor:
+            try:
+                payload = serializer.loads(cursor)
+            except BadSignature:
+                raise InvalidCursorError("Invalid cursor")
+            if payload.get("query") != fingerprint or payload.get("page_size") != page_size:
+                raise InvalidCursorError("Cursor does not belong to this query")
+            offset = payload["offset"]
 
-        store_key = store.key
-        query = cls.query(ItemModel.store == store_key)
-        if reverse:
-            query = query.order(-ItemModel.created_at)
+        results_key = f"item_search:{fingerprint}"
+        ranked_ids = memcache.get(results_key) if offset else None
+        if ranked_ids is None:
+            terms = sorted({word[:SEARCH_PREFIX_LENGTH] for word in words})
+            keys = cls.query(*(cls.search_terms == term for term in terms)).fetch(MAX_SEARCH_MATCHES, keys_only=True)
+            matches = [item for item in cls.get_multi_cached([key.id() for key in keys]) if item is not None]
+            matches.sort(key=lambda item: (cls._search_rank(item, words), item.name.casefold()))
+            ranked_ids = [item.key.id() for item in matches]
+            memcache.set(results_key, ranked_ids, time=SEARCH_RESULTS_TIME)
+            items = matches[offset:offset + page_size]
         else:
-            query = query.order(ItemModel.created_at)
-        items, next_cursor, more = query.fetch_page(page_size, start_cursor=cursor)
-        return items, next_cursor, more
+            page_ids = ranked_ids[offset:offset + page_size]
+            items = [item for item in cls.get_multi_cached(page_ids) if item is not None]
+
+        next_offset = offset + page_size
+        signed = None
+        if next_offset < len(ranked_ids):
+            signed = serializer.dumps({"query": fingerprint, "page_size": page_size, "offset": next_offset})
+        return ItemPage(items, signed, signed is not None)
 
     @classmethod
+    def backfill_listing_properties(cls, batch_size: int = PUT_MULTI_CHUNK_SIZE) -> int:
+        """
+        Writes the LISTING_PROJECTION properties of the items that have no stored value for one of them,
+        such as the items created before num_shards existed, so projection queries return them.
+
+        Each such item is re-read and written in its own transaction, so concurrent writes are not overwritten.
+
+        Returns:
+            int: the number of items updated
+        """
+        updated = 0
+        cursor, more = None, True
+        while more:
+            items, cursor, more = cls.query().fetch_page(batch_size, start_cursor=cursor)
+            for item in items:
+                if cls._lacks_listing_properties(item) and cls._backfill_listing_properties_txn(item.key):
+                    updated += 1
+        return updated
+
+    @classmethod
+    def _lacks_listing_properties(cls, item: 'ItemModel') -> bool:
+        # Defaults are applied on read but only stored by a put.
+        return any(not cls._properties[name]._has_value(item) for name in cls.LISTING_PROJECTION)
+
+    @staticmethod
+    @ndb.transactional()
+    def _backfill_listing_properties_txn(item_key: ndb.Key) -> bool:
+        item = item_key.get()
+        if item is None or not ItemModel._lacks_listing_properties(item):
+            return False
+        item.put()
+        return True
+
+    @classmethod
+    def index_search_terms(cls, batch_size: int = PUT_MULTI_CHUNK_SIZE) -> int:
+        """
+        Writes the search terms of the items created before items were searchable.
+
+        Each stale item is re-read and written in its own transaction, so purchases and updates committed
+        while the migration runs are not overwritten.
+
+        Returns:
+            int: the number of items updated
+        """
+        updated = 0
+        cursor, more = None, True
+        while more:
+            items, cursor, more = cls.query().fetch_page(batch_size, start_cursor=cursor)
+            for item in items:
+                if item.search_terms != cls.search_terms_for(item.name) and cls._index_search_terms_txn(item.key):
+                    updated += 1
+        return updated
+
+    @staticmethod
     @ndb.transactional()
+    def _index_search_terms_txn(item_key: ndb.Key) -> bool:
+        item = item_key.get()
+        if item is None or item.search_terms == ItemModel.search_terms_for(item.name):
+            return False
+        item.put()
+        return True
+
+    @classmethod
+    def get_by_store(cls, store_id: int, secret_key: str, page_size: int = DEFAULT_PAGE_SIZE, cursor: Optional[str] = None,
+                     reverse: bool = False, projected: bool = False, local: bool = True) -> 'ItemPage':
+        """
+        Returns one page of a store's items, see paginate.
+
+        Raises:
+            StoreNotFoundError: if the store is not found
+            InvalidPageSizeError: if the page size is out of range
+            InvalidCursorError: if the cursor is invalid for this query
+        """
+        if not StoreModel.exists_cached(store_id):
+            raise StoreNotFoundError("Invalid store id")
+        return cls.paginate(secret_key, page_size=page_size, cursor=cursor, store_id=store_id,
+                            reverse=reverse, projected=projected, local=local)
+
+    @classmethod
     def consume_item(cls, item_id: int) -> Union['ItemModel', None]:
         """
             Consumes an item by decrementing its quantity.
 
+            Sharded items decrement a random non-empty shard instead of the item entity.
+            The item is read through the entity cache, and items the cache shows as sold out are confirmed
+            against memcache and Datastore, summing the shards of sharded items, and rejected without a
+            transaction; otherwise the stock is checked again in the transaction.
+
             Args:
                 item_id (int): the id of the item to consume
 
@@ -117,21 +693,254 @@ class ItemModel(ndb.Model, SerializationMixin):
                 ItemNotFoundError: if the item is not found
                 ItemSoldOutError: if the item is sold out
         """
+        item = cls.get_cached(item_id)
+        if item is not None and item.get_stock() < 1:
+            # This process' copy may predate a restock, memcache is invalidated by every committed write.
+            # A sharded item's cached total may have drifted from its shards.
+            item = cls._cache.get(cls, item_id, local=False)
+            if item is not None and item.get_stock(cached=False) < 1:
+                raise ItemSoldOutError("Item sold out")
+        if item is None:
+            raise ItemNotFoundError("Invalid item id")
+        if item.num_shards:
+            return cls._consume_sharded(item)
+        item = cls._consume_unsharded(item_id)
+        if item.num_shards:
+            # The cached copy predates enable_sharding.
+            return cls._consume_sharded(item)
+        return item
+
+    @classmethod
+    @ndb.transactional()
+    def _consume_unsharded(cls, item_id: int) -> 'ItemModel':
         item = ndb.Key(cls, item_id).get()
         if item is None:
             raise ItemNotFoundError("Invalid item id")
+        if item.num_shards:
+            return item
         if item.quantity is None or item.quantity < 1:
             raise ItemSoldOutError("Item sold out")
         item.quantity -= 1
+        item._stock_only_write = True
         item.put()
         return item
 
     @classmethod
-    @ndb.transactional()
+    def _consume_sharded(cls, item: 'ItemModel') -> 'ItemModel':
+        """
+        Takes a unit from a random shard among the ones a single get_multi shows as non-empty. Only if every one
+        of them was drained concurrently are the remaining shards tried, as they may have been restocked since.
+        """
+        shard_keys = item.shard_keys()
+        candidates = [shard.key for shard in ndb.get_multi(shard_keys) if shard is not None and shard.count > 0]
+        random.shuffle(candidates)
+        others = [shard_key for shard_key in shard_keys if shard_key not in candidates]
+        random.shuffle(others)
+        for shard_key in candidates + others:
+            if ItemStockShard.take(shard_key):
+                cls._shard_stock_taken(item)
+                return item
+        raise ItemSoldOutError("Item sold out")
+
+    @classmethod
+    def consume_items(cls, lines: List[Tuple[int, int]]) -> List['ItemModel']:
+        """
+        Consumes several items at once, all-or-nothing, in a single cross-group transaction.
+
+        Stock is validated up front with one get_multi so that obviously sold out carts never open a
+        transaction. Sharded items are decremented from the fewest shards that cover the requested quantity.
+
+        Args:
+            lines (List[Tuple[int, int]]): (item_id, quantity) pairs, duplicate ids are merged
+
+        Returns:
+            List['ItemModel']: the consumed items, in the order they were first requested
+
+        Raises:
+            InvalidItemQuantity: if a quantity is not a positive integer
+            InvalidBatchError: if the batch is empty or spans more entity groups than one transaction allows
+            ItemNotFoundError: if any of the items is not found
+            ItemSoldOutError: if any of the items does not have enough stock, `items` holds the details
+        """
+        quantities = {}
+        for item_id, quantity in lines:
+            if not isinstance(quantity, int) or isinstance(quantity, bool) or quantity < 1:
+                raise InvalidItemQuantity('Quantity must be >= 1')
+            quantities[item_id] = quantities.get(item_id, 0) + quantity
+        if not quantities:
+            raise InvalidBatchError('No items to consume')
+
+        items = cls.get_multi_cached(quantities)
+        missing = [item_id for item_id, item in zip(quantities, items) if item is None]
+        if missing:
+            raise ItemNotFoundError(f"Invalid item ids: {missing}")
+
+        sold_out = cls._stock_shortfalls(
+            (item, quantities[item.key.id()], item.get_stock()) for item in items
+        )
+        if sold_out:
+            # The cached copies may predate a restock, confirm against Datastore and the shards before rejecting the cart.
+            items = ndb.get_multi([item.key for item in items])
+            sold_out = cls._stock_shortfalls(
+                (item, quantities[item.key.id()], item.get_stock(cached=False)) for item in items
+            )
+            if sold_out:
+                raise ItemSoldOutError("Items sold out", items=sold_out)
+
+        for _ in range(BATCH_CONSUME_ATTEMPTS):
+            plan = cls._plan_shard_takes([item for item in items if item.num_shards], quantities)
+            if plan is None:
+                break
+            if len(plan) + sum(1 for item in items if not item.num_shards) > MAX_XG_ENTITY_GROUPS:
+                raise InvalidBatchError('Too many items in a single purchase')
+            consumed = cls._consume_items_txn([item.key for item in items if not item.num_shards], quantities, plan)
+            if consumed is not None:
+                for item in items:
+                    if item.num_shards:
+                        cls._shard_stock_taken(item, quantities[item.key.id()])
+                consumed = {item.key: item for item in consumed}
+                return [consumed.get(item.key, item) for item in items]
+            items = ndb.get_multi([item.key for item in items])
+
+        sold_out = cls._stock_shortfalls(
+            (item, quantities[item.key.id()], sum(shard.count for shard in ndb.get_multi(item.shard_keys()) if shard))
+            for item in items if item.num_shards
+        )
+        raise ItemSoldOutError("Items sold out", items=sold_out)
+
+    @staticmethod
+    def _stock_shortfalls(candidates) -> List[dict]:
+        return [
+            {"item_id": item.key.id(), "requested": requested, "available": available}
+            for item, requested, available in candidates
+            if available < requested
+        ]
+
+    @classmethod
+    def _plan_shard_takes(cls, sharded_items: List['ItemModel'], quantities: dict) -> Optional[dict]:
+        """
+        Picks, for every sharded item, the fewest shards that cover its requested quantity.
+
+        Returns:
+            Optional[dict]: shard key -> amount to take, or None if a sharded item no longer has enough stock
+        """
+        shard_keys = [key for item in sharded_items for key in item.shard_keys()]
+        shards = dict(zip(shard_keys, ndb.get_multi(shard_keys)))
+        plan = {}
+        for item in sharded_items:
+            remaining = quantities[item.key.id()]
+            available = [shards[key] for key in item.shard_keys() if shards[key] is not None and shards[key].count > 0]
+            for shard in sorted(available, key=lambda shard: shard.count, reverse=True):
+                if remaining == 0:
+                    break
+                amount = min(shard.count, remaining)
+                plan[shard.key] = amount
+                remaining -= amount
+            if remaining:
+                return None
+        return plan
+
+    @classmethod
+    @ndb.transactional(xg=True)
+    def _consume_items_txn(cls, item_keys: List[ndb.Key], quantities: dict, shard_plan: dict) -> Optional[List['ItemModel']]:
+        """
+        Applies a batch purchase and returns the updated unsharded items. Returns None, without writing anything,
+        if a planned shard was drained concurrently or an item was sharded since it was read,
+        and raises ItemSoldOutError if an unsharded item ran out of stock.
+        """
+        shard_keys = list(shard_plan)
+        entities = ndb.get_multi(item_keys + shard_keys)
+        items, shards = entities[:len(item_keys)], entities[len(item_keys):]
+        if any(item.num_shards for item in items):
+            return None
+
+        sold_out = cls._stock_shortfalls(
+            (item, quantities[item.key.id()], item.quantity or 0) for item in items
+        )
+        if sold_out:
+            raise ItemSoldOutError("Items sold out", items=sold_out)
+        if any(shard is None or shard.count < shard_plan[shard_key] for shard_key, shard in zip(shard_keys, shards)):
+            return None
+
+        for item in items:
+            item.quantity -= quantities[item.key.id()]
+            item._stock_only_write = True
+        for shard_key, shard in zip(shard_keys, shards):
+            shard.count -= shard_plan[shard_key]
+        ndb.put_multi(items + shards)
+        return items
+
+    @classmethod
+    def reserve(cls, item_id: int, user_id: int, quantity: int = 1, ttl: int = DEFAULT_RESERVATION_TTL) -> 'StockReservation':
+        """
+            Holds `quantity` units of an item for `ttl` seconds, so the user can buy them later without
+            contending for the stock again.
+
+            The held units leave the available stock right away and return to it if the reservation expires.
+            Sharded items hold them from the fewest shards that cover the quantity, like consume_items.
+            Requests for more than the available stock, confirmed past the caches, are rejected before any
+            transaction starts.
+
+            Args:
+                item_id (int): the id of the item to reserve
+                user_id (int): the id of the user who may buy the reserved units
+                quantity (int): the number of units to hold
+                ttl (int): how long the hold lasts, in seconds
+
+            Returns:
+                StockReservation: the new reservation
+
+            Raises:
+                ItemNotFoundError: if the item is not found
+                ItemSoldOutError: if the item does not have `quantity` units available
+                InvalidItemQuantity: if the quantity is not a positive integer
+                InvalidReservationError: if the ttl is out of range
+        """
+        if not isinstance(quantity, int) or isinstance(quantity, bool) or quantity < 1:
+            raise InvalidItemQuantity('Quantity must be >= 1')
+        if not isinstance(ttl, int) or isinstance(ttl, bool) or not 1 <= ttl <= MAX_RESERVATION_TTL:
+            raise InvalidReservationError(f"Reservation ttl must be between 1 and {MAX_RESERVATION_TTL} seconds")
+
+        item = cls.get_cached(item_id)
+        if item is not None and item.get_stock() < quantity:
+            # This process' copy may predate a restock, memcache is invalidated by every committed write.
+            # A sharded item's cached total may have drifted from its shards.
+            item = cls._cache.get(cls, item_id, local=False)
+            sold_out = cls._stock_shortfalls([(item, quantity, item.get_stock(cached=False))] if item else [])
+            if sold_out:
+                raise ItemSoldOutError("Item sold out", items=sold_out)
+        if item is None:
+            raise ItemNotFoundError("Invalid item id")
+
+        expires_at = datetime.datetime.utcnow() + datetime.timedelta(seconds=ttl)
+        for _ in range(BATCH_CONSUME_ATTEMPTS):
+            if item.num_shards:
+                plan = cls._plan_shard_takes([item], {item.key.id(): quantity})
+                if plan is None:
+                    break
+            else:
+                plan = {item.key: quantity}
+            reservation = StockReservation.hold(plan, item.key, user_id, quantity, expires_at)
+            if reservation is not None:
+                if item.num_shards:
+                    cls._shard_stock_taken(item, quantity)
+                return reservation
+            # A planned shard was drained concurrently, or the item was sharded since it was read.
+            item = item.key.get()
+            if item is None:
+                raise ItemNotFoundError("Invalid item id")
+
+        sold_out = cls._stock_shortfalls([(item, quantity, item.get_stock(cached=False))])
+        raise ItemSoldOutError("Item sold out", items=sold_out)
+
+    @classmethod
+    @ndb.transactional(xg=True)
     def update_item(cls, item_id: int, **kwargs) -> Union['ItemModel', None]:
         """
         Updates an item with the given attributes.
 
+        Setting the quantity of a sharded item redistributes it evenly across its shards.
+
         Args:
             item_id (int): the id of the item to update
             **kwargs: the attributes to update, along with their values
@@ -149,7 +958,7 @@ class ItemModel(ndb.Model, SerializationMixin):
         if item is None:
             raise ItemNotFoundError('Invalid item id')
 
-        excluded_attrs = {'created_at', 'key', 'name', 'store'}
+        excluded_attrs = {'created_at', 'key', 'name', 'store', 'num_shards'}
 
         validations = {
             'quantity': lambda x: x >= 0 or InvalidItemQuantity('Quantity must be >= 0'),
@@ -163,11 +972,314 @@ class ItemModel(ndb.Model, SerializationMixin):
                     if isinstance(validations_result, Exception):
                         raise validations_result
                 setattr(item, attr_name, attr_value)
-        item.put()
+
+        if item.num_shards and 'quantity' in kwargs:
+            counts = cls._split_stock(item.quantity, item.num_shards)
+            shards = [
+                ItemStockShard(key=shard_key, item=item.key, count=count)
+                for shard_key, count in zip(item.shard_keys(), counts)
+            ]
+            # Registered before the put, whose hook invalidates the listings once the new total is cached.
+            cache_key = cls._stock_cache_key(item_id)
+            ndb.get_context().call_on_commit(lambda: memcache.set(cache_key, item.quantity, time=STOCK_TOTAL_CACHE_TIME))
+            ndb.put_multi([item] + shards)
+        else:
+            item.put()
         return item
 
 
-class User(UserMixin, ndb.Model, SerializationMixin):
+class ItemPage(NamedTuple):
+    items: List[ItemModel]
+    next_cursor: Optional[str]
+    has_more: bool
+
+
+class StockReservation(ndb.Model):
+    """
+    Units of an item held for a user until `expires_at`.
+
+    The units were taken from the `stock` entities, the item itself or some of its shards, `amounts[i]` of them
+    from `stock[i]`. Buying the reservation deletes it, and the sweeper returns the units of expired reservations
+    to the stock they came from.
+    """
+    item = ndb.KeyProperty(kind='ItemModel', required=True)
+    stock = ndb.KeyProperty(repeated=True, indexed=False)
+    amounts = ndb.IntegerProperty(repeated=True, indexed=False)
+    user_id = ndb.IntegerProperty(indexed=False)
+    quantity = ndb.IntegerProperty(required=True, indexed=False)
+    expires_at = ndb.DateTimeProperty(required=True)
+
+    def takes(self) -> List[Tuple[ndb.Key, int]]:
+        # Reservations written before holds could span shards took every unit from a single stock entity.
+        return list(zip(self.stock, self.amounts or [self.quantity]))
+
+    @classmethod
+    @ndb.transactional(xg=True)
+    def hold(cls, plan: dict, item_key: ndb.Key, user_id: int, quantity: int,
+             expires_at: datetime.datetime) -> Optional['StockReservation']:
+        """
+        Moves `quantity` units out of an item, or out of some of its shards, into a new reservation.
+
+        Args:
+            plan (dict): stock key -> units to take from it, the item's key or the keys of its shards
+
+        Returns:
+            Optional[StockReservation]: the reservation, or None if a stock entity does not have its planned units
+                or the item was sharded since it was read
+        """
+        stock_keys = list(plan)
+        stocks = ndb.get_multi(stock_keys)
+        for stock_key, stock in zip(stock_keys, stocks):
+            if stock is None:
+                return None
+            if isinstance(stock, ItemModel):
+                if stock.num_shards or (stock.quantity or 0) < plan[stock_key]:
+                    return None
+                stock.quantity -= plan[stock_key]
+                stock._stock_only_write = True
+            else:
+                if stock.count < plan[stock_key]:
+                    return None
+                stock.count -= plan[stock_key]
+        reservation = cls(item=item_key, stock=stock_keys, amounts=[plan[key] for key in stock_keys],
+                          user_id=user_id, quantity=quantity, expires_at=expires_at)
+        ndb.put_multi(stocks + [reservation])
+        return reservation
+
+    @classmethod
+    @ndb.transactional()
+    def complete(cls, reservation_id: int, item_id: int, user_id: int) -> 'StockReservation':
+        """
+        Turns a reservation into a sale. Its units already left the stock, so only the reservation is written.
+
+        Raises:
+            ReservationNotFoundError: if the user holds no such reservation of the item, e.g. it was bought already
+            ReservationExpiredError: if the reservation expired
+        """
+        reservation = ndb.Key(cls, reservation_id).get()
+        if reservation is None or reservation.item.id() != item_id or reservation.user_id != user_id:
+            raise ReservationNotFoundError("Invalid reservation id")
+        if reservation.expires_at <= datetime.datetime.utcnow():
+            raise ReservationExpiredError("Reservation expired")
+        reservation.key.delete()
+        return reservation
+
+    @classmethod
+    def release_expired(cls, batch_size: int = RESERVATION_SWEEP_BATCH_SIZE) -> int:
+        """
+        Returns the units of expired reservations to their stock, oldest first, until none is left.
+
+        The reservations taken from the same stock entities are released together, in as few transactions as
+        the entity group limit allows.
+
+        Returns:
+            int: the number of reservations released
+        """
+        released = 0
+        while True:
+            released_before = released
+            expired = cls.query(cls.expires_at <= datetime.datetime.utcnow()).order(cls.expires_at).fetch(batch_size)
+            by_stock = {}
+            for reservation in expired:
+                by_stock.setdefault(tuple(reservation.stock), []).append(reservation.key)
+            for stock_keys, keys in by_stock.items():
+                # Leave room for the stock entities and the shard an item's stock may have moved to.
+                chunk_size = max(MAX_XG_ENTITY_GROUPS - len(stock_keys) - 1, 1)
+                for start in range(0, len(keys), chunk_size):
+                    released += cls._release(keys[start:start + chunk_size])
+            # Stop on a short batch, or when the query only returned reservations released already.
+            if len(expired) < batch_size or released == released_before:
+                return released
+
+    @classmethod
+    def _release(cls, reservation_keys: List[ndb.Key]) -> int:
+        item_key, returned_to_shards, released = cls._release_txn(reservation_keys)
+        if returned_to_shards:
+            item = ItemModel.get_cached(item_key.id())
+            if item is not None:
+                ItemModel._shard_stock_returned(item, returned_to_shards)
+        return released
+
+    @classmethod
+    @ndb.transactional(xg=True)
+    def _release_txn(cls, reservation_keys: List[ndb.Key]) -> Tuple[Optional[ndb.Key], int, int]:
+        """
+        Deletes the reservations that are still expired and returns their units to the stock they were taken from,
+        or to the item's first shard if the item was sharded since they were taken.
+
+        Returns:
+            Tuple[Optional[ndb.Key], int, int]: the item key, the number of units returned to shards and the number
+                of reservations released
+        """
+        now = datetime.datetime.utcnow()
+        reservations = [
+            reservation for reservation in ndb.get_multi(reservation_keys)
+            if reservation is not None and reservation.expires_at <= now
+        ]
+        if not reservations:
+            return None, 0, 0
+        item_key = reservations[0].item
+        amounts = {}
+        for reservation in reservations:
+            for stock_key, amount in reservation.takes():
+                amounts[stock_key] = amounts.get(stock_key, 0) + amount
+
+        stocks = dict(zip(amounts, ndb.get_multi(list(amounts))))
+        item = stocks.get(item_key)
+        if item is not None and item.num_shards:
+            shard_key = ItemStockShard.key_for(item_key.id(), 0)
+            amounts[shard_key] = amounts.get(shard_key, 0) + amounts.pop(item_key)
+            stocks.pop(item_key)
+            if shard_key not in stocks:
+                stocks[shard_key] = shard_key.get()
+
+        returned_to_shards = 0
+        updated = []
+        for stock_key, amount in amounts.items():
+            stock = stocks[stock_key]
+            if stock is None:
+                logger.error(f"Stock {stock_key} of {len(reservations)} expired reservations is gone, dropping {amount} units")
+            elif isinstance(stock, ItemModel):
+                stock.quantity = (stock.quantity or 0) + amount
+                stock._stock_only_write = True
+                updated.append(stock)
+            else:
+                stock.count += amount
+                returned_to_shards += amount
+                updated.append(stock)
+        ndb.put_multi(updated)
+        ndb.delete_multi([reservation.key for reservation in reservations])
+        return item_key, returned_to_shards, len(reservations)
+
+
+class PurchaseEvent(ndb.Model):
+    """
+    An item consumption event waiting in the Datastore outbox to be written to BigQuery.
+
+    The key id is the event id. `lease_expires_at` is when the event becomes available to a worker again,
+    new events are available immediately.
+    """
+    user_id = ndb.IntegerProperty(indexed=False)
+    store_id = ndb.IntegerProperty(indexed=False)
+    item_id = ndb.IntegerProperty(indexed=False)
+    timestamp = ndb.StringProperty(indexed=False)
+    lease_expires_at = ndb.DateTimeProperty(required=True)
+
+    def to_row(self) -> dict:
+        return {
+            "timestamp": self.timestamp,
+            "user_id": self.user_id,
+            "store_id": self.store_id,
+            "item_id": self.item_id,
+            "event_id": self.key.id()
+        }
+
+    @classmethod
+    def lease(cls, limit: int, lease_seconds: int) -> List['PurchaseEvent']:
+        """
+        Leases up to `limit` available events for `lease_seconds`, oldest lease first.
+
+        Events that are not deleted before the lease runs out are handed out again, so delivery is at least once.
+        """
+        now = datetime.datetime.utcnow()
+        events = cls.query(cls.lease_expires_at <= now).order(cls.lease_expires_at).fetch(limit)
+        lease_expires_at = now + datetime.timedelta(seconds=lease_seconds)
+        for event in events:
+            event.lease_expires_at = lease_expires_at
+        ndb.put_multi(events)
+        return events
+
+
+class DeadLetterTask(ndb.Model):
+    """A task that could not be enqueued even after retries, kept so it can be inspected and replayed."""
+    queue_name = ndb.StringProperty(required=True)
+    url = ndb.StringProperty(indexed=False)
+    payload = ndb.TextProperty()
+    error = ndb.TextProperty()
+    created_at = ndb.DateTimeProperty(auto_now_add=True)
+
+    @classmethod
+    def record(cls, tasks: list, error: str) -> List[ndb.Key]:
+        """
+        Args:
+            tasks (list): (queue_name, taskqueue.Task) pairs
+            error (str): the last enqueue error
+        """
+        dead_letters = [
+            cls(queue_name=queue_name, url=task.url, payload=task.payload.decode("utf-8"), error=error)
+            for queue_name, task in tasks
+        ]
+        logger.error(f"Moving {len(dead_letters)} tasks to the dead letter store: {error}")
+        return ndb.put_multi(dead_letters)
+
+
+class AnalyticsRollup(ndb.Model):
+    """
+    Purchase counts for one hour of ItemsConsumed events, keyed by the hour (e.g. '2026-10-17T13').
+
+    `store_items` and `user_items` hold [store_id, item_id, count] and [user_id, item_id, count] triples.
+    An hour with more triples than fit one entity is split into parts, keyed '2026-10-17T13/1' and so on.
+    """
+    bucket_start = ndb.DateTimeProperty(required=True)
+    store_items = ndb.JsonProperty(default=[], compressed=True)
+    user_items = ndb.JsonProperty(default=[], compressed=True)
+    created_at = ndb.DateTimeProperty(auto_now_add=True)
+
+    @classmethod
+    def key_for(cls, bucket_start: datetime.datetime, part: int = 0) -> ndb.Key:
+        hour = bucket_start.strftime("%Y-%m-%dT%H")
+        return ndb.Key(cls, f"{hour}/{part}" if part else hour)
+
+    @classmethod
+    def keys_between(cls, start: datetime.datetime, end: datetime.datetime) -> List[ndb.Key]:
+        return cls.query(cls.bucket_start >= start, cls.bucket_start < end).fetch(keys_only=True)
+
+    @classmethod
+    def latest(cls) -> Optional['AnalyticsRollup']:
+        return cls.query().order(-cls.bucket_start).get()
+
+    @classmethod
+    def since(cls, start: datetime.datetime) -> List['AnalyticsRollup']:
+        return cls.query(cls.bucket_start >= start).fetch()
+
+
+class UniqueValue(CachedModelMixin, ndb.Model):
+    """
+    Claims a normalized value of a unique User property. The value is the key name, so uniqueness is
+    checked with a key lookup inside the registration transaction instead of with a query.
+    """
+    user = ndb.KeyProperty(kind='User', indexed=False)
+
+    @staticmethod
+    def normalize(value: str) -> str:
+        return value.strip().casefold()
+
+    @classmethod
+    def key_for(cls, value: str) -> ndb.Key:
+        return ndb.Key(cls, cls.normalize(value))
+
+    @classmethod
+    def lookup(cls, value: str) -> Optional[ndb.Key]:
+        """
+        Returns:
+            Optional[ndb.Key]: the key of the user who claimed `value`, None if nobody has
+        """
+        normalized = cls.normalize(value)
+        if not normalized:
+            return None
+        claim = cls.get_cached(normalized)
+        return claim.user if claim is not None else None
+
+
+class UniqueUsername(UniqueValue):
+    _cache = EntityCache('UniqueUsername', *UNIQUE_VALUE_CACHE_POLICY)
+
+
+class UniqueEmail(UniqueValue):
+    _cache = EntityCache('UniqueEmail', *UNIQUE_VALUE_CACHE_POLICY)
+
+
+class User(UserMixin, CachedModelMixin, ndb.Model, SerializationMixin):
     username = ndb.StringProperty(required=True)
     password_hash = ndb.StringProperty(required=True)
     email = ndb.StringProperty(required=True)
@@ -175,15 +1287,13 @@ class User(UserMixin, ndb.Model, SerializationMixin):
     is_active = ndb.BooleanProperty(default=True)
     is_admin = ndb.BooleanProperty(default=False)
 
+    # Role and activation changes must not wait for cached copies to expire, hence the short policy.
+    _cache = EntityCache('User', *USER_CACHE_POLICY)
+
+    _serializer_exclude = ('password_hash',)
+
     def to_dict(self):
-        return {
-            "id": self.key.id(),
-            "username": self.username,
-            "email": self.email,
-            "created_at": self.created_at,
-            "is_active": self.is_active,
-            "is_admin": self.is_admin
-        }
+        return self.to_dict_extended(include_id=True)
 
     def get_id(self):
         return self.key.id()
@@ -196,11 +1306,23 @@ class User(UserMixin, ndb.Model, SerializationMixin):
 
     @classmethod
     def get_by_email(cls, email: str) -> Optional['User']:
-        return cls.query(User.email == email).get()
+        return cls._get_by_unique_value(UniqueEmail, email, User.email)
 
     @classmethod
     def get_by_username(cls, username: str) -> Optional['User']:
-        return cls.query(User.username == username).get()
+        return cls._get_by_unique_value(UniqueUsername, username, User.username)
+
+    @classmethod
+    def _get_by_unique_value(cls, claim_class, value: str, prop: ndb.Property) -> Optional['User']:
+        user_key = claim_class.lookup(value)
+        if user_key is not None:
+            return cls.get_cached(user_key.id())
+        if not LEGACY_USER_LOOKUP:
+            return None
+        user = cls.query(prop == value).get()
+        if user is not None:
+            user.claim_unique_values()
+        return user
 
     @classmethod
     def get_by_id(cls, user_id: int) -> Optional['User']:
@@ -208,11 +1330,79 @@ class User(UserMixin, ndb.Model, SerializationMixin):
 
     @classmethod
     def create_user(cls, username: str, email: str, password: str, is_admin: bool = False) -> Union[ndb.Key, None]:
-        if cls.get_by_email(email):
-            raise UserAlreadyExistsError("User with this email already exists")
-        if cls.get_by_username(username):
-            raise UserAlreadyExistsError("User with this username already exists")
+        """
+        Creates a user and claims its username and email in one cross-group transaction,
+        so of two concurrent registrations of the same username or email only one succeeds.
+        Usernames and emails are compared case-insensitively.
+
+        Raises:
+            InvalidUserError: if the username or email is blank
+            UserAlreadyExistsError: if the username or email is claimed by another user
+        """
+        if not UniqueUsername.normalize(username) or not UniqueEmail.normalize(email):
+            raise InvalidUserError("Username and email must not be blank")
+        if LEGACY_USER_LOOKUP:
+            cls._claim_legacy_values(username, email)
         user = cls(username=username, email=email, is_admin=is_admin)
+        # Hashing is slow, keep it out of the transaction.
         user.set_password(password)
+        return cls._put_new_user(user)
+
+    @classmethod
+    def _claim_legacy_values(cls, username: str, email: str):
+        """
+        Claims the values of the users created before registration claimed them that hold `username` or `email`,
+        so that the registration transaction sees them as taken.
+        """
+        for prop, value in ((User.username, username), (User.email, email)):
+            variants = list(dict.fromkeys([value, value.strip(), UniqueValue.normalize(value)]))
+            for legacy_user in cls.query(prop.IN(variants)).fetch():
+                legacy_user.claim_unique_values()
+
+    @staticmethod
+    @ndb.transactional(xg=True)
+    def _put_new_user(user: 'User') -> ndb.Key:
+        username_key = UniqueUsername.key_for(user.username)
+        email_key = UniqueEmail.key_for(user.email)
+        taken_username, taken_email = ndb.get_multi([username_key, email_key])
+        if taken_email is not None:
+            raise UserAlreadyExistsError("User with this email already exists")
+        if taken_username is not None:
+            raise UserAlreadyExistsError("User with this username already exists")
         key = user.put()
+        ndb.put_multi([UniqueUsername(key=username_key, user=key), UniqueEmail(key=email_key, user=key)])
         return key
+
+    def claim_unique_values(self) -> bool:
+        """
+        Claims the username and email of a user created before they were claimed at registration.
+
+        Returns:
+            bool: False if another user already holds either of them
+        """
+        claims = [
+            UniqueUsername.get_or_insert(UniqueUsername.normalize(self.username), user=self.key),
+            UniqueEmail.get_or_insert(UniqueEmail.normalize(self.email), user=self.key),
+        ]
+        if any(claim.user != self.key for claim in claims):
+            logger.warning(f"User {self.key.id()} shares its username or email with another user")
+            return False
+        return True
+
+    @classmethod
+    def claim_all_unique_values(cls, batch_size: int = 100) -> Tuple[int, int]:
+        """
+        Claims the username and email of every user, for the users created before they were claimed at registration.
+
+        Returns:
+            Tuple[int, int]: the number of users visited and the number sharing a username or email with another user
+        """
+        visited = conflicts = 0
+        cursor, more = None, True
+        while more:
+            users, cursor, more = cls.query().fetch_page(batch_size, start_cursor=cursor)
+            for user in users:
+                visited += 1
+                if not user.claim_unique_values():
+                    conflicts += 1
+        return visited, conflicts
@@ -0,0 +1,83 @@
+import time
+import uuid
+from typing import Optional
+
+from google.appengine.api import memcache
+
+from app.cache import get_chunked, set_chunked
+from app.models import logger
+from app.services.rollup_service import fetch_analytics_from_rollups
+from app.services.task_service import enqueue_task
+
+ANALYTICS_CACHE_KEY = "cached_analytics"
+ANALYTICS_LOCK_KEY = "cached_analytics:lock"
+# Served as is for this long, then served stale while one background task refreshes it.
+ANALYTICS_FRESH_FOR = 10 * 60
+ANALYTICS_CACHE_TIME = 24 * 3600
+ANALYTICS_LOCK_TIME = 60
+COLD_CACHE_POLLS = 5
+COLD_CACHE_POLL_INTERVAL = 0.1
+
+
+def _store(analytics: dict):
+    set_chunked(ANALYTICS_CACHE_KEY, {"value": analytics, "fresh_until": time.time() + ANALYTICS_FRESH_FOR},
+                time=ANALYTICS_CACHE_TIME)
+
+def _acquire_lock() -> Optional[str]:
+    token = uuid.uuid4().hex
+    return token if memcache.add(ANALYTICS_LOCK_KEY, token, time=ANALYTICS_LOCK_TIME) else None
+
+def _release_lock(token: str):
+    # A lock that expired during the refresh may be held by another one by now.
+    if memcache.get(ANALYTICS_LOCK_KEY) == token:
+        memcache.delete(ANALYTICS_LOCK_KEY)
+
+def refresh_analytics(lock: Optional[str] = None) -> Optional[dict]:
+    """
+        Recomputes the analytics and stores them under the refresh lock, then releases it.
+
+        Args:
+            lock (Optional[str]): the token of the lock the caller already holds, as passed to the refresh task
+                by get_analytics. Without it the lock is taken first.
+
+        Returns:
+            Optional[dict]: the analytics, or None if another refresh holds the lock
+    """
+    if lock is None:
+        lock = _acquire_lock()
+        if lock is None:
+            return None
+    try:
+        analytics = fetch_analytics_from_rollups()
+        _store(analytics)
+        return analytics
+    finally:
+        _release_lock(lock)
+
+def get_analytics(force_refresh: bool = False) -> dict:
+    """
+        Returns the cached analytics with stale-while-revalidate semantics.
+
+        A stale (or, with `force_refresh`, any) entry is served immediately, and only the request that wins
+        the memcache add() lock enqueues a background refresh. On a cold cache the lock winner computes
+        the analytics inline while the other requests wait briefly for its result.
+    """
+    entry = get_chunked(ANALYTICS_CACHE_KEY)
+    if entry is not None:
+        if force_refresh or entry["fresh_until"] <= time.time():
+            lock = _acquire_lock()
+            if lock is not None:
+                enqueue_task(target='/tasks/refresh_analytics', queue_name='default', payload={"lock": lock})
+        return entry["value"]
+
+    lock = _acquire_lock()
+    if lock is not None:
+        return refresh_analytics(lock)
+
+    for _ in range(COLD_CACHE_POLLS):
+        time.sleep(COLD_CACHE_POLL_INTERVAL)
+        entry = get_chunked(ANALYTICS_CACHE_KEY)
+        if entry is not None:
+            return entry["value"]
+    logger.warning("Analytics cache still cold, computing without the lock")
+    return fetch_analytics_from_rollups()
@@ -1,111 +1,242 @@
-from google.cloud import bigquery
+import hashlib
 import uuid
 import datetime
+import json
+import os
+import time
+from typing import TYPE_CHECKING, List
 
+from app.instrumentation import timed
 from app.models import logger
+from app.services.clients import LazyClient
+
+if TYPE_CHECKING:
+    from google.cloud import bigquery
 
 PROJECT_ID = "acquired-ripple-473314-j5"
 DATASET_ID = "flask_project_dataser"
 TABLE_ID = "ItemsConsumed"
 
-bq_client = bigquery.Client(project=PROJECT_ID)
+TABLE_REF = f"{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}"
+ANALYTICS_LOOKBACK_DAYS = int(os.environ.get("ANALYTICS_LOOKBACK_DAYS", 7))
+
+ITEMS_CONSUMED_SCHEMA = [
+    ("timestamp", "TIMESTAMP"),
+    ("user_id", "INTEGER"),
+    ("store_id", "INTEGER"),
+    ("item_id", "INTEGER"),
+    ("event_id", "INTEGER"),
+]
+ITEMS_CONSUMED_CLUSTERING = ["store_id", "user_id"]
+
+
+def _new_bq_client() -> 'bigquery.Client':
+    # google-cloud-bigquery takes a few hundred milliseconds to import, so only processes that use it load it.
+    from google.cloud import bigquery
+    return bigquery.Client(project=PROJECT_ID)
+
+_bq_client = LazyClient(_new_bq_client)
+
+def get_bq_client() -> 'bigquery.Client':
+    """
+        Returns this process' BigQuery client, built on first use.
+    """
+    return _bq_client.get()
+
+# Row errors with these reasons are transient, or only mean that another row in the batch was rejected.
+RETRYABLE_ROW_ERRORS = {"stopped", "backendError", "internalError", "timeout", "rateLimitExceeded"}
 
-def log_item_consumed(user_id: int, store_id: int, item_id: int, timestamp: datetime.datetime):
-    table_ref = f"{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}"
 
-    row = {
+class BigQueryBatchWriter:
+    """
+        Streams rows to one table with a single insert_rows_json call per batch of at most `max_rows` rows.
+
+        Rows that fail with a retryable error are retried on their own, up to `max_attempts` times; rows
+        BigQuery rejects as invalid are logged and dropped. Each row's `event_id` is sent as its insertId
+        so retried rows are de-duplicated by BigQuery.
+
+        Without a `client`, the process' shared client from get_bq_client is used.
+    """
+
+    def __init__(self, table_ref: str, client=None, max_rows: int = 500, max_attempts: int = 3, backoff: float = 0.5):
+        self.table_ref = table_ref
+        self.client = client
+        self.max_rows = max_rows
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+
+    def write(self, rows: List[dict]) -> List[dict]:
+        """
+            Writes `rows` right away, in batches of at most `max_rows` rows.
+
+            Returns:
+                List[dict]: the rows that could not be written
+        """
+        failed = []
+        for start in range(0, len(rows), self.max_rows):
+            failed.extend(self._insert(rows[start:start + self.max_rows]))
+        return failed
+
+    def _insert(self, rows: List[dict]) -> List[dict]:
+        pending = rows
+        for attempt in range(self.max_attempts):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                with timed("bigquery"):
+                    errors = (self.client or get_bq_client()).insert_rows_json(
+                        self.table_ref, pending, row_ids=[str(row["event_id"]) for row in pending]
+                    )
+            except Exception as e:
+                logger.error(f"Error inserting {len(pending)} rows into BigQuery: {e}")
+                continue
+
+            retry = []
+            for error in errors:
+                row = pending[error["index"]]
+                reasons = {row_error.get("reason") for row_error in error.get("errors", [])}
+                if reasons <= RETRYABLE_ROW_ERRORS:
+                    retry.append(row)
+                else:
+                    logger.error(f"BigQuery rejected row {row}: {error['errors']}")
+            logger.info(f"Inserted {len(pending) - len(errors)} rows into BigQuery, retrying {len(retry)}")
+            pending = retry
+            if not pending:
+                return []
+
+        logger.error(f"Giving up on {len(pending)} rows after {self.max_attempts} attempts")
+        return pending
+
+
+item_consumed_writer = BigQueryBatchWriter(TABLE_REF)
+
+
+def _event_id(source: str, index: int) -> int:
+    # Retries of the same task produce the same ids, so BigQuery de-duplicates the rows they write again.
+    # 15 hex digits keep the ids unique enough to be insertIds while fitting the INTEGER column.
+    return int(hashlib.sha256(f"{source}:{index}".encode("utf-8")).hexdigest()[:15], 16) or 1
+
+
+def _item_consumed_row(user_id: int, store_id: int, item_id: int, timestamp: datetime.datetime, event_id: int) -> dict:
+    return {
         "timestamp": timestamp,
         "user_id": user_id,
         "store_id": store_id,
         "item_id": item_id,
-        "event_id": uuid.uuid4().int >> 96
+        "event_id": event_id
     }
 
-    errors = bq_client.insert_rows_json(table_ref, [row])
-    if errors:
-        logger.error(f"Error inserting row into BigQuery: {errors}")
-
-def fetch_analytics_from_bq():
+def log_item_consumed(user_id: int, store_id: int, item_id: int, timestamp: datetime.datetime,
+                      source: str = None) -> List[dict]:
     """
-        Fetches analytics data from BigQuery and returns it in a dictionary format.
+        Writes one consumed unit to BigQuery before returning.
 
-        This function uses three separate BigQuery jobs to fetch the following data:
-        - A list of distinct user IDs from the last 7 days
-        - A list of stores along with the items they have sold in the last 7 days
-        - A list of users along with the items they have purchased in the last 7 days
+        Returns:
+            List[dict]: the rows that could not be written
+    """
+    event_id = _event_id(source, 0) if source else uuid.uuid4().int >> 65
+    return item_consumed_writer.write([_item_consumed_row(user_id, store_id, item_id, timestamp, event_id)])
 
-        The results are returned in a dictionary format, with each key being a string representing the type of data, and the value being a list of dictionaries containing the data.
+def log_items_consumed(user_id: int, lines: List[dict], timestamp: datetime.datetime, source: str = None) -> List[dict]:
+    """
+        Writes a whole purchase to BigQuery before returning, one row per consumed unit.
 
-        The dictionaries for the store sales and user purchases will contain the following keys:
-        - 'store_id' or 'user_id'
-        - 'items' - a list of dictionaries containing the following keys:
-          - 'item_id'
-          - 'total_items_sold' or 'total_items_bought'
+        Args:
+            user_id: the id of the user that made the purchase
+            lines: dictionaries with 'item_id', 'store_id' and 'quantity' keys
+            timestamp: the time of the purchase
+            source: a name that identifies the purchase across retries, such as the task name;
+                the event ids are derived from it so retried rows are de-duplicated
 
-        The dictionary for the recent users will contain the following key:
-        - 'user_id'
+        Returns:
+            List[dict]: the rows that could not be written
+    """
+    units = [line for line in lines for _ in range(line.get("quantity", 1))]
+    rows = [
+        _item_consumed_row(user_id, line["store_id"], line["item_id"], timestamp,
+                           _event_id(source, index) if source else uuid.uuid4().int >> 65)
+        for index, line in enumerate(units)
+    ]
+    return item_consumed_writer.write(rows)
+
+def ensure_items_consumed_table() -> 'bigquery.Table':
+    """
+        Creates the ItemsConsumed table, partitioned by day on `timestamp` and clustered on store_id and user_id,
+        so the analytics queries only scan the partitions of their time window.
 
-        The data is fetched from the last 7 days.
+        An existing table gets its clustering updated; partitioning cannot be added to an existing table,
+        so a warning is logged if it is missing.
 
         Returns:
-            dict: a dictionary containing the analytics data
+            bigquery.Table: the table
     """
-    seven_days_ago = (datetime.datetime.now() - datetime.timedelta(days=7)).strftime('%Y-%m-%d')
-    queries = {
-        'recent_users': f"""
-            SELECT DISTINCT user_id
-            FROM `{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}`
-            WHERE timestamp >= '{seven_days_ago}'
-        """,
-        'store_sales': f"""
-            SELECT 
-                store_id,
-                ARRAY_AGG(STRUCT(
-                    item_id,
-                    total_items_sold
-                ) ORDER BY total_items_sold DESC) as items
-            FROM (
-                SELECT 
-                    store_id,
-                    item_id,
-                    COUNT(*) as total_items_sold
-                FROM `{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}`
-                WHERE timestamp >= '{seven_days_ago}'
-                GROUP BY store_id, item_id
-            )
-            GROUP BY store_id
-            ORDER BY store_id
-        """,
-        'user_purchases': f"""
-            SELECT 
-                user_id,
-                ARRAY_AGG(STRUCT(
-                    item_id,
-                    total_items_bought
-                ) ORDER BY total_items_bought DESC) as items
-            FROM (
-                SELECT 
-                    user_id,
-                    item_id,
-                    COUNT(*) as total_items_bought
-                FROM `{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}`
-                WHERE timestamp >= '{seven_days_ago}'
-                GROUP BY user_id, item_id
-            )
-            GROUP BY user_id
-            ORDER BY user_id
-        """
+    from google.cloud import bigquery
+
+    bq_client = get_bq_client()
+    bq_client.create_dataset(f"{PROJECT_ID}.{DATASET_ID}", exists_ok=True)
+    schema = [bigquery.SchemaField(name, field_type) for name, field_type in ITEMS_CONSUMED_SCHEMA]
+    table = bigquery.Table(TABLE_REF, schema=schema)
+    table.time_partitioning = bigquery.TimePartitioning(type_=bigquery.TimePartitioningType.DAY, field="timestamp")
+    table.clustering_fields = ITEMS_CONSUMED_CLUSTERING
+    table = bq_client.create_table(table, exists_ok=True)
+
+    if table.time_partitioning is None:
+        logger.warning(f"{TABLE_REF} is not partitioned, analytics queries scan the whole table")
+    if table.clustering_fields != ITEMS_CONSUMED_CLUSTERING:
+        table.clustering_fields = ITEMS_CONSUMED_CLUSTERING
+        table = bq_client.update_table(table, ["clustering_fields"])
+    return table
+
+def _run_query(name: str, query: str, parameters: List['bigquery.ScalarQueryParameter']) -> 'bigquery.QueryJob':
+    from google.cloud import bigquery
+
+    job_config = bigquery.QueryJobConfig(query_parameters=parameters, use_query_cache=True)
+    with timed("bigquery"):
+        return get_bq_client().query(query, job_config=job_config, job_id_prefix=f"{name}_")
+
+def _record_job_stats(name: str, job: 'bigquery.QueryJob') -> dict:
+    """
+        Logs the cost of a finished query job as a JSON line, so refresh costs can be tracked with log-based metrics.
+    """
+    stats = {
+        "query": name,
+        "job_id": job.job_id,
+        "total_bytes_processed": job.total_bytes_processed,
+        "total_bytes_billed": job.total_bytes_billed,
+        "cache_hit": job.cache_hit,
+        "slot_millis": job.slot_millis,
     }
+    logger.info(f"BigQuery job stats {json.dumps(stats)}")
+    return stats
 
-    results = {}
-    jobs = {}
-
-    for name, query in queries.items():
-        query_job = bq_client.query(query)
-        jobs[name] = query_job
+def fetch_hourly_item_counts(start: datetime.datetime, end: datetime.datetime) -> List[dict]:
+    """
+        Counts the purchases between `start` (inclusive) and `end` (exclusive), per hour, store, user and item.
 
-    for name, job in jobs.items():
-        rows = job.result()
-        results[name] = [dict(row) for row in rows]
+        Events delivered more than once are counted once, by event_id.
 
-    return results
+        Returns:
+            List[dict]: rows with 'hour', 'store_id', 'user_id', 'item_id' and 'total' keys
+    """
+    from google.cloud import bigquery
+
+    query = f"""
+        SELECT
+            TIMESTAMP_TRUNC(timestamp, HOUR) as hour,
+            store_id,
+            user_id,
+            item_id,
+            COUNT(DISTINCT event_id) as total
+        FROM `{TABLE_REF}`
+        WHERE timestamp >= @start AND timestamp < @end
+        GROUP BY hour, store_id, user_id, item_id
+    """
+    parameters = [
+        bigquery.ScalarQueryParameter("start", "TIMESTAMP", start.replace(tzinfo=datetime.timezone.utc)),
+        bigquery.ScalarQueryParameter("end", "TIMESTAMP", end.replace(tzinfo=datetime.timezone.utc)),
+    ]
+    job = _run_query("hourly_item_counts", query, parameters)
+    with timed("bigquery"):
+        rows = [dict(row) for row in job.result()]
+    _record_job_stats("hourly_item_counts", job)
+    return rows
@@ -0,0 +1,35 @@
+import os
+import threading
+from typing import Callable, Generic, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class LazyClient(Generic[T]):
+    """
+        Builds a client with `factory` on first use, once per process.
+
+        Importing the client library and discovering credentials is deferred until a request needs the
+        client, so instances that never call the service never pay for it. Concurrent first uses build
+        a single client. A process forked after the client was built, such as a gunicorn worker of a
+        preloaded app, builds its own instead of sharing the parent's connections and locks.
+    """
+
+    def __init__(self, factory: Callable[[], T]):
+        self._factory = factory
+        self._client: Optional[T] = None
+        self._lock = threading.Lock()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def get(self) -> T:
+        client = self._client
+        if client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self._factory()
+                client = self._client
+        return client
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._client = None
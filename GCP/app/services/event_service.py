@@ -0,0 +1,88 @@
+import datetime
+import uuid
+from typing import List
+
+from flask import current_app
+from google.appengine.ext import ndb
+
+from app.models import PurchaseEvent, logger
+from app.services.bigquery_service import TABLE_REF, BigQueryBatchWriter
+from app.services.task_service import enqueue_task
+
+OUTBOX_LEASE_SECONDS = 300
+OUTBOX_BATCH_SIZE = 500
+OUTBOX_MAX_BATCHES = 20
+
+# Writes each leased batch synchronously, so the drain knows which events BigQuery acknowledged.
+outbox_writer = BigQueryBatchWriter(TABLE_REF)
+
+
+def new_event_id() -> int:
+    # 63 random bits: the id is the outbox key and the BigQuery insertId, and must fit the INTEGER column.
+    return (uuid.uuid4().int >> 65) or 1
+
+def publish_item_consumed(user_id: int, lines: List[dict], timestamp: str):
+    """
+        Publishes a purchase for analytics, using the delivery mode in the EVENT_DELIVERY_MODE config.
+
+        'outbox', the default, writes one PurchaseEvent per consumed unit with a single put_multi, to be drained
+        in bulk by the drain_purchase_events cron job. 'push' enqueues one Task Queue task per purchase; the
+        request waits for the add when it ends, so the Task Queue round trip is part of the purchase's latency.
+
+        Args:
+            user_id: the id of the user that made the purchase
+            lines: dictionaries with 'item_id', 'store_id' and 'quantity' keys
+            timestamp: the time of the purchase, in ISO format
+    """
+    if current_app.config.get("EVENT_DELIVERY_MODE") == "outbox":
+        now = datetime.datetime.utcnow()
+        events = [
+            PurchaseEvent(
+                id=new_event_id(),
+                user_id=user_id,
+                store_id=line["store_id"],
+                item_id=line["item_id"],
+                timestamp=timestamp,
+                lease_expires_at=now
+            )
+            for line in lines
+            for _ in range(line.get("quantity", 1))
+        ]
+        ndb.put_multi(events)
+        return
+
+    task_payload = {
+        "user_id": user_id,
+        "lines": lines,
+        "timestamp": timestamp
+    }
+    enqueue_task(target='/tasks/log_items_consumed', queue_name='log-item-consumed', payload=task_payload)
+
+def drain_purchase_events(batch_size: int = OUTBOX_BATCH_SIZE, lease_seconds: int = OUTBOX_LEASE_SECONDS,
+                          max_batches: int = OUTBOX_MAX_BATCHES) -> dict:
+    """
+        Moves events from the Datastore outbox to BigQuery, a leased batch at a time.
+
+        Each batch is written with one BigQuery insert that uses the event ids as insertIds, so events delivered
+        twice are de-duplicated by BigQuery, and only the events BigQuery acknowledged are deleted. Failed events stay leased and are retried once their lease runs out.
+
+        Returns:
+            dict: the number of events written and the number left for a later run
+    """
+    written = failed = 0
+    for _ in range(max_batches):
+        events = PurchaseEvent.lease(batch_size, lease_seconds)
+        if not events:
+            break
+
+        failed_ids = {row["event_id"] for row in outbox_writer.write([event.to_row() for event in events])}
+
+        acked = [event.key for event in events if event.key.id() not in failed_ids]
+        ndb.delete_multi(acked)
+        written += len(acked)
+        failed += len(events) - len(acked)
+        if len(events) < batch_size:
+            break
+
+    logger.info(f"Drained purchase events: written={written}, failed={failed}")
+    return {"written": written, "failed": failed}
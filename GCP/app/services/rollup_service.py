@@ -0,0 +1,116 @@
+import datetime
+import os
+from collections import defaultdict
+from typing import List, Optional
+
+from google.appengine.ext import ndb
+
+from app.models import AnalyticsRollup, logger
+from app.services.bigquery_service import ANALYTICS_LOOKBACK_DAYS, fetch_hourly_item_counts
+
+# Streaming inserts can land a little after the event time; an hour is only rolled up once this has passed.
+ROLLUP_LAG = datetime.timedelta(minutes=5)
+# Events reach BigQuery late when the outbox drain or the log tasks are retried, so every run rolls up the last
+# ROLLUP_RECOMPUTE_HOURS completed hours again. Events that arrive later than that are left out of the rollups.
+ROLLUP_RECOMPUTE_HOURS = int(os.environ.get("ROLLUP_RECOMPUTE_HOURS", 6))
+ROLLUP_MAX_HOURS_PER_RUN = 24 * ANALYTICS_LOOKBACK_DAYS
+# Triples per AnalyticsRollup entity, which keeps busy hours far below Datastore's 1MB entity limit.
+ROLLUP_MAX_ROWS_PER_ENTITY = 10000
+
+
+def _floor_hour(moment: datetime.datetime) -> datetime.datetime:
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+def build_hourly_rollups(now: Optional[datetime.datetime] = None) -> int:
+    """
+        Rolls up every completed hour since the latest AnalyticsRollup, and the last ROLLUP_RECOMPUTE_HOURS
+        completed hours again, with a single BigQuery query. Recomputed hours replace their rollups, so purchases
+        that reached BigQuery after their hour was rolled up are counted once they arrive.
+
+        Hours without purchases still get an (empty) rollup, which marks them as done. Hours with more than
+        ROLLUP_MAX_ROWS_PER_ENTITY triples are split across several rollups, and parts left over from an earlier,
+        larger computation of an hour are deleted.
+
+        Returns:
+            int: the number of hours rolled up
+    """
+    now = now or datetime.datetime.utcnow()
+    end = _floor_hour(now - ROLLUP_LAG)
+    latest = AnalyticsRollup.latest()
+    start = latest.bucket_start + datetime.timedelta(hours=1) if latest else end - datetime.timedelta(days=ANALYTICS_LOOKBACK_DAYS)
+    start = min(start, end - datetime.timedelta(hours=ROLLUP_RECOMPUTE_HOURS))
+    start = max(start, end - datetime.timedelta(hours=ROLLUP_MAX_HOURS_PER_RUN))
+    if start >= end:
+        return 0
+
+    store_items = defaultdict(lambda: defaultdict(int))
+    user_items = defaultdict(lambda: defaultdict(int))
+    for row in fetch_hourly_item_counts(start, end):
+        hour = _floor_hour(row["hour"].replace(tzinfo=None))
+        store_items[hour][(row["store_id"], row["item_id"])] += row["total"]
+        user_items[hour][(row["user_id"], row["item_id"])] += row["total"]
+
+    rollups = []
+    hours = 0
+    hour = start
+    while hour < end:
+        rollups.extend(_rollup_parts(
+            hour,
+            [[store_id, item_id, total] for (store_id, item_id), total in store_items[hour].items()],
+            [[user_id, item_id, total] for (user_id, item_id), total in user_items[hour].items()]
+        ))
+        hours += 1
+        hour += datetime.timedelta(hours=1)
+    stale = set(AnalyticsRollup.keys_between(start, end)) - {rollup.key for rollup in rollups}
+    ndb.put_multi(rollups)
+    ndb.delete_multi(stale)
+    logger.info(f"Built {len(rollups)} analytics rollups for {hours} hours from {start} to {end}")
+    return hours
+
+def _rollup_parts(hour: datetime.datetime, store_items: List[list], user_items: List[list]) -> List[AnalyticsRollup]:
+    rows = [(True, row) for row in store_items] + [(False, row) for row in user_items]
+    return [
+        AnalyticsRollup(
+            key=AnalyticsRollup.key_for(hour, part),
+            bucket_start=hour,
+            store_items=[row for is_store, row in rows[offset:offset + ROLLUP_MAX_ROWS_PER_ENTITY] if is_store],
+            user_items=[row for is_store, row in rows[offset:offset + ROLLUP_MAX_ROWS_PER_ENTITY] if not is_store]
+        )
+        for part, offset in enumerate(range(0, max(len(rows), 1), ROLLUP_MAX_ROWS_PER_ENTITY))
+    ]
+
+def _grouped_items(totals: dict, owner_key: str, total_key: str) -> List[dict]:
+    grouped = defaultdict(list)
+    for (owner_id, item_id), total in totals.items():
+        grouped[owner_id].append({"item_id": item_id, total_key: total})
+    return [
+        {owner_key: owner_id, "items": sorted(items, key=lambda item: item[total_key], reverse=True)}
+        for owner_id, items in sorted(grouped.items())
+    ]
+
+def fetch_analytics_from_rollups(days: int = ANALYTICS_LOOKBACK_DAYS, now: Optional[datetime.datetime] = None) -> dict:
+    """
+        Merges the hourly rollups of the last `days` days into the /analytics response.
+
+        Reads only Datastore, so the cost does not grow with the size of the events table.
+        The data covers the hours rolled up so far, i.e. up to the last completed hour.
+
+        Returns:
+            dict: the 'recent_users', 'store_sales' and 'user_purchases' analytics
+    """
+    now = now or datetime.datetime.utcnow()
+    since = _floor_hour(now) - datetime.timedelta(days=days)
+
+    store_totals = defaultdict(int)
+    user_totals = defaultdict(int)
+    for rollup in AnalyticsRollup.since(since):
+        for store_id, item_id, total in rollup.store_items:
+            store_totals[(store_id, item_id)] += total
+        for user_id, item_id, total in rollup.user_items:
+            user_totals[(user_id, item_id)] += total
+
+    return {
+        "recent_users": [{"user_id": user_id} for user_id in sorted({user_id for user_id, _ in user_totals})],
+        "store_sales": _grouped_items(store_totals, "store_id", "total_items_sold"),
+        "user_purchases": _grouped_items(user_totals, "user_id", "total_items_bought"),
+    }
@@ -1,20 +1,146 @@
-from google.appengine.api import taskqueue
+from flask import Flask, g
+from google.appengine.api import apiproxy_rpc, taskqueue
+import contextvars
 import json
+import threading
+from typing import List, Optional
 
-from app.models import logger
+from app.models import DeadLetterTask, logger
 
-def enqueue_task(target: str, queue_name: str, payload: dict):
+TASK_BATCH_SIZE = taskqueue.MAX_TASKS_PER_ADD
+TASK_MAX_IN_FLIGHT = 10
+TASK_MAX_ATTEMPTS = 3
 
+_current = contextvars.ContextVar("task_batcher", default=None)
+
+
+class TaskBatcher:
+    """
+        Groups the tasks added by one request into Queue.add_async([...]) batch calls.
+
+        Adds are buffered and sent once a batch is full, without waiting for the Task Queue. When the request
+        ends, the remaining tasks are sent and the request waits for all of its batches, so every RPC finishes
+        while the request that started it, and its API ticket, is still alive. Failed batches are retried up to
+        `max_attempts` times and tasks that still fail are stored as DeadLetterTask entities.
+        At most `max_in_flight` batches are outstanding; beyond that a flush waits for the oldest ones.
+    """
+
+    def __init__(self, batch_size: int = TASK_BATCH_SIZE, max_in_flight: int = TASK_MAX_IN_FLIGHT,
+                 max_attempts: int = TASK_MAX_ATTEMPTS):
+        self.batch_size = batch_size
+        self.max_in_flight = max_in_flight
+        self.max_attempts = max_attempts
+        self._pending = []
+        self._in_flight = []
+        self._lock = threading.Lock()
+
+    def add(self, queue_name: str, task: taskqueue.Task):
+        with self._lock:
+            self._pending.append((queue_name, task, 1))
+            full = len(self._pending) >= self.batch_size
+        if full:
+            self.flush()
+
+    def flush(self, wait: bool = False):
+        """
+            Sends every buffered task. With `wait`, also blocks until every outstanding batch has finished,
+            and sends the retries of failed batches until none is left.
+        """
+        self._send()
+        while wait:
+            self._collect(wait=True)
+            with self._lock:
+                if not self._pending:
+                    return
+            self._send()
+
+    def _send(self):
+        self._collect(wait=len(self._in_flight) >= self.max_in_flight)
+        with self._lock:
+            pending, self._pending = self._pending, []
+
+        batches = {}
+        for entry in pending:
+            batches.setdefault(entry[0], []).append(entry)
+        for queue_name, entries in batches.items():
+            for start in range(0, len(entries), self.batch_size):
+                batch = entries[start:start + self.batch_size]
+                try:
+                    rpc = taskqueue.Queue(queue_name).add_async([task for _, task, _ in batch])
+                except Exception as e:
+                    self._failed(batch, e)
+                    continue
+                with self._lock:
+                    self._in_flight.append((rpc, batch))
+
+    def _collect(self, wait: bool):
+        with self._lock:
+            if wait:
+                done, self._in_flight = self._in_flight, []
+            else:
+                done = [flight for flight in self._in_flight if flight[0].state == apiproxy_rpc.RPC.FINISHING]
+                self._in_flight = [flight for flight in self._in_flight if flight not in done]
+
+        for rpc, batch in done:
+            try:
+                rpc.get_result()
+                logger.info(f"Enqueued {len(batch)} tasks")
+            except Exception as e:
+                self._failed(batch, e)
+
+    def _failed(self, batch: List[tuple], error: Exception):
+        logger.error(f"Error enqueuing {len(batch)} tasks: {error}")
+        retry = [(queue_name, task, attempts + 1) for queue_name, task, attempts in batch if attempts < self.max_attempts]
+        dead = [(queue_name, task) for queue_name, task, attempts in batch if attempts >= self.max_attempts]
+        with self._lock:
+            self._pending.extend(retry)
+        if dead:
+            DeadLetterTask.record(dead, str(error))
+
+
+# Batches the tasks added outside of a request, e.g. by a script, which flushes it itself.
+task_batcher = TaskBatcher()
+
+def current_batcher() -> TaskBatcher:
+    """
+        Returns the batcher of the current request, or the process' batcher outside of requests.
+    """
+    return _current.get() or task_batcher
+
+def enqueue_task(target: str, queue_name: str, payload: dict) -> Optional[taskqueue.Task]:
+    """
+        Buffers a task; it is sent with the next batch, at the latest when the current request ends.
+    """
     try:
-        task = taskqueue.add(
+        task = taskqueue.Task(
             url=target,
             payload=json.dumps(payload),
-            method='POST',
-            queue_name=queue_name
+            method='POST'
         )
-
-        logger.info(f"Enqueued task for {str(payload)}")
+        current_batcher().add(queue_name, task)
         return task
     except Exception:
         logger.error(f"Error enqueuing task for {str(payload)}")
         return None
+
+def start_request_tasks():
+    g.task_batcher_token = _current.set(TaskBatcher())
+
+def flush_pending_tasks(exception: Exception = None):
+    """
+        Sends the tasks of the ending request and waits for every batch it sent.
+    """
+    token = g.pop("task_batcher_token", None)
+    if token is None:
+        return
+    try:
+        _current.get().flush(wait=True)
+    finally:
+        _current.reset(token)
+
+def init_task_batching(app: Flask):
+    """
+        Gives every request of `app` its own TaskBatcher, flushed when the request is torn down.
+    """
+    app.before_request(start_request_tasks)
+    app.teardown_request(flush_pending_tasks)
@@ -0,0 +1,103 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from typing import TYPE_CHECKING
+
+from app.models import logger
+from app.cache import LRUCache
+from app.services.clients import LazyClient
+
+if TYPE_CHECKING:
+    import google.auth.transport.requests
+    import requests
+
+GOOGLE_CERTS_URL = os.environ.get("GOOGLE_CERTS_URL", "https://www.googleapis.com/oauth2/v1/certs")
+TOKEN_CACHE_SIZE = 4096
+DEFAULT_CERTS_MAX_AGE = 300
+_MAX_AGE_PATTERN = re.compile(r"max-age=(\d+)")
+
+
+class GoogleCertsCache:
+    """
+        Google's token signing certificates, fetched over one long-lived session and
+        refreshed only when the Cache-Control max-age of the last response runs out.
+    """
+
+    def __init__(self, certs_url: str, transport: 'google.auth.transport.requests.Request'):
+        self.certs_url = certs_url
+        self._transport = transport
+        self._certs = None
+        self._expires_at = 0
+        self._lock = threading.Lock()
+
+    def get(self, force_refresh: bool = False) -> dict:
+        with self._lock:
+            if force_refresh or self._certs is None or self._expires_at <= time.time():
+                self._certs, self._expires_at = self._fetch()
+            return self._certs
+
+    def _fetch(self) -> (dict, float):
+        response = self._transport(self.certs_url, method="GET")
+        if response.status != 200:
+            raise ValueError(f"Could not fetch certificates at {self.certs_url}")
+        cache_control = response.headers.get("cache-control", "")
+        match = _MAX_AGE_PATTERN.search(cache_control)
+        max_age = int(match.group(1)) if match else DEFAULT_CERTS_MAX_AGE
+        logger.info(f"Fetched Google signing certificates, valid for {max_age}s")
+        return json.loads(response.data.decode("utf-8")), time.time() + max_age
+
+
+class TokenVerifier:
+    """
+        Verifies Google ID tokens and remembers the verified claims until the token's `exp`,
+        so repeat callers skip the signature check entirely.
+    """
+
+    def __init__(self, certs_url: str = GOOGLE_CERTS_URL, cache_size: int = TOKEN_CACHE_SIZE, session: 'requests.Session' = None):
+        # The auth transport pulls in requests and urllib3, so it is only imported once a token is verified.
+        import google.auth.transport.requests
+        import requests
+
+        self._transport = google.auth.transport.requests.Request(session=session or requests.Session())
+        self.certs = GoogleCertsCache(certs_url, self._transport)
+        self._verified = LRUCache(max_size=cache_size)
+
+    def verify(self, token: str) -> dict:
+        """
+            Args:
+                token: the encoded ID token
+
+            Returns:
+                dict: the verified token claims
+
+            Raises:
+                ValueError: if the token is malformed, expired or not signed by Google
+        """
+        if not token:
+            raise ValueError("Missing token")
+        cache_key = hashlib.sha256(token.encode("utf-8")).hexdigest()
+        claims = self._verified.get(cache_key)
+        if claims is not None:
+            return claims
+
+        from google.auth import jwt
+
+        try:
+            claims = jwt.decode(token, certs=self.certs.get())
+        except ValueError as e:
+            if "Certificate for key id" not in str(e):
+                raise
+            # Google rotated its keys before our copy of the certificates expired.
+            claims = jwt.decode(token, certs=self.certs.get(force_refresh=True))
+
+        self._verified.set(cache_key, claims, expires_at=claims["exp"])
+        return claims
+
+
+_verifier = LazyClient(TokenVerifier)
+
+def get_token_verifier() -> TokenVerifier:
+    return _verifier.get()
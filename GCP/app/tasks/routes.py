@@ -2,7 +2,11 @@ import logging
 import json
 from flask import request, jsonify
 from app.tasks import bp as task_bp
-from app.services.bigquery_service import log_item_consumed
+from app.models import ItemModel, StockReservation, User
+from app.services.bigquery_service import ensure_items_consumed_table, log_item_consumed, log_items_consumed
+from app.services.event_service import drain_purchase_events
+from app.services.rollup_service import build_hourly_rollups
+from app.services.analytics_service import refresh_analytics
 
 logger = logging.getLogger(__name__)
 
@@ -28,8 +32,9 @@ def log_item_consumed_task():
         if not all([user_id, item_id, store_id]):
             return jsonify({"error": "Missing required fields"}), 400
 
-        # Log to BigQuery
-        log_item_consumed(user_id, item_id, store_id, timestamp)
+        # Written before the task is acknowledged, a failure makes Task Queue retry it.
+        if log_item_consumed(user_id=user_id, store_id=store_id, item_id=item_id, timestamp=timestamp, source=task_name):
+            return jsonify({"error": "BigQuery insert failed"}), 500
         logger.info(f"Successfully logged item consumption: user={user_id}, item={item_id}, store={store_id}, timestamp={timestamp}")
 
         return jsonify({"status": "success"}), 200
@@ -37,3 +42,138 @@ def log_item_consumed_task():
     except json.JSONDecodeError:
         logger.error("Invalid JSON in task payload")
         return jsonify({"error": "Invalid JSON"}), 400
+
+@task_bp.route('/log_items_consumed', methods=['POST'])
+def log_items_consumed_task():
+    """
+    Task handler for logging a batch purchase to BigQuery.
+    Called asynchronously by App Engine Task Queue.
+    """
+    task_name = request.headers.get('X-AppEngine-TaskName')
+    if not task_name:
+        logger.warning("Request not from task queue")
+        return jsonify({"error": "Unauthorized"}), 401
+
+    try:
+        data = json.loads(request.data)
+
+        user_id = data.get('user_id')
+        lines = data.get('lines')
+        timestamp = data.get('timestamp')
+
+        if not user_id or not lines or not all(line.get('item_id') and line.get('store_id') for line in lines):
+            return jsonify({"error": "Missing required fields"}), 400
+
+        # Written before the task is acknowledged, a failure makes Task Queue retry it.
+        if log_items_consumed(user_id, lines, timestamp, source=task_name):
+            return jsonify({"error": "BigQuery insert failed"}), 500
+        logger.info(f"Successfully logged batch consumption: user={user_id}, lines={len(lines)}, timestamp={timestamp}")
+
+        return jsonify({"status": "success"}), 200
+
+    except json.JSONDecodeError:
+        logger.error("Invalid JSON in task payload")
+        return jsonify({"error": "Invalid JSON"}), 400
+
+@task_bp.route('/drain_purchase_events', methods=['GET'])
+def drain_purchase_events_task():
+    """
+    Cron handler that writes the purchase events waiting in the Datastore outbox to BigQuery.
+    """
+    if request.headers.get('X-Appengine-Cron') != 'true':
+        logger.warning("Request not from cron")
+        return jsonify({"error": "Unauthorized"}), 401
+
+    result = drain_purchase_events()
+    return jsonify({"status": "success", **result}), 200
+
+@task_bp.route('/release_expired_reservations', methods=['GET'])
+def release_expired_reservations_task():
+    """
+    Cron handler that returns the stock held by expired reservations.
+    """
+    if request.headers.get('X-Appengine-Cron') != 'true':
+        logger.warning("Request not from cron")
+        return jsonify({"error": "Unauthorized"}), 401
+
+    released = StockReservation.release_expired()
+    return jsonify({"status": "success", "released": released}), 200
+
+@task_bp.route('/build_analytics_rollups', methods=['GET'])
+def build_analytics_rollups_task():
+    """
+    Cron handler that rolls up the purchase events of every completed hour not rolled up yet, and recomputes the latest hours.
+    """
+    if request.headers.get('X-Appengine-Cron') != 'true':
+        logger.warning("Request not from cron")
+        return jsonify({"error": "Unauthorized"}), 401
+
+    hours = build_hourly_rollups()
+    return jsonify({"status": "success", "hours": hours}), 200
+
+@task_bp.route('/ensure_items_consumed_table', methods=['POST', 'GET'])
+def ensure_items_consumed_table_task():
+    """
+    Creates the ItemsConsumed table, or updates its clustering, before purchases are written to it.
+    Run once after a deploy, and daily by cron; it does nothing when the table is already set up.
+    """
+    if not request.headers.get('X-AppEngine-TaskName') and request.headers.get('X-Appengine-Cron') != 'true':
+        logger.warning("Request not from task queue or cron")
+        return jsonify({"error": "Unauthorized"}), 401
+
+    table = ensure_items_consumed_table()
+    return jsonify({"status": "success", "partitioned": table.time_partitioning is not None,
+                    "clustering_fields": table.clustering_fields}), 200
+
+@task_bp.route('/refresh_analytics', methods=['POST', 'GET'])
+def refresh_analytics_task():
+    """
+    Recomputes the cached /analytics response. Enqueued with the refresh lock when a request finds the cache
+    stale, and run by cron to keep it warm; cron runs are skipped while another refresh holds the lock.
+    """
+    if not request.headers.get('X-AppEngine-TaskName') and request.headers.get('X-Appengine-Cron') != 'true':
+        logger.warning("Request not from task queue or cron")
+        return jsonify({"error": "Unauthorized"}), 401
+
+    lock = json.loads(request.data).get("lock") if request.data else None
+    if refresh_analytics(lock) is None:
+        return jsonify({"status": "skipped", "message": "Another refresh is running"}), 200
+    return jsonify({"status": "success"}), 200
+
+@task_bp.route('/claim_user_values', methods=['POST', 'GET'])
+def claim_user_values_task():
+    """
+    One-off migration that claims the username and email of the users registered before they were claimed.
+    Run it once as a task or from cron, then set LEGACY_USER_LOOKUP to false.
+    """
+    if not request.headers.get('X-AppEngine-TaskName') and request.headers.get('X-Appengine-Cron') != 'true':
+        logger.warning("Request not from task queue or cron")
+        return jsonify({"error": "Unauthorized"}), 401
+
+    users, conflicts = User.claim_all_unique_values()
+    return jsonify({"status": "success", "users": users, "conflicts": conflicts}), 200
+
+@task_bp.route('/backfill_item_listing_properties', methods=['POST', 'GET'])
+def backfill_item_listing_properties_task():
+    """
+    One-off migration that stores the listing properties, such as num_shards, of the items written before they existed.
+    Run it once as a task or from cron, then set LEGACY_ITEM_LISTING to false.
+    """
+    if not request.headers.get('X-AppEngine-TaskName') and request.headers.get('X-Appengine-Cron') != 'true':
+        logger.warning("Request not from task queue or cron")
+        return jsonify({"error": "Unauthorized"}), 401
+
+    updated = ItemModel.backfill_listing_properties()
+    return jsonify({"status": "success", "updated": updated}), 200
+
+@task_bp.route('/index_item_search_terms', methods=['POST', 'GET'])
+def index_item_search_terms_task():
+    """
+    One-off migration that writes the search terms of the items created before items were searchable.
+    """
+    if not request.headers.get('X-AppEngine-TaskName') and request.headers.get('X-Appengine-Cron') != 'true':
+        logger.warning("Request not from task queue or cron")
+        return jsonify({"error": "Unauthorized"}), 401
+
+    updated = ItemModel.index_search_terms()
+    return jsonify({"status": "success", "updated": updated}), 200
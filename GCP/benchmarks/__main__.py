@@ -0,0 +1,68 @@
+"""
+    Offline benchmarks against the testbed stubs, run from the GCP directory.
+
+        python -m benchmarks run --output results.json
+        python -m benchmarks run --quick --only buy_item_concurrency get_items_latency
+        python -m benchmarks compare baseline.json results.json --threshold 0.15
+
+    compare exits with status 1 when a metric regressed by more than the threshold, so a change can be checked
+    by running the suite before and after it on the same machine.
+"""
+import argparse
+import sys
+
+from benchmarks import scenarios  # noqa: F401, registers the benchmarks
+from benchmarks.harness import BENCHMARKS, compare, read_results, run, write_results
+
+
+def _run(args) -> int:
+    names = args.only or list(BENCHMARKS)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        print(f"Unknown benchmarks: {', '.join(unknown)}; available: {', '.join(BENCHMARKS)}", file=sys.stderr)
+        return 2
+    results = run(names, quick=args.quick)
+    for name, result in results["benchmarks"].items():
+        print(f"{name} ({result['duration_s']}s)")
+        for metric, value in result["metrics"].items():
+            print(f"    {metric:<40} {value}")
+    if args.output:
+        write_results(results, args.output)
+        print(f"Results written to {args.output}")
+    return 0
+
+
+def _compare(args) -> int:
+    rows = compare(read_results(args.baseline), read_results(args.current), args.threshold)
+    regressions = [row for row in rows if row["regressed"]]
+    for row in rows:
+        flag = "REGRESSED" if row["regressed"] else ""
+        print(f"{row['benchmark']:<24} {row['metric']:<40} {row['baseline']:>12} -> {row['current']:<12} "
+              f"{row['change']:+8.1%} {flag}")
+    print(f"{len(regressions)} of {len(rows)} metrics regressed by more than {args.threshold:.0%}")
+    return 1 if regressions else 0
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description="Offline performance benchmarks.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="run the benchmarks and optionally write the results as JSON")
+    run_parser.add_argument("--only", nargs="+", metavar="NAME", help=f"benchmarks to run, from: {', '.join(BENCHMARKS)}")
+    run_parser.add_argument("--quick", action="store_true", help="smaller catalogs and fewer iterations")
+    run_parser.add_argument("--output", metavar="PATH", help="where to write the JSON results")
+    run_parser.set_defaults(handler=_run)
+
+    compare_parser = commands.add_parser("compare", help="compare two JSON results, failing on regressions")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=0.15,
+                                help="relative change that counts as a regression (default: 0.15)")
+    compare_parser.set_defaults(handler=_compare)
+
+    args = parser.parse_args(argv)
+    return args.handler(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
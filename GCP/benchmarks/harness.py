@@ -0,0 +1,235 @@
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.ext import ndb, testbed
+
+GCP_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+# name -> function(quick) returning {"params": {...}, "metrics": {...}}
+BENCHMARKS: Dict[str, Callable[[bool], dict]] = {}
+
+# Metrics with these suffixes are better when higher; every other metric is better when lower.
+HIGHER_IS_BETTER = ("_per_sec",)
+
+
+def benchmark(name: str):
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+class Stubs:
+    """
+        A fresh set of testbed service stubs: Datastore, Memcache, TaskQueue and App Identity.
+    """
+
+    def __init__(self):
+        self.testbed = testbed.Testbed()
+
+    def __enter__(self) -> testbed.Testbed:
+        from app.cache import EntityCache
+
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(root_path=GCP_ROOT)
+        self.testbed.init_app_identity_stub()
+        ndb.get_context().clear_cache()
+        EntityCache.clear_all_local()
+        return self.testbed
+
+    def __exit__(self, *exc_info):
+        self.testbed.deactivate()
+
+
+class FakeBigQueryClient:
+    """
+        Stands in for bigquery.Client: inserts succeed, and queries return the rows `rows_for(query, job_config)` builds.
+    """
+
+    def __init__(self, rows_for: Callable[[str, Any], List[dict]] = lambda query, job_config: []):
+        self.rows_for = rows_for
+        self.queries = 0
+        self.inserted_rows = 0
+
+    def insert_rows_json(self, table, rows, row_ids=None):
+        self.inserted_rows += len(rows)
+        return []
+
+    def query(self, query, job_config=None, job_id_prefix=None):
+        self.queries += 1
+        return FakeQueryJob(f"{job_id_prefix}{self.queries}", self.rows_for(query, job_config))
+
+
+class FakeQueryJob:
+    def __init__(self, job_id: str, rows: List[dict]):
+        self.job_id = job_id
+        self.rows = rows
+        self.total_bytes_processed = 0
+        self.total_bytes_billed = 0
+        self.cache_hit = False
+        self.slot_millis = 0
+
+    def result(self):
+        return self.rows
+
+
+class RpcCounter:
+    """
+        Counts the API calls made through the stubs, per service and method, and the ones that failed.
+
+        Calls from every thread are counted while the counter is active, i.e. inside its `with` block.
+    """
+
+    _hook_installed = False
+    _active: List['RpcCounter'] = []
+
+    def __init__(self):
+        self.calls = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def _hook(cls, service, call, request, response, rpc, error):
+        for counter in cls._active:
+            counter._record(f"{service}.{call}", error is not None)
+
+    def _record(self, name: str, failed: bool):
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+            if failed:
+                self.errors[name] = self.errors.get(name, 0) + 1
+
+    def __enter__(self) -> 'RpcCounter':
+        # The hook list outlives testbed activations, so the hook is installed once and dispatches to the active counters.
+        if not RpcCounter._hook_installed:
+            apiproxy_stub_map.apiproxy.GetPostCallHooks().Append("benchmarks", RpcCounter._hook)
+            RpcCounter._hook_installed = True
+        RpcCounter._active.append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        RpcCounter._active.remove(self)
+
+
+def summarize(samples: List[float], prefix: str = "") -> Dict[str, float]:
+    """
+        Latency percentiles, in milliseconds, and throughput of a list of durations in seconds.
+    """
+    ordered = sorted(samples)
+    total = sum(ordered)
+    return {
+        f"{prefix}p50_ms": round(statistics.median(ordered) * 1000, 4),
+        f"{prefix}p95_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 4),
+        f"{prefix}mean_ms": round(total / len(ordered) * 1000, 4),
+        f"{prefix}ops_per_sec": round(len(ordered) / total, 2) if total else 0.0,
+    }
+
+
+def measure(func: Callable[[], Any], iterations: int, warmup: int = 3, before: Optional[Callable[[], Any]] = None) -> List[float]:
+    """
+        Times `iterations` calls of `func` after `warmup` untimed ones. `before` runs untimed ahead of every call.
+    """
+    for _ in range(warmup):
+        if before is not None:
+            before()
+        func()
+    samples = []
+    for _ in range(iterations):
+        if before is not None:
+            before()
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def logged_in_client(app, user_key: ndb.Key):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session["_user_id"] = str(user_key.id())
+        session["_fresh"] = True
+    return client
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=GCP_ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(names: List[str], quick: bool = False) -> dict:
+    """
+        Runs the named benchmarks, each against a fresh set of stubs.
+
+        Returns:
+            dict: the environment the run happened in and the params and metrics of every benchmark
+    """
+    results = {}
+    for name in names:
+        with Stubs():
+            started = time.perf_counter()
+            results[name] = BENCHMARKS[name](quick)
+            results[name]["duration_s"] = round(time.perf_counter() - started, 3)
+    return {
+        "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "quick": quick,
+        "benchmarks": results,
+    }
+
+
+def compare(baseline: dict, current: dict, threshold: float) -> List[dict]:
+    """
+        Compares every metric present in both runs.
+
+        Returns:
+            List[dict]: one row per metric with the relative change, positive when the metric got worse,
+                and whether it regressed by more than `threshold`
+    """
+    rows = []
+    for name, result in current["benchmarks"].items():
+        base_metrics = baseline["benchmarks"].get(name, {}).get("metrics", {})
+        for metric, value in result["metrics"].items():
+            base = base_metrics.get(metric)
+            if base is None:
+                continue
+            if base == 0:
+                change = 0.0 if value == 0 else float("inf")
+            else:
+                change = (value - base) / abs(base)
+            if metric.endswith(HIGHER_IS_BETTER):
+                change = -change
+            rows.append({
+                "benchmark": name,
+                "metric": metric,
+                "baseline": base,
+                "current": value,
+                "change": change,
+                "regressed": change > threshold,
+            })
+    return rows
+
+
+def write_results(results: dict, path: str):
+    with open(path, "w") as results_file:
+        json.dump(results, results_file, indent=2, sort_keys=True)
+        results_file.write("\n")
+
+
+def read_results(path: str) -> dict:
+    with open(path) as results_file:
+        return json.load(results_file)
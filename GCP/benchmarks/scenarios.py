@@ -0,0 +1,471 @@
+import datetime
+import threading
+import time
+from typing import List
+
+import requests
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from benchmarks.harness import FakeBigQueryClient, RpcCounter, benchmark, logged_in_client, measure, summarize
+
+
+def _app():
+    from flask import Flask
+    from main import app
+
+    # The App Engine runtime middleware expects the production API server; without it requests reach the stubs.
+    app.wsgi_app = Flask.wsgi_app.__get__(app)
+    return app
+
+
+ADMIN_USERNAME = "bench-admin"
+ADMIN_PASSWORD = "bench-password"
+# Simulated latency of every RPC in the worker_modes benchmark.
+RPC_LATENCY_MS = 5
+
+
+def _admin() -> ndb.Key:
+    from app.models import User
+    return User.create_user(ADMIN_USERNAME, "bench-admin@example.com", ADMIN_PASSWORD, is_admin=True)
+
+
+def _store() -> ndb.Key:
+    from app.models import StoreModel
+    return StoreModel(name="Bench Store", description="Benchmark store").put()
+
+
+def _seed_items(store_key: ndb.Key, count: int) -> List[ndb.Key]:
+    from app.models import ItemModel
+    items = [
+        ItemModel(name=f"Item {index}", description="Benchmark item", price=1.0 + index % 50, quantity=100, store=store_key)
+        for index in range(count)
+    ]
+    return ItemModel.put_multi_chunked(items)
+
+
+def _cold_caches():
+    from app.cache import EntityCache
+    memcache.flush_all()
+    EntityCache.clear_all_local()
+    ndb.get_context().clear_cache()
+
+
+@benchmark("buy_item_concurrency")
+def buy_item_concurrency(quick: bool) -> dict:
+    """
+        Concurrent POST /items/<id>/buy on one item, unsharded and with 8 stock shards.
+
+        Failed Datastore commits are the transaction retries; buys that exhaust their retries fail with a 500.
+    """
+    threads, buys_per_thread = (4, 10) if quick else (8, 25)
+    app = _app()
+    user_key = _admin()
+    store_key = _store()
+    admin = logged_in_client(app, user_key)
+
+    metrics = {}
+    for variant, shards in (("unsharded", None), ("sharded", 8)):
+        item_id = admin.post("/items", json={"name": variant, "price": 1.0, "quantity": threads * buys_per_thread * 2,
+                                             "store_id": store_key.id(), "stock_shards": shards}).get_json()["key_id"]
+        samples, statuses = [], []
+        lock = threading.Lock()
+
+        def buyer():
+            client = logged_in_client(app, user_key)
+            for _ in range(buys_per_thread):
+                start = time.perf_counter()
+                status = client.post(f"/items/{item_id}/buy").status_code
+                with lock:
+                    samples.append(time.perf_counter() - start)
+                    statuses.append(status)
+
+        with RpcCounter() as rpcs:
+            started = time.perf_counter()
+            workers = [threading.Thread(target=buyer) for _ in range(threads)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            elapsed = time.perf_counter() - started
+
+        metrics.update(summarize(samples, prefix=f"{variant}_"))
+        metrics[f"{variant}_buys_per_sec"] = round(len(samples) / elapsed, 2)
+        metrics[f"{variant}_commit_retries"] = rpcs.errors.get("datastore_v3.Commit", 0)
+        metrics[f"{variant}_failed_buys"] = sum(1 for status in statuses if status != 200)
+
+    return {"params": {"threads": threads, "buys_per_thread": buys_per_thread}, "metrics": metrics}
+
+
+@benchmark("get_items_latency")
+def get_items_latency(quick: bool) -> dict:
+    """
+        GET /items?store_id=X page latency as the catalog grows: with cold caches, with warm caches,
+        and for the fifth page reached through cursors.
+    """
+    sizes = (100, 1000) if quick else (100, 1000, 5000)
+    iterations = 10 if quick else 30
+    app = _app()
+    user_key = _admin()
+    client = logged_in_client(app, user_key)
+
+    metrics = {}
+    seeded = 0
+    store_key = _store()
+    for size in sizes:
+        _seed_items(store_key, size - seeded)
+        seeded = size
+        url = f"/items?store_id={store_key.id()}&page_size=20"
+
+        def first_page():
+            assert client.get(url).status_code == 200
+
+        metrics.update(summarize(measure(first_page, iterations, before=_cold_caches), prefix=f"items_{size}_cold_"))
+        metrics.update(summarize(measure(first_page, iterations), prefix=f"items_{size}_warm_"))
+
+        cursor = None
+        for _ in range(4):
+            cursor = client.get(url + (f"&cursor={cursor}" if cursor else "")).get_json()["pagination"]["next_cursor"]
+
+        def fifth_page():
+            assert client.get(f"{url}&cursor={cursor}").status_code == 200
+
+        metrics.update(summarize(measure(fifth_page, iterations, before=_cold_caches), prefix=f"items_{size}_page5_cold_"))
+
+    return {"params": {"catalog_sizes": list(sizes), "page_size": 20, "iterations": iterations}, "metrics": metrics}
+
+
+@benchmark("serialization")
+def serialization(quick: bool) -> dict:
+    """
+        Serializing a page of 100 items: the per-model serializer alone and through the app's JSON provider.
+    """
+    from app.models import ItemModel
+
+    rounds = 20 if quick else 200
+    app = _app()
+    store_key = _store()
+    items = ndb.get_multi(_seed_items(store_key, 100))
+
+    to_dict = measure(lambda: [item.to_dict_extended(include_id=True) for item in items], rounds)
+    dumps = measure(lambda: app.json.dumps({"items": items}), rounds)
+
+    metrics = {}
+    metrics.update(summarize(to_dict, prefix="to_dict_page_"))
+    metrics.update(summarize(dumps, prefix="json_page_"))
+    metrics["to_dict_items_per_sec"] = round(len(items) * len(to_dict) / sum(to_dict), 1)
+    metrics["json_items_per_sec"] = round(len(items) * len(dumps) / sum(dumps), 1)
+    return {"params": {"page_size": len(items), "rounds": rounds, "model": ItemModel.__name__}, "metrics": metrics}
+
+
+class _CertsAdapter(requests.adapters.BaseAdapter):
+    """
+        Serves a certificates document for any URL, so TokenVerifier runs its real code path offline.
+    """
+
+    def __init__(self, body: bytes):
+        super().__init__()
+        self.body = body
+
+    def send(self, request, **kwargs):
+        response = requests.Response()
+        response.status_code = 200
+        response.headers["Content-Type"] = "application/json"
+        response.headers["Cache-Control"] = "public, max-age=3600"
+        response._content = self.body
+        response.request = request
+        response.url = request.url
+        return response
+
+    def close(self):
+        pass
+
+
+def _token_signer():
+    import json
+
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from cryptography.x509.oid import NameOID
+    from google.auth import crypt
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "benchmarks")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(1)
+        .not_valid_before(now)
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .sign(key, hashes.SHA256())
+    )
+    certs = json.dumps({"bench-key": cert.public_bytes(serialization.Encoding.PEM).decode()}).encode()
+    pem = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+    return crypt.RSASigner.from_string(pem, key_id="bench-key"), certs
+
+
+@benchmark("auth_decorators")
+def auth_decorators(quick: bool) -> dict:
+    """
+        Overhead of the auth decorators on an empty view: the session login with login_required, admin_required
+        on top of it, and google_authenticated with a token seen before (cached claims) and with a new one
+        (signature check). The undecorated view is the baseline.
+    """
+    from flask import jsonify
+    from flask_login import LoginManager, login_required
+    from google.auth import jwt
+
+    from app import create_app, decorators
+    from app.models import User
+    from app.services.token_service import TokenVerifier
+
+    iterations = 50 if quick else 500
+    app = create_app()
+    login = LoginManager(app)
+    login.user_loader(lambda user_id: User.get_cached(int(user_id)))
+
+    def empty():
+        return jsonify({}), 200
+
+    app.add_url_rule("/plain", "plain", empty)
+    app.add_url_rule("/login", "login", login_required(empty))
+    app.add_url_rule("/admin", "admin", login_required(decorators.admin_required(empty)))
+    app.add_url_rule("/google", "google", decorators.google_authenticated(empty))
+
+    signer, certs = _token_signer()
+    session = requests.Session()
+    session.mount("https://", _CertsAdapter(certs))
+    verifier = TokenVerifier(certs_url="https://certs.benchmarks.invalid/certs", session=session)
+
+    def token() -> str:
+        now = int(time.time())
+        return jwt.encode(signer, {"sub": str(time.perf_counter_ns()), "iat": now, "exp": now + 600}).decode()
+
+    client = logged_in_client(app, _admin())
+    seen_token = token()
+    get_token_verifier = decorators.get_token_verifier
+    decorators.get_token_verifier = lambda: verifier
+    def get(url: str, token: str = None):
+        headers = {"Authorization": f"Bearer {token}"} if token else {}
+        assert client.get(url, headers=headers).status_code == 200
+
+    try:
+        samples = {
+            "plain": measure(lambda: get("/plain"), iterations),
+            "login_required": measure(lambda: get("/login"), iterations),
+            "admin_required": measure(lambda: get("/admin"), iterations),
+            "google_cached_token": measure(lambda: get("/google", seen_token), iterations),
+        }
+        new_tokens = [token() for _ in range(iterations + 3)]
+        samples["google_new_token"] = measure(lambda: get("/google", new_tokens.pop()), iterations)
+    finally:
+        decorators.get_token_verifier = get_token_verifier
+
+    metrics = {}
+    for name, durations in samples.items():
+        metrics.update(summarize(durations, prefix=f"{name}_"))
+    return {"params": {"iterations": iterations}, "metrics": metrics}
+
+
+def _hourly_rows(users: int, items: int):
+    def rows_for(query, job_config) -> List[dict]:
+        parameters = {parameter.name: parameter.value for parameter in job_config.query_parameters}
+        rows = []
+        hour = parameters["start"]
+        while hour < parameters["end"]:
+            for user_id in range(1, users + 1):
+                rows.append({"hour": hour, "store_id": user_id % 5 + 1, "user_id": user_id,
+                             "item_id": hour.hour * users % items + 1, "total": 1})
+            hour += datetime.timedelta(hours=1)
+        return rows
+    return rows_for
+
+
+@benchmark("analytics")
+def analytics(quick: bool) -> dict:
+    """
+        GET /analytics with a cold cache, computed from a week of hourly rollups, and with a warm one.
+        The rollups are built first from a fake BigQuery client.
+    """
+    from app.services import bigquery_service, rollup_service
+
+    users, items = (20, 50) if quick else (100, 500)
+    iterations = 5 if quick else 20
+    app = _app()
+    client = logged_in_client(app, _admin())
+
+    fake_client = FakeBigQueryClient(_hourly_rows(users, items))
+    get_bq_client = bigquery_service.get_bq_client
+    bigquery_service.get_bq_client = lambda: fake_client
+    try:
+        started = time.perf_counter()
+        hours = rollup_service.build_hourly_rollups()
+        rollup_ms = round((time.perf_counter() - started) * 1000, 2)
+    finally:
+        bigquery_service.get_bq_client = get_bq_client
+
+    def get_analytics():
+        assert client.get("/analytics").status_code == 200
+
+    metrics = {"rollup_build_ms": rollup_ms}
+    metrics.update(summarize(measure(get_analytics, iterations, warmup=1, before=_cold_caches), prefix="cold_"))
+    metrics.update(summarize(measure(get_analytics, iterations), prefix="warm_"))
+    return {"params": {"hours": hours, "users": users, "items": items, "iterations": iterations}, "metrics": metrics}
+
+
+_STARTUP_SCRIPT = """
+import json, sys, time
+started = time.perf_counter()
+import main
+import_ms = (time.perf_counter() - started) * 1000
+modules = len(sys.modules)
+bigquery_imported = "google.cloud.bigquery" in sys.modules
+
+from flask import Flask
+from google.appengine.ext import testbed
+from app.models import User
+stubs = testbed.Testbed()
+stubs.activate()
+stubs.init_datastore_v3_stub()
+stubs.init_memcache_stub()
+main.app.wsgi_app = Flask.wsgi_app.__get__(main.app)
+client = main.app.test_client()
+with client.session_transaction() as session:
+    session["_user_id"] = str(User.create_user("startup", "startup@example.com", "password").id())
+started = time.perf_counter()
+assert client.get("/items").status_code == 200
+first_request_ms = (time.perf_counter() - started) * 1000
+print(json.dumps({"import_ms": import_ms, "first_request_ms": first_request_ms, "modules": modules,
+                  "bigquery_imported": bigquery_imported}))
+"""
+
+
+@benchmark("startup")
+def startup(quick: bool) -> dict:
+    """
+        Cold start of a fresh interpreter: importing main, which builds the app, and serving its first GET /items.
+    """
+    import json
+    import subprocess
+    import sys
+
+    from benchmarks.harness import GCP_ROOT
+
+    runs = 3 if quick else 10
+    results = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", _STARTUP_SCRIPT], cwd=GCP_ROOT, capture_output=True,
+                                text=True, check=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    metrics = {}
+    metrics.update(summarize([result["import_ms"] / 1000 for result in results], prefix="import_main_"))
+    metrics.update(summarize([result["first_request_ms"] / 1000 for result in results], prefix="first_request_"))
+    metrics["imported_modules"] = results[-1]["modules"]
+    return {"params": {"runs": runs, "bigquery_imported_at_startup": results[-1]["bigquery_imported"]}, "metrics": metrics}
+
+
+def _free_port() -> int:
+    import socket
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _serve(worker_class: str, workers: int, threads: int, env: dict):
+    """
+        Starts gunicorn with gunicorn.conf.py and the given worker settings on benchmarks.server:app.
+
+        Returns:
+            Tuple[subprocess.Popen, str]: the server process and its base URL, once it answers
+    """
+    import os
+    import subprocess
+    import sys
+
+    from benchmarks.harness import GCP_ROOT
+
+    port = _free_port()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "benchmarks.server:app"],
+        cwd=GCP_ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        env={**os.environ, **env, "PORT": str(port), "GUNICORN_WORKER_CLASS": worker_class,
+             "GUNICORN_WORKERS": str(workers), "GUNICORN_THREADS": str(threads), "SERVER_TIMING": "false"}
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"gunicorn exited with status {process.returncode}")
+        try:
+            requests.get(f"{base_url}/bench/catalog", timeout=5)
+            return process, base_url
+        except requests.RequestException:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("gunicorn did not start")
+
+
+@benchmark("worker_modes")
+def worker_modes(quick: bool) -> dict:
+    """
+        Requests per second one instance serves with sync workers and with gthread workers, under concurrent clients
+        reading items and store listings. Runs gunicorn with gunicorn.conf.py against benchmarks.server, whose stubs
+        add a simulated latency to every RPC.
+    """
+    clients, requests_per_client = (8, 25) if quick else (16, 100)
+    env = {"BENCH_RPC_LATENCY_MS": str(RPC_LATENCY_MS), "BENCH_CATALOG_SIZE": "100" if quick else "500"}
+    modes = (("sync", "sync", 1, 1), ("gthread", "gthread", 1, 8), ("gthread_2x8", "gthread", 2, 8))
+
+    metrics = {}
+    for name, worker_class, workers, threads in modes:
+        process, base_url = _serve(worker_class, workers, threads, env)
+        try:
+            samples, errors = [], []
+            lock = threading.Lock()
+
+            def reader(index: int):
+                session = requests.Session()
+                login = session.post(f"{base_url}/auth/login", json={"username": ADMIN_USERNAME, "password": ADMIN_PASSWORD})
+                if login.status_code != 200:
+                    # A failed assert would only end this thread, and the run would report no errors.
+                    with lock:
+                        errors.append(login.status_code)
+                    return
+                catalog = session.get(f"{base_url}/bench/catalog").json()
+                urls = [f"{base_url}/items?store_id={catalog['store_id']}&page_size=20&expand=store"]
+                urls += [f"{base_url}/items/{item_id}" for item_id in catalog["item_ids"][index::clients][:10]]
+                for request_index in range(requests_per_client):
+                    start = time.perf_counter()
+                    status = session.get(urls[request_index % len(urls)]).status_code
+                    with lock:
+                        samples.append(time.perf_counter() - start)
+                        if status != 200:
+                            errors.append(status)
+
+            started = time.perf_counter()
+            readers = [threading.Thread(target=reader, args=(index,)) for index in range(clients)]
+            for thread in readers:
+                thread.start()
+            for thread in readers:
+                thread.join()
+            elapsed = time.perf_counter() - started
+        finally:
+            process.terminate()
+            process.wait()
+
+        latency = summarize(samples, prefix=f"{name}_")
+        del latency[f"{name}_ops_per_sec"]
+        metrics.update(latency)
+        metrics[f"{name}_requests_per_sec"] = round(len(samples) / elapsed, 2)
+        metrics[f"{name}_errors"] = len(errors)
+
+    return {
+        "params": {"clients": clients, "requests_per_client": requests_per_client, "rpc_latency_ms": RPC_LATENCY_MS,
+                   "modes": [f"{name}: {workers} x {worker_class}, {threads} threads" for name, worker_class, workers, threads in modes]},
+        "metrics": metrics
+    }
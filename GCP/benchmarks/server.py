@@ -0,0 +1,43 @@
+"""
+    The app served by gunicorn for the worker_modes benchmark, against testbed stubs seeded with a catalog:
+
+        gunicorn -c gunicorn.conf.py benchmarks.server:app
+
+    Each worker process sets up its own stubs, which answer in microseconds. Production RPCs take milliseconds
+    that the worker spends waiting, so every API call first sleeps for BENCH_RPC_LATENCY_MS.
+
+    Requests go through the production WSGI stack, wrap_wsgi_app included, so every request gets its own
+    os.environ and NDB context as in production.
+"""
+import os
+import time
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.ext import testbed
+
+# wrap_wsgi_app starts every request from the os.environ it sees when main is imported: it needs the testbed's
+# app id, but none of the NDB context state that setting up the stubs leaves in this thread's environment.
+testbed.Testbed().setup_env()
+from main import app
+from benchmarks.harness import Stubs
+from benchmarks.scenarios import RPC_LATENCY_MS, _admin, _seed_items, _store
+
+RPC_LATENCY_MS = float(os.environ.get("BENCH_RPC_LATENCY_MS", RPC_LATENCY_MS))
+CATALOG_SIZE = int(os.environ.get("BENCH_CATALOG_SIZE", 200))
+
+
+def _simulate_latency(service, call, request, response, rpc=None):
+    time.sleep(RPC_LATENCY_MS / 1000)
+
+
+Stubs().__enter__()
+_admin()
+store_key = _store()
+item_ids = [key.id() for key in _seed_items(store_key, CATALOG_SIZE)]
+# Added after seeding, so only the requests pay for it.
+apiproxy_stub_map.apiproxy.GetPreCallHooks().Append("simulated_latency", _simulate_latency)
+
+
+@app.route("/bench/catalog", methods=["GET"])
+def bench_catalog():
+    return {"store_id": store_key.id(), "item_ids": item_ids}
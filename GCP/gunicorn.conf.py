@@ -0,0 +1,31 @@
+"""
+    Gunicorn settings, loaded by the app.yaml entrypoint:
+
+        gunicorn -c gunicorn.conf.py main:app
+
+    Requests spend most of their time waiting on Datastore, Memcache, Task Queue and BigQuery RPCs, so each worker
+    runs `threads` requests at once (the gthread worker) instead of one (the sync worker). The app is thread-safe:
+
+    - wrap_wsgi_app makes os.environ request-local and runs every request in a copy of the contextvars context.
+      The NDB context is per thread and is replaced for every request, so requests never share its cache or batches.
+    - Flask-Login keeps the current user on the request context.
+    - The BigQuery client and the token verifier are built once per process under a lock (LazyClient), and are
+      rebuilt in forked children.
+    - The entity caches are shared by the threads of a worker and guard their state with locks. Every request
+      batches its tasks on its own and waits for them before it ends.
+
+    gevent workers are not supported: the App Engine APIs keep request state in threading.local and os.environ,
+    which only stays per request if every library involved is monkey-patched before it is imported.
+
+    Every setting can be overridden from the environment, e.g. GUNICORN_WORKER_CLASS=sync to go back to one
+    request per worker. Keep app.yaml's max_concurrent_requests at workers * threads.
+"""
+import os
+
+bind = f":{os.environ.get('PORT', '8080')}"
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gthread")
+# Workers do not share their in-process caches, so fewer workers with more threads hit them more often.
+workers = int(os.environ.get("GUNICORN_WORKERS", 2))
+threads = int(os.environ.get("GUNICORN_THREADS", 8))
+# With gthread workers the timeout only covers the worker's heartbeat, App Engine enforces request deadlines.
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 60))
@@ -12,6 +12,7 @@ from app.core import bp as main_bp
 from app.auth import bp as auth_bp
 from app.tasks import bp as task_bp
 from app.models import User
+from app.instrumentation import timed
 
 app.register_blueprint(main_bp)
 app.register_blueprint(auth_bp)
@@ -23,7 +24,8 @@ def handle_generic_exception(error):
 
 @login.user_loader
 def load_user(user_id):
-    return User.get_by_id(int(user_id))
+    with timed("user"):
+        return User.get_cached(int(user_id))
 
 if __name__ == "__main__":
     app.run(host="127.0.0.1", port=8080, debug=True)
\ No newline at end of file
@@ -5,6 +5,7 @@ sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")
 import pytest
 from google.appengine.ext import ndb, testbed
 from app import create_app
+from app.cache import EntityCache
 
 @pytest.fixture
 def ndb_stub():
@@ -13,12 +14,28 @@ def ndb_stub():
     tb.init_datastore_v3_stub()
     tb.init_memcache_stub()
     ndb.get_context().clear_cache()
+    EntityCache.clear_all_local()
     yield tb
     tb.deactivate()
 
 
 @pytest.fixture
 def client(ndb_stub):
-    app = create_app()
+    from flask import Flask
+    from main import app
+
+    # The App Engine runtime middleware expects the production API server; without it requests reach the stubs.
+    app.wsgi_app = Flask.wsgi_app.__get__(app)
     app.config["TESTING"] = True
     return app.test_client()
+
+
+@pytest.fixture
+def admin_client(client):
+    from app.models import User
+
+    user_key = User.create_user("admin", "admin@example.com", "password", is_admin=True)
+    with client.session_transaction() as session:
+        session["_user_id"] = str(user_key.id())
+        session["_fresh"] = True
+    return client
@@ -1,6 +1,12 @@
+import datetime
+
+import pytest
+from google.appengine.api import datastore, memcache
 from google.appengine.ext import ndb
 
-from app.models import StoreModel, ItemModel
+from app.exceptions import (InvalidCursorError, ItemSoldOutError, UserAlreadyExistsError, ReservationNotFoundError,
+                            ReservationExpiredError, InvalidUserError)
+from app.models import StoreModel, ItemModel, User, UniqueUsername, StockReservation
 
 def test_create_store(ndb_stub):
     store = StoreModel(name="Init Store", description="Init Desc")
@@ -9,5 +15,330 @@ def test_create_store(ndb_stub):
     assert retrieved.name == "Init Store"
 
 
+def test_consume_sharded_item(ndb_stub):
+    store_key = StoreModel(name="Init Store", description="Init Desc").put()
+    item_key = ItemModel(name="Hot Item", price=5.0, store=store_key, quantity=3).put()
+    ItemModel.enable_sharding(item_key.id(), 2)
+
+    for _ in range(3):
+        ItemModel.consume_item(item_key.id())
+
+    item = ItemModel.get_by_id(item_key.id())
+    assert item.to_dict_extended()["quantity"] == 0
+    with pytest.raises(ItemSoldOutError):
+        ItemModel.consume_item(item_key.id())
+
+    item = ItemModel.update_item(item_key.id(), quantity=5)
+    assert item.get_stock() == 5
+    assert sum(shard.count for shard in ndb.get_multi(item.shard_keys())) == 5
+
+
+def test_consume_sharded_item_only_tries_non_empty_shards(ndb_stub, monkeypatch):
+    from app.models import ItemStockShard
+
+    store_key = StoreModel(name="Init Store", description="Init Desc").put()
+    item_key = ItemModel(name="Hot Item", price=5.0, store=store_key, quantity=1).put()
+    ItemModel.enable_sharding(item_key.id(), 20)
+    tried = []
+    take = ItemStockShard.take
+    monkeypatch.setattr(ItemStockShard, "take", lambda shard_key, amount=1: tried.append(shard_key) or take(shard_key, amount))
+
+    ItemModel.consume_item(item_key.id())
+    assert len(tried) == 1
+
+
+def test_consume_items_is_all_or_nothing(ndb_stub):
+    store_key = StoreModel(name="Init Store", description="Init Desc").put()
+    plain_key = ItemModel(name="Plain Item", price=5.0, store=store_key, quantity=2).put()
+    hot_key = ItemModel(name="Hot Item", price=5.0, store=store_key, quantity=4).put()
+    ItemModel.enable_sharding(hot_key.id(), 3)
+
+    with pytest.raises(ItemSoldOutError) as exc_info:
+        ItemModel.consume_items([(plain_key.id(), 3), (hot_key.id(), 1)])
+    assert exc_info.value.items == [{"item_id": plain_key.id(), "requested": 3, "available": 2}]
+    assert ItemModel.get_by_id(hot_key.id()).get_stock() == 4
+
+    items = ItemModel.consume_items([(plain_key.id(), 2), (hot_key.id(), 3), (hot_key.id(), 1)])
+    assert [item.to_dict_extended()["quantity"] for item in items] == [0, 0]
+
+
+def test_reservations_hold_stock_until_bought_or_expired(ndb_stub):
+    store_key = StoreModel(name="Init Store", description="Init Desc").put()
+    plain_key = ItemModel(name="Plain Item", price=5.0, store=store_key, quantity=3).put()
+    hot_key = ItemModel(name="Hot Item", price=5.0, store=store_key, quantity=4).put()
+    ItemModel.enable_sharding(hot_key.id(), 2)
+
+    bought = ItemModel.reserve(plain_key.id(), user_id=1, quantity=2)
+    expiring = ItemModel.reserve(plain_key.id(), user_id=1)
+    held = ItemModel.reserve(hot_key.id(), user_id=1, quantity=2)
+    assert ItemModel.get_by_id(plain_key.id()).get_stock() == 0
+    assert ItemModel.get_by_id(hot_key.id()).get_stock() == 2
+    with pytest.raises(ItemSoldOutError):
+        ItemModel.reserve(plain_key.id(), user_id=2)
+
+    with pytest.raises(ReservationNotFoundError):
+        StockReservation.complete(bought.key.id(), plain_key.id(), user_id=2)
+    assert StockReservation.complete(bought.key.id(), plain_key.id(), user_id=1).quantity == 2
+    with pytest.raises(ReservationNotFoundError):
+        StockReservation.complete(bought.key.id(), plain_key.id(), user_id=1)
+
+    past = datetime.datetime.utcnow() - datetime.timedelta(seconds=1)
+    for reservation in (expiring, held):
+        reservation.expires_at = past
+        reservation.put()
+    with pytest.raises(ReservationExpiredError):
+        StockReservation.complete(expiring.key.id(), plain_key.id(), user_id=1)
+
+    assert StockReservation.release_expired() == 2
+    assert StockReservation.query().count() == 0
+    assert ItemModel.get_by_id(plain_key.id()).get_stock() == 1
+    assert ItemModel.get_by_id(hot_key.id()).get_stock() == 4
+
+
+def test_sharded_sold_out_checks_sum_the_shards(ndb_stub):
+    store_key = StoreModel(name="Init Store", description="Init Desc").put()
+    item_key = ItemModel(name="Hot Item", price=5.0, store=store_key, quantity=3).put()
+    ItemModel.enable_sharding(item_key.id(), 2)
+    stock_key = ItemModel._stock_cache_key(item_key.id())
+
+    # The memcache total drifted below the shards.
+    memcache.set(stock_key, 0)
+    ItemModel.consume_item(item_key.id())
+    memcache.set(stock_key, 0)
+    assert ItemModel.reserve(item_key.id(), user_id=1, quantity=2).quantity == 2
+    assert memcache.get(stock_key) == 0
+    with pytest.raises(ItemSoldOutError):
+        ItemModel.consume_item(item_key.id())
+
+
+def test_reservations_of_sharded_items_span_shards(ndb_stub):
+    store_key = StoreModel(name="Init Store", description="Init Desc").put()
+    item_key = ItemModel(name="Hot Item", price=5.0, store=store_key, quantity=10).put()
+    item = ItemModel.enable_sharding(item_key.id(), 10)
+
+    reservation = ItemModel.reserve(item_key.id(), user_id=1, quantity=4)
+    assert len(reservation.stock) == 4 and reservation.amounts == [1, 1, 1, 1]
+    assert ItemModel.get_by_id(item_key.id()).get_stock(cached=False) == 6
+    with pytest.raises(ItemSoldOutError) as sold_out:
+        ItemModel.reserve(item_key.id(), user_id=1, quantity=7)
+    assert sold_out.value.items == [{"item_id": item_key.id(), "requested": 7, "available": 6}]
+
+    reservation.expires_at = datetime.datetime.utcnow() - datetime.timedelta(seconds=1)
+    reservation.put()
+    assert StockReservation.release_expired() == 1
+    assert [shard.count for shard in ndb.get_multi(item.shard_keys())] == [1] * 10
+    assert ItemModel.get_by_id(item_key.id()).get_stock() == 10
+
+
+def test_cached_user_sees_role_changes(ndb_stub):
+    user_key = User.create_user(username="user", email="user@example.com", password="secret")
+    assert User.get_cached(user_key.id()).is_admin is False
+
+    user = User.get_by_id(user_key.id())
+    user.is_admin = True
+    user.put()
+
+    assert User.get_cached(user_key.id()).is_admin is True
+    assert User.get_cached(123456) is None
+
+
+def test_usernames_and_emails_are_claimed_at_registration(ndb_stub):
+    user_key = User.create_user(username="Alice", email="alice@example.com", password="secret")
+
+    with pytest.raises(UserAlreadyExistsError):
+        User.create_user(username=" alice ", email="other@example.com", password="secret")
+    with pytest.raises(UserAlreadyExistsError):
+        User.create_user(username="bob", email="ALICE@example.com", password="secret")
+    assert User.query().count() == 1
+
+    assert User.get_by_username("ALICE").key == user_key
+    assert User.get_by_email("alice@example.com").key == user_key
+    assert User.get_by_username("nobody") is None
+
+    legacy_key = User(username="carol", email="carol@example.com", password_hash="x").put()
+    with pytest.raises(UserAlreadyExistsError):
+        User.create_user(username="Carol", email="new-carol@example.com", password="secret")
+    assert UniqueUsername.get_by_id("carol").user == legacy_key
+    assert User.get_by_username("carol").key == legacy_key
+
+    legacy_key = User(username="dave", email="dave@example.com", password_hash="x").put()
+    assert User.get_by_username("dave").key == legacy_key
+    assert UniqueUsername.get_by_id("dave").user == legacy_key
+
+    with pytest.raises(InvalidUserError):
+        User.create_user(username="   ", email="blank@example.com", password="secret")
+
+
+def test_entity_cache_reads_through_and_invalidates_on_update(ndb_stub):
+    store_key = StoreModel(name="Init Store", description="Init Desc").put()
+    item_key = ItemModel(name="Plain Item", price=5.0, store=store_key, quantity=2).put()
+    before = ItemModel._cache.stats()
+
+    assert ItemModel.get_cached(item_key.id()).quantity == 2
+    assert ItemModel.get_cached(item_key.id()).quantity == 2
+    assert StoreModel.exists_cached(store_key.id())
+    assert not StoreModel.exists_cached(123456)
+    stats = ItemModel._cache.stats()
+    assert stats["misses"] - before["misses"] == 1
+    assert stats["local_hits"] - before["local_hits"] == 1
+
+    ItemModel.consume_item(item_key.id())
+    assert ItemModel.get_cached(item_key.id()).quantity == 1
+    ItemModel.update_item(item_key.id(), price=7.5)
+    assert ItemModel.get_multi_cached([item_key.id(), 123456])[0].price == 7.5
+
+
+def test_entity_cache_read_through_loses_to_a_concurrent_invalidation(ndb_stub, monkeypatch):
+    from app import cache
+
+    store_key = StoreModel(name="Init Store", description="Init Desc").put()
+    item_key = ItemModel(name="Plain Item", price=5.0, store=store_key, quantity=2).put()
+    get_multi = ndb.get_multi
+
+    def get_multi_then_update(keys, **kwargs):
+        entities = get_multi(keys, **kwargs)
+        # The update commits and invalidates after this reader loaded the old entity, before it is cached.
+        ItemModel.update_item(item_key.id(), price=7.5)
+        return entities
+    monkeypatch.setattr(cache.ndb, "get_multi", get_multi_then_update)
+    assert ItemModel.get_cached(item_key.id()).price == 5.0
+    monkeypatch.setattr(cache.ndb, "get_multi", get_multi)
+
+    assert memcache.get(ItemModel._cache.cache_key(item_key.id())) is None
+    assert ItemModel.get_cached(item_key.id()).price == 7.5
+    assert ItemModel.get_multi_cached([item_key.id()], local=False)[0].price == 7.5
+
+
+def test_cached_etag_loses_to_a_concurrent_write(ndb_stub, monkeypatch):
+    store_key = StoreModel(name="Init Store", description="Init Desc").put()
+    item_key = ItemModel(name="Plain Item", price=5.0, store=store_key, quantity=2).put()
+    stale_etag = item_key.get().etag()
+    get = ItemModel._cache.get
+
+    def get_then_update(model_class, entity_id, local=True):
+        entity = get(model_class, entity_id, local=local)
+        # The update commits and invalidates the ETag after this reader loaded the old version.
+        ItemModel.update_item(item_key.id(), price=7.5)
+        return entity
+    monkeypatch.setattr(ItemModel._cache, "get", get_then_update)
+    assert ItemModel.cached_etag(item_key.id()) == stale_etag
+    monkeypatch.setattr(ItemModel._cache, "get", get)
+
+    assert memcache.get(ItemModel._cache.version_key(item_key.id())) is None
+    assert ItemModel.cached_etag(item_key.id()) == item_key.get().etag() != stale_etag
+
+
+def test_put_multi_chunked_returns_a_key_per_item(ndb_stub):
+    store_key = StoreModel(name="Init Store", description="Init Desc").put()
+    items = [ItemModel(name=f"Item {index}", price=1.0, store=store_key) for index in range(7)]
+
+    keys = ItemModel.put_multi_chunked(items, chunk_size=3)
+
+    assert [key.kind() for key in keys] == ["ItemModel"] * 7
+    assert [item.name for item in ItemModel.get_multi_cached([key.id() for key in keys])] == [item.name for item in items]
+
+
+def test_index_yaml_matches_the_listing_queries():
+    from app.indexes import INDEX_FILE, item_listing_indexes, render_index_yaml
+
+    with open(INDEX_FILE) as index_file:
+        assert index_file.read() == render_index_yaml(item_listing_indexes())
+
+
+def test_serializer_matches_the_default_json_encoding(ndb_stub):
+    from flask.json.provider import DefaultJSONProvider
+    from app import create_app, serialization
+
+    store_key = StoreModel(name="Init Store", description="Init Desc").put()
+    item = ItemModel(name="Plain Item", price=5.0, store=store_key, quantity=2)
+    item.put()
+    user = User(username="user", email="user@example.com", password_hash="hash")
+    user.put()
+
+    assert item.to_dict_extended({"name", "store"}, include_id=True) == {"name": "Plain Item", "store": store_key.id(), "id": item.key.id()}
+    assert "password_hash" not in user.to_dict()
+
+    app = create_app()
+    item_dict = {**item.to_dict(exclude=["num_shards", "version", "search_terms"]), "store": store_key.id()}
+    user_dict = {**user.to_dict(), "created_at": user.created_at}
+    reference = DefaultJSONProvider(app).dumps({"items": [item_dict], "user": user_dict}, separators=(",", ":"))
+    assert app.json.dumps({"items": [item], "user": user.to_dict()}, separators=(",", ":")) == reference
+
+    orjson, serialization.orjson = serialization.orjson, None
+    try:
+        assert app.json.dumps({"items": [item], "user": user.to_dict()}, separators=(",", ":")) == reference
+    finally:
+        serialization.orjson = orjson
+
+
+def test_paginate_binds_cursors_to_the_query(ndb_stub):
+    store_key = StoreModel(name="Init Store", description="Init Desc").put()
+    for index in range(5):
+        ItemModel(name=f"Item {index}", price=1.0, store=store_key).put()
+
+    first = ItemModel.paginate("secret", page_size=2, store_id=store_key.id())
+    assert [item.name for item in first.items] == ["Item 0", "Item 1"]
+
+    second = ItemModel.paginate("secret", page_size=2, cursor=first.next_cursor, store_id=store_key.id())
+    third = ItemModel.paginate("secret", page_size=2, cursor=second.next_cursor, store_id=store_key.id())
+    assert [item.name for item in second.items + third.items] == ["Item 2", "Item 3", "Item 4"]
+    assert third.next_cursor is None and third.has_more is False
+
+    for kwargs in ({"secret_key": "other"}, {"reverse": True}, {"page_size": 3}, {"store_id": None}):
+        arguments = {"secret_key": "secret", "page_size": 2, "store_id": store_key.id(), **kwargs}
+        with pytest.raises(InvalidCursorError):
+            ItemModel.paginate(cursor=first.next_cursor, **arguments)
+
+
+def test_etag_follows_the_entity_version(ndb_stub):
+    store_key = StoreModel(name="Init Store", description="Init Desc").put()
+    item_key = ItemModel(name="Item", price=1.0, quantity=2, store=store_key).put()
+    first = ItemModel.cached_etag(item_key.id())
+    assert first == item_key.get().etag()
+
+    ItemModel.consume_item(item_key.id())
+    second = ItemModel.cached_etag(item_key.id())
+    assert second != first and second == item_key.get().etag()
+    assert "version" not in item_key.get().to_dict_extended()
+    assert ItemModel.cached_etag(item_key.id() + 1000) is None
+
+
+def test_listing_cache_is_invalidated_by_item_writes(ndb_stub):
+    store_key = StoreModel(name="Init Store", description="Init Desc").put()
+    other_store_key = StoreModel(name="Other Store", description="Other Desc").put()
+    item_key = ItemModel(name="Item", price=1.0, quantity=2, store=store_key).put()
+    scopes = ItemModel.listing_scopes(store_key.id())
+
+    value, token = ItemModel.listing_cache.get(scopes, {"page_size": 2})
+    assert value is None and ItemModel.listing_cache.set(token, {"items": ["page"]})
+    assert ItemModel.listing_cache.get(scopes, {"page_size": 2})[0] == {"items": ["page"]}
+    assert ItemModel.listing_cache.get(scopes, {"page_size": 3})[0] is None
+
+    ItemModel(name="Other Item", price=1.0, store=other_store_key).put()
+    ItemModel.listing_changed(other_store_key.id())
+    assert ItemModel.listing_cache.get(scopes, {"page_size": 2})[0] == {"items": ["page"]}
+
+    # Purchases only move stock, which pages cache for STOCK_LISTING_CACHE_TIME instead.
+    ItemModel.consume_item(item_key.id())
+    assert ItemModel.listing_cache.get(scopes, {"page_size": 2})[0] == {"items": ["page"]}
+
+    ItemModel.update_item(item_key.id(), price=2.0)
+    assert ItemModel.listing_cache.get(scopes, {"page_size": 2})[0] is None
+
+
+def test_backfill_lists_legacy_items_in_projected_listings(ndb_stub):
+    store_key = StoreModel(name="Init Store", description="Init Desc").put()
+    # Written before num_shards existed.
+    legacy = datastore.Entity("ItemModel")
+    legacy.update({"name": "Legacy Item", "price": 1.0, "quantity": 2, "store": store_key.to_old_key(),
+                   "created_at": datetime.datetime.utcnow()})
+    datastore.Put(legacy)
+    ItemModel(name="New Item", price=1.0, quantity=2, store=store_key).put()
 
+    def projected_names():
+        return [item.name for item in ItemModel.paginate("secret", projected=True).items]
 
+    assert projected_names() == ["New Item"]
+    assert ItemModel.backfill_listing_properties() == 1
+    assert sorted(projected_names()) == ["Legacy Item", "New Item"]
+    assert ItemModel.backfill_listing_properties() == 0
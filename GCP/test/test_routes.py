@@ -1,10 +1,253 @@
-from google.appengine.ext import ndb
+import datetime
+import os
+import threading
 
-from app.models import StoreModel, ItemModel
+from google.appengine.ext import ndb, testbed
 
-def test_create_store_endpoint(client):
-    response = client.post("/store", json={"name": "Init Store"})
+from app.models import StoreModel, ItemModel, StockReservation
+from app.services import task_service
+
+def test_create_store_endpoint(admin_client):
+    response = admin_client.post("/stores", json={"name": "Init Store", "description": "Init Desc"})
     data = response.get_json()
     assert response.status_code == 201
     assert "key_id" in data
     assert "model" in data
+
+
+def test_responses_carry_server_timing(admin_client, caplog):
+    store_id = admin_client.post("/stores", json={"name": "Init Store", "description": "Init Desc"}).get_json()["key_id"]
+
+    response = admin_client.get(f"/stores/{store_id}")
+    timing = response.headers["Server-Timing"]
+    assert "memcache;dur=" in timing and "total;dur=" in timing
+
+    metrics = [record.json_fields for record in caplog.records if hasattr(record, "json_fields")]
+    assert metrics[-1]["endpoint"] == "core.get_store" and metrics[-1]["status"] == 200
+    assert metrics[-1]["rpc_counts"]["memcache"] >= 1
+
+
+def test_cache_stats_cover_every_entity_cache(admin_client):
+    store_id = admin_client.post("/stores", json={"name": "Init Store", "description": "Init Desc"}).get_json()["key_id"]
+    admin_client.get(f"/stores/{store_id}")
+
+    stats = admin_client.get("/cache/stats").json
+    assert {"StoreModel", "ItemModel", "User", "UniqueUsername", "UniqueEmail"} <= set(stats)
+    assert stats["StoreModel"]["local_hits"] + stats["StoreModel"]["memcache_hits"] + stats["StoreModel"]["misses"] >= 1
+
+
+def test_search_items_by_word_prefixes(admin_client):
+    store_key = StoreModel(name="Init Store", description="Init Desc").put()
+    for name in ("Wireless Headphones", "Wired Headphones", "Headphone Stand", "Wireless"):
+        ItemModel(name=name, price=5.0, store=store_key, quantity=1).put()
+
+    response = admin_client.get("/items/search?q=WIRE head&page_size=10")
+    assert response.status_code == 200
+    assert [item["name"] for item in response.json["items"]] == ["Wired Headphones", "Wireless Headphones"]
+    assert "search_terms" not in response.json["items"][0]
+
+    response = admin_client.get("/items/search?q=wireless")
+    assert [item["name"] for item in response.json["items"]] == ["Wireless", "Wireless Headphones"]
+
+    names = []
+    cursor = ""
+    while cursor is not None:
+        page = admin_client.get(f"/items/search?q=head&page_size=2&cursor={cursor}").json
+        names += [item["name"] for item in page["items"]]
+        cursor = page["pagination"]["next_cursor"]
+    assert names == ["Headphone Stand", "Wired Headphones", "Wireless Headphones"]
+
+    assert admin_client.get("/items/search?q=").status_code == 400
+
+
+def test_expand_embeds_the_stores_of_items(admin_client):
+    store_key = StoreModel(name="Init Store", description="Init Desc").put()
+    item_key = ItemModel(name="Plain Item", price=5.0, store=store_key, quantity=1).put()
+    url = f"/items?store_id={store_key.id()}&expand=store"
+
+    items = admin_client.get(url).json["items"]
+    assert items[0]["store"]["id"] == store_key.id()
+    assert items[0]["store"]["name"] == "Init Store"
+    assert admin_client.get(f"/items?ids={item_key.id()}&expand=store").json["items"][0]["store"]["id"] == store_key.id()
+    assert admin_client.get("/items?expand=owner").status_code == 400
+
+    response = admin_client.get(f"/items/{item_key.id()}?expand=store")
+    assert response.json["store"]["name"] == "Init Store"
+    etag = response.headers["ETag"]
+
+    assert admin_client.put(f"/stores/{store_key.id()}", json={"name": "Renamed Store"}).status_code == 200
+    assert admin_client.get(url).json["items"][0]["store"]["name"] == "Renamed Store"
+    response = admin_client.get(f"/items/{item_key.id()}?expand=store", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.json["store"]["name"] == "Renamed Store"
+
+    # A rename committed on another instance cannot invalidate this process' copy of the store.
+    cache_key = StoreModel._cache.cache_key(store_key.id())
+    stale = StoreModel._cache._local.get(cache_key)
+    assert admin_client.put(f"/stores/{store_key.id()}", json={"name": "Moved Store"}).status_code == 200
+    StoreModel._cache._local.set(cache_key, stale)
+    assert admin_client.get(url).json["items"][0]["store"]["name"] == "Moved Store"
+
+
+def test_cached_listing_pages_skip_this_process_copies(admin_client):
+    store_key = StoreModel(name="Init Store", description="Init Desc").put()
+    item_key = ItemModel(name="Plain Item", price=5.0, store=store_key, quantity=1).put()
+    cache_key = ItemModel._cache.cache_key(item_key.id())
+    ItemModel.get_cached(item_key.id())
+    stale = ItemModel._cache._local.get(cache_key)
+
+    ItemModel.update_item(item_key.id(), price=7.0)
+    # As if the update was committed on another instance, which cannot invalidate this process' copy.
+    ItemModel._cache._local.set(cache_key, stale)
+    assert admin_client.get(f"/items?store_id={store_key.id()}").json["items"][0]["price"] == 7.0
+
+
+def test_reserve_and_buy_reserved_items(admin_client):
+    store_key = StoreModel(name="Init Store", description="Init Desc").put()
+    item_key = ItemModel(name="Plain Item", price=5.0, store=store_key, quantity=3).put()
+
+    response = admin_client.post(f"/items/{item_key.id()}/reserve", json={"quantity": 2, "ttl": 300})
+    assert response.status_code == 201
+    reservation_id = response.json["reservation_id"]
+    assert response.json["item_id"] == item_key.id() and response.json["quantity"] == 2
+    assert admin_client.post(f"/items/{item_key.id()}/reserve", json={"quantity": 2}).status_code == 400
+    assert admin_client.post(f"/items/{item_key.id()}/reserve", json={"ttl": 0}).status_code == 400
+    assert admin_client.post(f"/items/{item_key.id() + 1000}/reserve").status_code == 404
+
+    other = StockReservation.query().get()
+    other.user_id += 1
+    other.put()
+    response = admin_client.post(f"/items/{item_key.id()}/buy", json={"reservation_id": reservation_id})
+    assert response.status_code == 404
+
+    other.user_id -= 1
+    other.expires_at = datetime.datetime.utcnow() - datetime.timedelta(seconds=1)
+    other.put()
+    response = admin_client.post(f"/items/{item_key.id()}/buy", json={"reservation_id": reservation_id})
+    assert response.status_code == 410
+    assert admin_client.post(f"/items/{item_key.id()}/buy", json={"reservation_id": "1"}).status_code == 400
+
+    reservation_id = admin_client.post(f"/items/{item_key.id()}/reserve").json["reservation_id"]
+    response = admin_client.post(f"/items/{item_key.id()}/buy", json={"reservation_id": reservation_id})
+    assert response.status_code == 200 and response.json["quantity"] == 0
+    response = admin_client.post(f"/items/{item_key.id()}/buy", json={"reservation_id": reservation_id})
+    assert response.status_code == 404
+
+
+def test_boolean_quantities_are_rejected(admin_client):
+    store_key = StoreModel(name="Init Store", description="Init Desc").put()
+    item_key = ItemModel(name="Plain Item", price=5.0, store=store_key, quantity=3).put()
+
+    response = admin_client.post("/items/buy", json=[{"item_id": item_key.id(), "quantity": True}])
+    assert response.status_code == 400 and response.json["message"] == "Quantity must be >= 1"
+    assert item_key.get().quantity == 3
+
+    item = {"name": "New Item", "price": 1.0, "store_id": store_key.id()}
+    assert admin_client.post("/items", json={**item, "quantity": True}).json["message"] == "Invalid item quantity"
+    assert admin_client.post("/items", json={**item, "stock_shards": True}).json["message"] == "Invalid stock shard count"
+    results = admin_client.post("/items/bulk", json=[{**item, "quantity": False}, item]).json["results"]
+    assert [result["status"] for result in results] == [400, 201]
+
+
+def test_purchases_do_not_wait_for_the_task_queue(admin_client, ndb_stub, monkeypatch):
+    from google.appengine.api import taskqueue
+    from app.models import PurchaseEvent
+
+    ndb_stub.init_taskqueue_stub(root_path=os.path.join(os.path.dirname(__file__), ".."))
+    adds = []
+    add_async = taskqueue.Queue.add_async
+    monkeypatch.setattr(taskqueue.Queue, "add_async", lambda queue, tasks: adds.append(queue.name) or add_async(queue, tasks))
+    store_key = StoreModel(name="Init Store", description="Init Desc").put()
+    item_key = ItemModel(name="Plain Item", price=5.0, store=store_key, quantity=3).put()
+
+    assert admin_client.post(f"/items/{item_key.id()}/buy").status_code == 200
+    assert admin_client.post("/items/buy", json=[{"item_id": item_key.id(), "quantity": 2}]).status_code == 200
+    assert adds == []
+    assert PurchaseEvent.query().count() == 3
+
+
+def test_requests_wait_for_the_tasks_they_enqueue(admin_client, ndb_stub, monkeypatch):
+    monkeypatch.setitem(admin_client.application.config, "EVENT_DELIVERY_MODE", "push")
+    ndb_stub.init_taskqueue_stub(root_path=os.path.join(os.path.dirname(__file__), ".."))
+    taskqueue_stub = ndb_stub.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+    store_key = StoreModel(name="Init Store", description="Init Desc").put()
+    item_key = ItemModel(name="Plain Item", price=5.0, store=store_key, quantity=3).put()
+
+    assert admin_client.post(f"/items/{item_key.id()}/buy").status_code == 200
+    assert len(taskqueue_stub.GetTasks("log-item-consumed")) == 1
+    assert task_service.current_batcher() is task_service.task_batcher
+    assert task_service.task_batcher._pending == [] and task_service.task_batcher._in_flight == []
+
+
+def test_concurrent_requests_through_the_production_wsgi_stack():
+    import requests
+    from benchmarks.scenarios import ADMIN_PASSWORD, ADMIN_USERNAME, _serve
+
+    # One gthread worker serving benchmarks.server, whose app runs behind wrap_wsgi_app as in production.
+    process, base_url = _serve("gthread", 1, 8, {"BENCH_RPC_LATENCY_MS": "1", "BENCH_CATALOG_SIZE": "8"})
+    try:
+        catalog = requests.get(f"{base_url}/bench/catalog", timeout=10).json()
+        statuses = []
+
+        def buy_all(item_id):
+            session = requests.Session()
+            session.post(f"{base_url}/auth/login", json={"username": ADMIN_USERNAME, "password": ADMIN_PASSWORD})
+            for _ in range(5):
+                statuses.append(session.post(f"{base_url}/items/{item_id}/buy", timeout=10).status_code)
+                statuses.append(session.get(f"{base_url}/items?store_id={catalog['store_id']}", timeout=10).status_code)
+
+        threads = [threading.Thread(target=buy_all, args=(item_id,)) for item_id in catalog["item_ids"]]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert statuses == [200] * 80
+        session = requests.Session()
+        session.post(f"{base_url}/auth/login", json={"username": ADMIN_USERNAME, "password": ADMIN_PASSWORD})
+        for item_id in catalog["item_ids"]:
+            assert session.get(f"{base_url}/items/{item_id}", timeout=10).json()["quantity"] == 95
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def test_log_items_consumed_task_fails_until_the_rows_are_written(client, monkeypatch):
+    from app.services import bigquery_service
+
+    class FlakyBigQueryClient:
+        def __init__(self):
+            self.row_ids = []
+
+        def insert_rows_json(self, table, rows, row_ids=None):
+            self.row_ids.append(row_ids)
+            if len(self.row_ids) <= bigquery_service.item_consumed_writer.max_attempts:
+                raise ConnectionError("BigQuery unavailable")
+            return []
+
+    bq_client = FlakyBigQueryClient()
+    monkeypatch.setattr(bigquery_service, "get_bq_client", lambda: bq_client)
+    monkeypatch.setattr(bigquery_service.item_consumed_writer, "backoff", 0)
+    payload = {"user_id": 1, "lines": [{"item_id": 2, "store_id": 3, "quantity": 2}], "timestamp": "2024-01-01T00:00:00"}
+    headers = {"X-AppEngine-TaskName": "task-1"}
+
+    assert client.post("/tasks/log_items_consumed", json=payload, headers=headers).status_code == 500
+    assert client.post("/tasks/log_items_consumed", json=payload, headers=headers).status_code == 200
+    assert len(set(map(tuple, bq_client.row_ids))) == 1
+    assert len(set(bq_client.row_ids[0])) == 2
+
+
+def test_ensure_items_consumed_table_task(client, monkeypatch):
+    from app.tasks import routes as task_routes
+
+    class Table:
+        time_partitioning = object()
+        clustering_fields = ["store_id", "user_id"]
+    calls = []
+    monkeypatch.setattr(task_routes, "ensure_items_consumed_table", lambda: calls.append(1) or Table())
+
+    assert client.get("/tasks/ensure_items_consumed_table").status_code == 401
+    response = client.get("/tasks/ensure_items_consumed_table", headers={"X-Appengine-Cron": "true"})
+    assert response.status_code == 200
+    assert response.json == {"status": "success", "partitioned": True, "clustering_fields": ["store_id", "user_id"]}
+    assert calls == [1]
@@ -0,0 +1,304 @@
+import datetime
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+from google.appengine.api import memcache, taskqueue
+from google.appengine.ext import ndb, testbed
+from google.auth import crypt, jwt
+
+from app.models import DeadLetterTask, PurchaseEvent
+from app.cache import get_chunked, set_chunked
+from app.services import analytics_service, bigquery_service, event_service, rollup_service, task_service
+from app.services.bigquery_service import BigQueryBatchWriter
+from app.services.event_service import drain_purchase_events
+from app.services.task_service import enqueue_task
+from app.services.token_service import TokenVerifier
+
+
+class FakeBigQueryClient:
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.calls = []
+
+    def insert_rows_json(self, table, rows, row_ids=None):
+        self.calls.append((table, list(rows), row_ids))
+        return self.responses.pop(0) if self.responses else []
+
+    def query(self, query, job_config=None, job_id_prefix=None):
+        self.calls.append((query, job_config, job_id_prefix))
+        return FakeQueryJob(job_id_prefix)
+
+
+class FakeQueryJob:
+    def __init__(self, job_id_prefix):
+        self.job_id = f"{job_id_prefix}1"
+        self.total_bytes_processed = 1024
+        self.total_bytes_billed = 10485760
+        self.cache_hit = False
+        self.slot_millis = 12
+
+    def result(self):
+        return []
+
+
+@pytest.fixture
+def certs_endpoint():
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "stand-in")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(1)
+        .not_valid_before(now)
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .sign(key, hashes.SHA256())
+    )
+    body = json.dumps({"kid-1": cert.public_bytes(serialization.Encoding.PEM).decode()}).encode()
+    hits = []
+
+    class CertsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            hits.append(self.path)
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Cache-Control", "public, max-age=3600")
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), CertsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    pem = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+    signer = crypt.RSASigner.from_string(pem, key_id="kid-1")
+    yield f"http://127.0.0.1:{server.server_port}/certs", signer, hits
+    server.shutdown()
+
+
+def test_token_verifier_caches_certs_and_claims(certs_endpoint):
+    certs_url, signer, hits = certs_endpoint
+    verifier = TokenVerifier(certs_url=certs_url)
+    now = int(time.time())
+    token = jwt.encode(signer, {"sub": "123", "iat": now, "exp": now + 600}).decode()
+    other = jwt.encode(signer, {"sub": "456", "iat": now, "exp": now + 600}).decode()
+
+    assert verifier.verify(token)["sub"] == "123"
+    assert verifier.verify(token)["sub"] == "123"
+    assert verifier.verify(other)["sub"] == "456"
+    assert len(hits) == 1
+
+    with pytest.raises(ValueError):
+        verifier.verify(token[:-4] + "AAAA")
+
+
+def test_batch_writer_retries_only_failed_rows():
+    client = FakeBigQueryClient([[
+        {"index": 1, "errors": [{"reason": "backendError"}]},
+        {"index": 2, "errors": [{"reason": "invalid"}]},
+    ]])
+    writer = BigQueryBatchWriter("project.dataset.table", client=client, max_rows=3, backoff=0)
+    rows = [{"event_id": event_id} for event_id in range(4)]
+
+    assert writer.write(rows) == []
+    assert [call[1] for call in client.calls] == [rows[:3], [rows[1]], [rows[3]]]
+    assert client.calls[1][2] == ["1"]
+
+
+def test_hourly_item_counts_are_parameterized(monkeypatch):
+    client = FakeBigQueryClient([])
+    monkeypatch.setattr(bigquery_service, "get_bq_client", lambda: client)
+    start = datetime.datetime(2026, 10, 17, 8)
+    end = datetime.datetime(2026, 10, 17, 14)
+
+    assert bigquery_service.fetch_hourly_item_counts(start, end) == []
+    query, job_config, job_id_prefix = client.calls[0]
+    assert job_id_prefix == "hourly_item_counts_"
+    assert "@start" in query and "@end" in query
+    assert [parameter.value for parameter in job_config.query_parameters] == [
+        start.replace(tzinfo=datetime.timezone.utc), end.replace(tzinfo=datetime.timezone.utc)
+    ]
+
+
+def test_event_ids_use_at_least_60_bits():
+    event_ids = [event_service.new_event_id() for _ in range(1000)]
+    assert all(0 < event_id < 2 ** 63 for event_id in event_ids)
+    assert max(event_ids) >= 2 ** 40
+
+    task_event_ids = [bigquery_service._event_id("task-1", index) for index in range(1000)]
+    assert all(0 < event_id < 2 ** 63 for event_id in task_event_ids)
+    assert max(task_event_ids) >= 2 ** 40
+    assert task_event_ids == [bigquery_service._event_id("task-1", index) for index in range(1000)]
+
+
+def test_drain_purchase_events_keeps_unacknowledged_events(ndb_stub, monkeypatch):
+    failure = {"index": 1, "errors": [{"reason": "backendError"}]}
+    client = FakeBigQueryClient([[failure], [{**failure, "index": 0}], [{**failure, "index": 0}]])
+    monkeypatch.setattr(event_service.outbox_writer, "client", client)
+    monkeypatch.setattr(event_service.outbox_writer, "backoff", 0)
+    now = datetime.datetime.utcnow()
+    ndb.put_multi([
+        PurchaseEvent(id=event_id, user_id=1, store_id=2, item_id=3, lease_expires_at=now)
+        for event_id in (11, 12, 13)
+    ])
+
+    assert drain_purchase_events() == {"written": 2, "failed": 1}
+    remaining = PurchaseEvent.query().fetch()
+    assert [event.key.id() for event in remaining] == [client.calls[0][1][1]["event_id"]]
+    assert remaining[0].lease_expires_at > now
+    assert drain_purchase_events() == {"written": 0, "failed": 0}
+
+
+class FailingBigQueryClient:
+    def insert_rows_json(self, table, rows, row_ids=None):
+        raise ConnectionError("BigQuery unavailable")
+
+
+def test_drain_purchase_events_keeps_full_batches_that_fail(ndb_stub, monkeypatch):
+    monkeypatch.setattr(event_service.outbox_writer, "client", FailingBigQueryClient())
+    monkeypatch.setattr(event_service.outbox_writer, "backoff", 0)
+    now = datetime.datetime.utcnow()
+    ndb.put_multi([
+        PurchaseEvent(id=event_id, user_id=1, store_id=2, item_id=3, lease_expires_at=now)
+        for event_id in range(1, 501)
+    ])
+
+    assert drain_purchase_events() == {"written": 0, "failed": 500}
+    assert PurchaseEvent.query().count() == 500
+
+
+def test_enqueue_task_batches_and_dead_letters(ndb_stub, monkeypatch):
+    ndb_stub.init_taskqueue_stub(root_path=os.path.join(os.path.dirname(__file__), ".."))
+    taskqueue_stub = ndb_stub.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+
+    for item_id in range(3):
+        enqueue_task(target="/tasks/log_items_consumed", queue_name="log-item-consumed", payload={"item_id": item_id})
+    assert taskqueue_stub.GetTasks("log-item-consumed") == []
+    task_service.task_batcher.flush(wait=True)
+    assert len(taskqueue_stub.GetTasks("log-item-consumed")) == 3
+
+    def failing_add_async(self, tasks):
+        raise taskqueue.TransientError("unavailable")
+    monkeypatch.setattr(taskqueue.Queue, "add_async", failing_add_async)
+    enqueue_task(target="/tasks/log_items_consumed", queue_name="log-item-consumed", payload={"item_id": 4})
+    for _ in range(task_service.TASK_MAX_ATTEMPTS):
+        task_service.task_batcher.flush(wait=True)
+
+    dead_letters = DeadLetterTask.query().fetch()
+    assert [json.loads(dead_letter.payload) for dead_letter in dead_letters] == [{"item_id": 4}]
+
+
+def test_rollups_recompute_recent_hours_and_merge_on_read(ndb_stub, monkeypatch):
+    hour = datetime.datetime(2026, 10, 17, 12)
+    events = [
+        {"hour": hour, "store_id": 1, "user_id": 7, "item_id": 10, "total": 2},
+        {"hour": hour, "store_id": 1, "user_id": 8, "item_id": 11, "total": 3},
+    ]
+    queried = []
+    def fake_hourly_counts(start, end):
+        queried.append((start, end))
+        return [dict(row) for row in events if start <= row["hour"] < end]
+    monkeypatch.setattr(rollup_service, "fetch_hourly_item_counts", fake_hourly_counts)
+    now = datetime.datetime(2026, 10, 17, 13, 30)
+
+    assert rollup_service.build_hourly_rollups(now) == 24 * 7
+    # A purchase made at 12:xx reaches BigQuery after that hour was rolled up.
+    events.append({"hour": hour, "store_id": 1, "user_id": 7, "item_id": 10, "total": 2})
+    events.append({"hour": hour + datetime.timedelta(hours=1), "store_id": 1, "user_id": 8, "item_id": 11, "total": 3})
+    assert rollup_service.build_hourly_rollups(now + datetime.timedelta(hours=1)) == rollup_service.ROLLUP_RECOMPUTE_HOURS
+    assert queried[1] == (datetime.datetime(2026, 10, 17, 14) - datetime.timedelta(hours=rollup_service.ROLLUP_RECOMPUTE_HOURS),
+                          datetime.datetime(2026, 10, 17, 14))
+
+    analytics = rollup_service.fetch_analytics_from_rollups(now=now + datetime.timedelta(hours=1))
+    assert analytics["recent_users"] == [{"user_id": 7}, {"user_id": 8}]
+    assert analytics["store_sales"] == [{"store_id": 1, "items": [
+        {"item_id": 11, "total_items_sold": 6}, {"item_id": 10, "total_items_sold": 4}
+    ]}]
+    assert analytics["user_purchases"][0] == {"user_id": 7, "items": [{"item_id": 10, "total_items_bought": 4}]}
+
+
+def test_rollups_of_busy_hours_are_split_below_the_entity_limit(ndb_stub, monkeypatch):
+    from app.models import AnalyticsRollup
+
+    hour = datetime.datetime(2026, 10, 17, 12)
+    rows = [
+        {"hour": hour, "store_id": 10 ** 12 + index % 50, "user_id": 10 ** 15 + index, "item_id": 10 ** 15 + index, "total": 1}
+        for index in range(15000)
+    ]
+    monkeypatch.setattr(rollup_service, "fetch_hourly_item_counts", lambda start, end: [row for row in rows if start <= row["hour"] < end])
+    now = datetime.datetime(2026, 10, 17, 13, 30)
+
+    assert rollup_service.build_hourly_rollups(now) == 24 * 7
+    parts = [rollup for rollup in AnalyticsRollup.query().fetch() if rollup.bucket_start == hour]
+    assert len(parts) == 3
+    for part in parts:
+        assert len(part.store_items) + len(part.user_items) <= rollup_service.ROLLUP_MAX_ROWS_PER_ENTITY
+        assert len(part._to_pb().SerializeToString()) < 1024 * 1024
+    analytics = rollup_service.fetch_analytics_from_rollups(now=now)
+    assert len(analytics["recent_users"]) == 15000
+    assert sum(len(store["items"]) for store in analytics["store_sales"]) == 15000
+
+    # A recomputation of the hour that needs fewer parts removes the others.
+    del rows[100:]
+    rollup_service.build_hourly_rollups(now + datetime.timedelta(hours=1))
+    assert [rollup.key for rollup in AnalyticsRollup.query().fetch() if rollup.bucket_start == hour] == [AnalyticsRollup.key_for(hour)]
+    assert len(rollup_service.fetch_analytics_from_rollups(now=now)["recent_users"]) == 100
+
+
+def test_chunked_values_larger_than_a_memcache_entry(ndb_stub):
+    value = {"blob": os.urandom(2 * 1024 * 1024 + 17)}
+    assert set_chunked("big", value)
+    assert get_chunked("big") == value
+    assert get_chunked("missing") is None
+
+
+def test_analytics_are_computed_once_and_refreshed_in_the_background(ndb_stub, monkeypatch):
+    computed = []
+    monkeypatch.setattr(analytics_service, "fetch_analytics_from_rollups", lambda: computed.append(1) or {"n": len(computed)})
+    refreshes = []
+    monkeypatch.setattr(analytics_service, "enqueue_task", lambda **kwargs: refreshes.append(kwargs))
+
+    assert analytics_service.get_analytics() == {"n": 1}
+    assert analytics_service.get_analytics() == {"n": 1}
+    assert analytics_service.get_analytics(force_refresh=True) == {"n": 1}
+    assert analytics_service.get_analytics(force_refresh=True) == {"n": 1}
+    assert [refresh["target"] for refresh in refreshes] == ["/tasks/refresh_analytics"]
+
+    # A cron refresh neither runs nor releases the lock while the enqueued refresh holds it.
+    assert analytics_service.refresh_analytics() is None
+    assert memcache.get(analytics_service.ANALYTICS_LOCK_KEY) == refreshes[0]["payload"]["lock"]
+    assert analytics_service.refresh_analytics(refreshes[0]["payload"]["lock"]) == {"n": 2}
+    assert analytics_service.get_analytics() == {"n": 2}
+    assert analytics_service.refresh_analytics() == {"n": 3}
+    assert memcache.get(analytics_service.ANALYTICS_LOCK_KEY) is None
+
+
+def test_request_metrics_count_rpcs_from_many_threads():
+    from app.instrumentation import RequestMetrics
+
+    metrics = RequestMetrics()
+    def callbacks(thread):
+        for index in range(1000):
+            metrics.start_rpc("datastore", (thread, index))
+            metrics.finish_rpc("datastore", (thread, index))
+            metrics.add_memcache_lookups(1, 1)
+    threads = [threading.Thread(target=callbacks, args=(thread,)) for thread in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert metrics.rpc_counts == {"datastore": 8000}
+    assert metrics.memcache_hits == metrics.memcache_misses == 8000
+    assert metrics._rpc_started == {}